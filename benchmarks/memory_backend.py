@@ -0,0 +1,58 @@
+"""Stress the memory backend with concurrent readers and writers, and report
+the throughput for an increasing number of threads.
+
+Each thread works on its own model, hence threads should never wait for
+each other's locks::
+
+    $ python benchmarks/memory_backend.py --threads 1 2 4 8 --operations 20000
+"""
+import argparse
+import threading
+import time
+
+from daybed.backends.id_generators import KoremutakeGenerator
+from daybed.backends.memory import MemoryBackend
+
+
+def worker(backend, model_id, operations):
+    backend.put_model({'title': model_id}, {'read_definition': []}, model_id)
+    record_id = None
+    for i in range(operations):
+        if i % 4 == 0:
+            record_id, _ = backend.put_record(model_id, {'i': i}, ['bench'])
+        elif i % 4 == 3:
+            backend.get_paginated_records(model_id, 20)
+        else:
+            backend.get_record(model_id, record_id)
+
+
+def run(threads_count, operations):
+    backend = MemoryBackend(KoremutakeGenerator())
+    per_thread = operations // threads_count
+    threads = [threading.Thread(target=worker,
+                                args=(backend, 'model%s' % i, per_thread))
+               for i in range(threads_count)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    return per_thread * threads_count / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--threads', type=int, nargs='+',
+                        default=[1, 2, 4, 8, 16])
+    parser.add_argument('--operations', type=int, default=20000)
+    args = parser.parse_args()
+
+    print('%8s %14s' % ('threads', 'operations/s'))
+    for threads_count in args.threads:
+        throughput = run(threads_count, args.operations)
+        print('%8d %14.0f' % (threads_count, throughput))
+
+
+if __name__ == '__main__':
+    main()
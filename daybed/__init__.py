@@ -26,7 +26,7 @@ from daybed.permissions import (
 )
 from daybed.views.errors import forbidden_view
 from daybed.renderers import GeoJSON
-from daybed import indexer, events
+from daybed import events
 
 
 API_VERSION = 'v%s' % __version__.split('.')[0]
@@ -127,22 +127,28 @@ def main(global_config, **settings):
 
     # Indexing
 
-    # Connect client to hosts in conf
-    index_hosts = build_list(settings.get('elasticsearch.hosts',
-                                          "localhost:9200"))
-    indices_prefix = settings.get('elasticsearch.indices_prefix', 'daybed_')
-    config.registry.index = index = indexer.ElasticSearchIndexer(
-        index_hosts, indices_prefix
-    )
+    # Elasticsearch by default, or the in-process LocalIndexer
+    indexer_class = config.maybe_dotted(
+        settings.get('daybed.indexer', 'daybed.indexer.ElasticSearchIndexer'))
+    config.registry.index = index = indexer_class.load_from_config(config)
 
     # Suscribe index methods to API events
     config.add_subscriber(index.on_model_created, events.ModelCreated)
     config.add_subscriber(index.on_model_updated, events.ModelUpdated)
     config.add_subscriber(index.on_model_deleted, events.ModelDeleted)
     config.add_subscriber(index.on_record_created, events.RecordCreated)
+    config.add_subscriber(index.on_records_created, events.RecordsCreated)
     config.add_subscriber(index.on_record_updated, events.RecordUpdated)
     config.add_subscriber(index.on_record_deleted, events.RecordDeleted)
 
+    # Compiled record schemas
+    from daybed.schemas.validators import (record_schemas,
+                                           invalidate_record_schema)
+    record_schemas.size = int(settings.get('daybed.record_schemas_cache_size',
+                                           record_schemas.size))
+    config.add_subscriber(invalidate_record_schema, events.ModelUpdated)
+    config.add_subscriber(invalidate_record_schema, events.ModelDeleted)
+
     # Renderers
 
     # Force default accept header to JSON
@@ -162,9 +168,11 @@ def main(global_config, **settings):
     config.add_renderer('geojson', GeoJSON())
 
     # Requests attachments
+    from daybed.backends.cache import RequestBackend
 
     def attach_objects_to_request(event):
-        event.request.db = config.registry.backend
+        # Reads are memoized for the duration of the request.
+        event.request.db = RequestBackend(config.registry.backend)
         event.request.index = config.registry.index
         http_scheme = event.request.registry.settings.get('daybed.http_scheme')
         if http_scheme:
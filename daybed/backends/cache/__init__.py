@@ -0,0 +1,417 @@
+from copy import deepcopy
+import threading
+import time
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+import redis
+
+from daybed import logger
+from daybed.backends.exceptions import (ModelNotFound, RecordNotFound,
+                                        CredentialsNotFound)
+from daybed.permissions import permissions_matrix
+
+
+# Value of the entries deleted from a TTLCache.
+_DELETED = object()
+
+
+class TTLCache(object):
+    """A thread-safe LRU cache, whose entries expire after ``ttl`` seconds.
+
+    Every write is stamped with a generation number, so that a value read
+    from the source is not stored if the key was written or deleted
+    meanwhile (see :meth:`stamp`).
+    """
+    def __init__(self, size=1000, ttl=60):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._cleared = 0
+
+    def get(self, key):
+        """Returns the value of ``key``, or raises ``KeyError`` if it is
+        unknown or expired.
+        """
+        with self._lock:
+            expires, value, generation = self._entries[key]
+            if value is _DELETED or expires < time.time():
+                raise KeyError(key)
+            # Move it to the most recently used end.
+            del self._entries[key]
+            self._entries[key] = (expires, value, generation)
+            return value
+
+    def stamp(self):
+        """Returns the current generation, to be given to :meth:`set` with
+        a value read from the source after this call.
+        """
+        with self._lock:
+            return self._generation
+
+    def set(self, key, value, ttl=None, generation=None):
+        """Stores the value of ``key``.
+
+        With the ``generation`` stamped before it was read, the value is
+        not stored if the key was written, deleted or cleared since, as it
+        may be stale.
+        """
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock:
+            if generation is not None and self.__written_since(key,
+                                                               generation):
+                return
+            self.__store(key, value, ttl)
+
+    def delete(self, key):
+        with self._lock:
+            # Kept as a tombstone for the values being read meanwhile.
+            self.__store(key, _DELETED, self.ttl)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+            self._cleared = self._generation
+
+    def __written_since(self, key, generation):
+        if self._cleared > generation:
+            return True
+        entry = self._entries.get(key)
+        return entry is not None and entry[2] > generation
+
+    def __store(self, key, value, ttl):
+        self._generation += 1
+        self._entries.pop(key, None)
+        self._entries[key] = (time.time() + ttl, value, self._generation)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+
+class CachedBackend(object):
+    """Wraps a backend, and serves model definitions and permissions from an
+    in-process cache, invalidated when models are written.
+
+    Models permissions are also kept compiled as ``{principal: bitmask}``
+    (see :meth:`get_model_permissions_matrix`), for the authorization
+    policy.
+
+    Credentials keys are cached separately, during ``credentials_ttl``
+    seconds. Unknown credentials are remembered for
+    ``credentials_negative_ttl`` seconds, and forgotten as soon as they are
+    stored.
+
+    If an ``invalidation`` Redis client is given, invalidations are also
+    broadcasted to the other processes through a pub/sub ``channel``
+    (and ``<channel>.credentials`` for credentials). If the subscription
+    is lost, it is made again after ``reconnect_delay`` seconds (doubled
+    on each failure, up to ``reconnect_max_delay``), and the whole cache is
+    cleared since invalidations may have been missed meanwhile.
+    """
+    reconnect_delay = 1
+    reconnect_max_delay = 30
+
+    @classmethod
+    def load_from_config(cls, config):
+        settings = config.registry.settings
+        backend_class = config.maybe_dotted(settings['cache.backend'])
+
+        invalidation = None
+        if settings.get('cache.invalidation_host'):
+            invalidation = redis.StrictRedis(
+                host=settings['cache.invalidation_host'],
+                port=int(settings.get('cache.invalidation_port', 6379))
+            )
+        return CachedBackend(
+            backend_class.load_from_config(config),
+            size=int(settings.get('cache.size', 1000)),
+            ttl=float(settings.get('cache.ttl', 60)),
+            invalidation=invalidation,
+            channel=settings.get('cache.invalidation_channel',
+                                 'daybed.models'),
+            credentials_size=int(settings.get('cache.credentials_size',
+                                              10000)),
+            credentials_ttl=float(settings.get('cache.credentials_ttl', 60)),
+            credentials_negative_ttl=float(
+                settings.get('cache.credentials_negative_ttl', 5))
+        )
+
+    def __init__(self, backend, size=1000, ttl=60, invalidation=None,
+                 channel='daybed.models', credentials_size=10000,
+                 credentials_ttl=60, credentials_negative_ttl=5):
+        self._backend = backend
+        self._cache = TTLCache(size, ttl)
+        self._credentials = TTLCache(credentials_size, credentials_ttl)
+        self._credentials_negative_ttl = credentials_negative_ttl
+        self._invalidation = invalidation
+        self._channel = channel
+        self._credentials_channel = channel + '.credentials'
+
+        if invalidation is not None:
+            self._listener = threading.Thread(target=self._listen,
+                                              args=(self._subscribe(),))
+            self._listener.daemon = True
+            self._listener.start()
+
+    def __getattr__(self, name):
+        # Everything that is not cached is served by the wrapped backend.
+        return getattr(self._backend, name)
+
+    def _subscribe(self):
+        pubsub = self._invalidation.pubsub()
+        pubsub.subscribe(self._channel, self._credentials_channel)
+        return pubsub
+
+    def _listen(self, pubsub):
+        delay = self.reconnect_delay
+        while True:
+            try:
+                if pubsub is None:
+                    pubsub = self._subscribe()
+                    # Invalidations may have been missed while disconnected.
+                    self._cache.clear()
+                    self._credentials.clear()
+                    logger.info("Subscribed again to cache invalidations.")
+                    delay = self.reconnect_delay
+                for message in pubsub.listen():
+                    self._receive(message)
+                raise redis.ConnectionError("Subscription ended.")
+            except Exception:
+                logger.exception("Cache invalidations listener failed, "
+                                 "subscribing again in %ss." % delay)
+                if pubsub is not None:
+                    try:
+                        pubsub.close()
+                    except Exception:
+                        pass
+                pubsub = None
+                time.sleep(delay)
+                delay = min(delay * 2, self.reconnect_max_delay)
+
+    def _receive(self, message):
+        if message['type'] == 'message':
+            channel, data = message['channel'], message['data']
+            if isinstance(channel, bytes):
+                channel = channel.decode('utf-8')
+            if isinstance(data, bytes):
+                data = data.decode('utf-8')
+            if channel == self._credentials_channel:
+                self._credentials.delete(data)
+            else:
+                self._forget(data)
+
+    def _forget(self, model_id):
+        self._cache.delete(('definition', model_id))
+        self._cache.delete(('permissions', model_id))
+        self._cache.delete(('matrix', model_id))
+
+    def _invalidate(self, model_id):
+        self._forget(model_id)
+        if self._invalidation is not None:
+            self._invalidation.publish(self._channel, model_id)
+
+    def __get_cached(self, kind, model_id, getter):
+        key = (kind, model_id)
+        try:
+            value = self._cache.get(key)
+        except KeyError:
+            # Not stored if invalidated while being read.
+            generation = self._cache.stamp()
+            value = getter(model_id)
+            self._cache.set(key, value, generation=generation)
+        # Callers are free to alter what they get.
+        return deepcopy(value)
+
+    def get_model_definition(self, model_id):
+        return self.__get_cached('definition', model_id,
+                                 self._backend.get_model_definition)
+
+    def get_model_permissions(self, model_id):
+        return self.__get_cached('permissions', model_id,
+                                 self._backend.get_model_permissions)
+
+    def get_model_permissions_matrix(self, model_id):
+        """Returns the model permissions as ``{principal: bitmask}``.
+
+        It is shared between callers, and must not be altered.
+        """
+        key = ('matrix', model_id)
+        try:
+            return self._cache.get(key)
+        except KeyError:
+            generation = self._cache.stamp()
+            matrix = permissions_matrix(self.get_model_permissions(model_id))
+            self._cache.set(key, matrix, generation=generation)
+            return matrix
+
+    def put_model(self, definition, permissions, model_id=None):
+        model_id = self._backend.put_model(definition, permissions, model_id)
+        self._invalidate(model_id)
+        # Permissions are compiled once, when they are written.
+        self._cache.set(('matrix', model_id), permissions_matrix(permissions))
+        return model_id
+
+    def delete_model(self, model_id):
+        try:
+            return self._backend.delete_model(model_id)
+        finally:
+            self._invalidate(model_id)
+
+    def get_credentials_key(self, credentials_id):
+        try:
+            key = self._credentials.get(credentials_id)
+        except KeyError:
+            generation = self._credentials.stamp()
+            try:
+                key = self._backend.get_credentials_key(credentials_id)
+            except CredentialsNotFound:
+                key = None
+                self._credentials.set(credentials_id, None,
+                                      ttl=self._credentials_negative_ttl,
+                                      generation=generation)
+            else:
+                self._credentials.set(credentials_id, key,
+                                      generation=generation)
+        if key is None:
+            raise CredentialsNotFound(credentials_id)
+        return key
+
+    def store_credentials(self, token, credentials):
+        self._backend.store_credentials(token, credentials)
+        # Forget that they were unknown.
+        self._credentials.delete(credentials['id'])
+        if self._invalidation is not None:
+            self._invalidation.publish(self._credentials_channel,
+                                       credentials['id'])
+
+    def delete_db(self):
+        self._backend.delete_db()
+        self._cache.clear()
+        self._credentials.clear()
+
+
+class RequestBackend(object):
+    """Wraps the backend for the duration of a request, so that a model or a
+    record is read only once, whatever the number of components asking
+    for it.
+    """
+    _model_reads = ('get_model_definition', 'get_model_permissions')
+    _record_reads = ('get_record', 'get_record_authors', 'get_record_version',
+                     'get_record_with_version')
+
+    def __init__(self, backend):
+        self._backend = backend
+        self._reads = {}
+
+    def __getattr__(self, name):
+        return getattr(self._backend, name)
+
+    def __read(self, name, *args):
+        key = (name,) + args
+        try:
+            value, error = self._reads[key]
+        except KeyError:
+            value, error = None, None
+            try:
+                value = getattr(self._backend, name)(*args)
+            except (ModelNotFound, RecordNotFound, CredentialsNotFound) as e:
+                error = e
+            self._reads[key] = (value, error)
+        if error is not None:
+            raise error
+        return deepcopy(value)
+
+    def _forget(self, model_id, record_id=None):
+        for key in list(self._reads):
+            if key[1] != model_id:
+                continue
+            if record_id is None or key[2:] == (record_id,):
+                del self._reads[key]
+
+    def get_model_definition(self, model_id):
+        return self.__read('get_model_definition', model_id)
+
+    def get_model_permissions(self, model_id):
+        return self.__read('get_model_permissions', model_id)
+
+    def get_model_permissions_matrix(self, model_id):
+        """Returns the model permissions as ``{principal: bitmask}``, from
+        the backend if it keeps them compiled, otherwise compiled once for
+        the request.
+
+        It must not be altered.
+        """
+        key = ('get_model_permissions_matrix', model_id)
+        if key not in self._reads:
+            try:
+                get_matrix = self._backend.get_model_permissions_matrix
+            except AttributeError:
+                matrix = permissions_matrix(
+                    self.get_model_permissions(model_id))
+            else:
+                matrix = get_matrix(model_id)
+            self._reads[key] = (matrix, None)
+        return self._reads[key][0]
+
+    def get_record(self, model_id, record_id):
+        return self.__read('get_record', model_id, record_id)
+
+    def get_record_authors(self, model_id, record_id):
+        return self.__read('get_record_authors', model_id, record_id)
+
+    def get_record_version(self, model_id, record_id):
+        return self.__read('get_record_version', model_id, record_id)
+
+    def get_record_with_version(self, model_id, record_id):
+        return self.__read('get_record_with_version', model_id, record_id)
+
+    def get_credentials_key(self, credentials_id):
+        # Read by the authentication policy, then to identify the request.
+        return self.__read('get_credentials_key', credentials_id)
+
+    def store_credentials(self, token, credentials):
+        self._backend.store_credentials(token, credentials)
+        self._reads.pop(('get_credentials_key', credentials['id']), None)
+
+    def put_model(self, definition, permissions, model_id=None):
+        model_id = self._backend.put_model(definition, permissions, model_id)
+        self._forget(model_id)
+        return model_id
+
+    def delete_model(self, model_id):
+        try:
+            return self._backend.delete_model(model_id)
+        finally:
+            self._forget(model_id)
+
+    def put_record(self, model_id, record, authors, record_id=None,
+                   version=None):
+        try:
+            record_id, version = self._backend.put_record(
+                model_id, record, authors, record_id, version=version)
+        finally:
+            if record_id is not None:
+                self._forget(model_id, record_id)
+        return record_id, version
+
+    def delete_record(self, model_id, record_id, version=None):
+        try:
+            return self._backend.delete_record(model_id, record_id,
+                                               version=version)
+        finally:
+            self._forget(model_id, record_id)
+
+    def delete_records(self, model_id):
+        try:
+            return self._backend.delete_records(model_id)
+        finally:
+            self._forget(model_id)
+
+    def delete_db(self):
+        self._backend.delete_db()
+        self._reads.clear()
@@ -2,18 +2,26 @@ import os
 import socket
 
 import functools
+import six
+
+from pyramid.settings import asbool
 
 from couchdb.client import Server
-from couchdb.http import PreconditionFailed, Unauthorized
+from couchdb.http import PreconditionFailed, ResourceConflict, Unauthorized
 from couchdb.design import ViewDefinition
 
 from daybed import logger
 from .views import docs
 
 from . import views
+from .session import PooledSession
 from daybed.backends import exceptions as backend_exceptions
 
 
+def float_or_none(value):
+    return float(value) if value else None
+
+
 class CouchDBBackendConnectionError(Exception):
     pass
 
@@ -28,12 +36,29 @@ class CouchDBBackend(object):
         return CouchDBBackend(
             host=settings['backend.db_host'],
             db_name=os.environ.get('DB_NAME', settings['backend.db_name']),
-            id_generator=generator(config)
+            id_generator=generator(config),
+            batch_size=int(settings.get('backend.batch_size', 1000)),
+            return_deleted_records=asbool(
+                settings.get('backend.return_deleted_records', True)),
+            session=PooledSession(
+                pool_size=int(settings.get('backend.pool_size', 10)),
+                timeout=float_or_none(settings.get('backend.timeout')),
+                pool_timeout=float_or_none(
+                    settings.get('backend.pool_timeout')),
+                metrics_interval=float_or_none(
+                    settings.get('backend.metrics_interval'))
+            )
         )
 
-    def __init__(self, host, db_name, id_generator):
-        self.server = Server(host)
+    def __init__(self, host, db_name, id_generator, batch_size=1000,
+                 return_deleted_records=True, session=None):
+        if session is None:
+            session = PooledSession()
+        self.session = session
+        self.server = Server(host, session=session)
         self.db_name = db_name
+        self._batch_size = batch_size
+        self._return_deleted_records = return_deleted_records
 
         try:
             self.create_db_if_not_exist()
@@ -56,27 +81,31 @@ class CouchDBBackend(object):
             logger.info('Using db "%s".' % self.db_name)
 
     def sync_views(self):
-        ViewDefinition.sync_many(self.server[self.db_name], docs)
+        db = self.server[self.db_name]
+        ViewDefinition.sync_many(db, docs)
+        for design_id in views.obsolete:
+            if design_id in db:
+                del db[design_id]
 
     def get_models(self, principals):
         principals = list(set(principals))
         models = {}
+        # A model shows up once per matching principal.
         for result in views.models(self._db, keys=principals).rows:
-            doc = result.value
-            _id = doc["_id"]
+            summary = result.value
+            _id = result.id
             models[_id] = {
                 "id": _id,
-                "title": doc["definition"].get("title", _id),
-                "description": doc["definition"].get("description", "")
+                "title": summary.get("title", _id),
+                "description": summary.get("description", "")
             }
         return list(models.values())
 
     def __get_raw_model(self, model_id):
-        try:
-            doc = views.model_definitions(self._db, key=model_id).rows[0]
-            return doc.value
-        except IndexError:
+        doc = self._db.get(model_id)
+        if doc is None or doc.get('type') != 'definition':
             raise backend_exceptions.ModelNotFound(model_id)
+        return doc
 
     def get_model_definition(self, model_id):
         return self.__get_raw_model(model_id)['definition']
@@ -84,7 +113,7 @@ class CouchDBBackend(object):
     def __get_raw_records(self, model_id):
         # Make sure the model exists.
         self.__get_raw_model(model_id)
-        return views.records(self._db, key=model_id).rows
+        return views.records(self._db, key=model_id, include_docs=True).rows
 
     def get_records(self, model_id, raw_records=None):
         return [r["record"] for r in
@@ -95,19 +124,57 @@ class CouchDBBackend(object):
             raw_records = self.__get_raw_records(model_id)
         records = []
         for item in raw_records:
-            item.value['record']['id'] = item.value['_id'].split('-')[1]
-            records.append({"authors": item.value['authors'],
-                            "record": item.value['record']})
+            item.doc['record']['id'] = item.doc['_id'].split('-')[1]
+            records.append({"authors": item.doc['authors'],
+                            "record": item.doc['record']})
         return records
 
+    def get_paginated_records(self, model_id, limit, cursor=None):
+        """Returns up to ``limit`` records (with their authors) following the
+        ``cursor`` position, and the cursor of the next page (``None`` if
+        this is the last one).
+        """
+        if cursor is not None and not isinstance(cursor, six.string_types):
+            raise ValueError(cursor)
+        # Make sure the model exists.
+        self.__get_raw_model(model_id)
+
+        # Fetch one more row, to know where the next page starts.
+        options = dict(startkey=model_id, endkey=model_id, limit=limit + 1,
+                       include_docs=True)
+        if cursor is not None:
+            options['startkey_docid'] = cursor
+        rows = views.records(self._db, **options).rows
+
+        next_cursor = None
+        if len(rows) > limit:
+            next_cursor = rows[limit].id
+            rows = rows[:limit]
+        return self.get_records_with_authors(model_id, rows), next_cursor
+
+    def get_records_by_authors(self, model_id, authors):
+        """Returns the records of the model written by one of the
+        ``authors``, looked up in the authors view.
+        """
+        # Make sure the model exists.
+        self.__get_raw_model(model_id)
+
+        keys = [[model_id, author] for author in set(authors)]
+        if not keys:
+            return []
+        # A record shows up once per matching author.
+        rows = dict((row.id, row) for row in
+                    views.records_by_author(self._db, keys=keys,
+                                            include_docs=True).rows)
+        return self.get_records(model_id, raw_records=rows.values())
+
     def __get_raw_record(self, model_id, record_id):
-        key = u'-'.join((model_id, record_id))
-        try:
-            return views.records_all(self._db, key=key).rows[0].value
-        except IndexError:
+        doc = self._db.get(u'-'.join((model_id, record_id)))
+        if doc is None or doc.get('type') != 'record':
             raise backend_exceptions.RecordNotFound(
                 u'(%s, %s)' % (model_id, record_id)
             )
+        return doc
 
     def _model_exists(self, model_id):
         try:
@@ -133,6 +200,16 @@ class CouchDBBackend(object):
         doc = self.__get_raw_record(model_id, record_id)
         return doc['authors']
 
+    def get_record_version(self, model_id, record_id):
+        doc = self.__get_raw_record(model_id, record_id)
+        return doc['_rev']
+
+    def get_record_with_version(self, model_id, record_id):
+        doc = self.__get_raw_record(model_id, record_id)
+        record = doc['record']
+        record['id'] = record_id
+        return record, doc['_rev']
+
     def put_model(self, definition, permissions, model_id=None):
         if model_id is None:
             model_id = self._generate_id(key_exist=self._model_exists)
@@ -148,7 +225,8 @@ class CouchDBBackend(object):
         definition_id, _ = self._db.save(doc)
         return definition_id
 
-    def put_record(self, model_id, record, authors, record_id=None):
+    def put_record(self, model_id, record, authors, record_id=None,
+                   version=None):
         doc = {
             'type': 'record',
             'authors': authors,
@@ -159,31 +237,111 @@ class CouchDBBackend(object):
             try:
                 old_doc = self.__get_raw_record(model_id, record_id)
             except backend_exceptions.RecordNotFound:
+                if version is not None:
+                    raise backend_exceptions.VersionMismatch(record_id)
                 doc['_id'] = '-'.join((model_id, record_id))
             else:
                 authors = list(set(authors) | set(old_doc['authors']))
                 doc['authors'] = authors
                 old_doc.update(doc)
                 doc = old_doc
+                if version is not None:
+                    # CouchDB refuses the update if the revision changed.
+                    doc['_rev'] = version
         else:
             key_exist = functools.partial(self._record_exists, model_id)
             record_id = self._generate_id(key_exist=key_exist)
             doc['_id'] = '-'.join((model_id, record_id))
 
-        self._db.save(doc)
-        return record_id
+        try:
+            _, revision = self._db.save(doc)
+        except ResourceConflict:
+            if version is None:
+                raise
+            raise backend_exceptions.VersionMismatch(record_id)
+        return record_id, revision
+
+    def put_records(self, model_id, records, authors):
+        """Creates all the ``records`` with a single ``_bulk_docs`` request,
+        and returns their ids.
+        """
+        # Make sure the model exists.
+        self.__get_raw_model(model_id)
 
-    def delete_record(self, model_id, record_id):
+        records_ids = []
+        docs = []
+        for record in records:
+            record_id = self._generate_id()
+            records_ids.append(record_id)
+            docs.append({'_id': '-'.join((model_id, record_id)),
+                         'type': 'record',
+                         'authors': list(authors),
+                         'model_id': model_id,
+                         'record': record})
+
+        # Records whose generated id was already taken get another one.
+        results = self._db.update(docs)
+        for i, (success, _, _) in enumerate(results):
+            if not success:
+                records_ids[i], _ = self.put_record(model_id, records[i],
+                                                 authors)
+        return records_ids
+
+    def delete_record(self, model_id, record_id, version=None):
         doc = self.__get_raw_record(model_id, record_id)
         if doc:
-            self._db.delete(doc)
+            if version is not None:
+                # CouchDB refuses the deletion if the revision changed.
+                doc['_rev'] = version
+            try:
+                self._db.delete(doc)
+            except ResourceConflict:
+                if version is None:
+                    raise
+                raise backend_exceptions.VersionMismatch(record_id)
         return doc
 
     def delete_records(self, model_id):
-        results = self.__get_raw_records(model_id)
-        for result in results:
-            self._db.delete(result.value)
-        return self.get_records(model_id, raw_records=results)
+        """Deletes the records by ``_bulk_docs`` requests of ``batch_size``
+        records, and returns them.
+
+        If ``return_deleted_records`` is false, only their ids are returned,
+        and the records are not read.
+        """
+        # Make sure the model exists.
+        self.__get_raw_model(model_id)
+
+        records = []
+        options = dict(startkey=model_id, endkey=model_id,
+                       limit=self._batch_size,
+                       include_docs=self._return_deleted_records)
+        while True:
+            rows = views.records(self._db, **options).rows
+            # The last record of the previous batch is still there if it
+            # could not be deleted.
+            rows = [row for row in rows
+                    if row.id != options.get('startkey_docid')]
+            if not rows:
+                return records
+            options['startkey_docid'] = rows[-1].id
+
+            if self._return_deleted_records:
+                revisions = dict((row.id, row.doc['_rev']) for row in rows)
+            else:
+                revisions = dict(
+                    (row.id, row.value['rev']) for row in
+                    self._db.view('_all_docs', keys=[r.id for r in rows]))
+            results = self._db.update([
+                {'_id': row.id, '_rev': revisions[row.id], '_deleted': True}
+                for row in rows])
+
+            deleted = [row for row, (success, _, _) in zip(rows, results)
+                       if success]
+            if self._return_deleted_records:
+                records.extend(self.get_records(model_id, deleted))
+            else:
+                records.extend({'id': row.id.split('-')[1]}
+                               for row in deleted)
 
     def delete_model(self, model_id):
         """DELETE ALL THE THINGS"""
@@ -191,10 +349,7 @@ class CouchDBBackend(object):
         # Delete the associated data if any.
         records = self.delete_records(model_id)
 
-        try:
-            doc = views.model_definitions(self._db, key=model_id).rows[0].value
-        except IndexError:
-            raise backend_exceptions.ModelNotFound(model_id)
+        doc = self.__get_raw_model(model_id)
 
         # Delete the model definition if it exists.
         self._db.delete(doc)
@@ -204,7 +359,9 @@ class CouchDBBackend(object):
 
     def __get_raw_token(self, credentials_id):
         try:
-            return views.tokens(self._db, key=credentials_id).rows[0].value
+            rows = views.tokens(self._db, key=credentials_id,
+                                include_docs=True).rows
+            return rows[0].doc
         except IndexError:
             raise backend_exceptions.CredentialsNotFound(credentials_id)
 
@@ -0,0 +1,160 @@
+import threading
+import time
+
+from couchdb.http import ConnectionPool, Session
+
+from daybed import logger
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection got available in time."""
+
+
+class BoundedConnectionPool(ConnectionPool):
+    """Keeps at most ``size`` idle keep-alive connections per host, and
+    closes the others when they are released.
+    """
+    def __init__(self, timeout, size):
+        super(BoundedConnectionPool, self).__init__(timeout)
+        self.size = size
+
+    def release(self, url, conn):
+        with self.lock:
+            idle = sum(len(conns) for conns in self.conns.values())
+        if idle < self.size:
+            super(BoundedConnectionPool, self).release(url, conn)
+        else:
+            conn.close()
+
+
+class RequestsMetrics(object):
+    """Counts CouchDB requests, and the time spent waiting for a connection
+    and waiting for the responses, per HTTP method.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._methods = {}
+            self.busy = 0
+            self.max_busy = 0
+
+    def start(self):
+        with self._lock:
+            self.busy += 1
+            self.max_busy = max(self.max_busy, self.busy)
+
+    def record(self, method, waited, duration, failed=False):
+        with self._lock:
+            self.busy -= 1
+            stats = self._methods.setdefault(method, {
+                'count': 0, 'errors': 0, 'wait_time': 0.0,
+                'total_time': 0.0, 'max_time': 0.0})
+            stats['count'] += 1
+            stats['errors'] += int(failed)
+            stats['wait_time'] += waited
+            stats['total_time'] += duration
+            stats['max_time'] = max(stats['max_time'], duration)
+
+    def stats(self):
+        with self._lock:
+            return {'busy': self.busy,
+                    'max_busy': self.max_busy,
+                    'methods': dict((method, dict(stats)) for method, stats
+                                    in self._methods.items())}
+
+    def report(self):
+        """Logs the stats gathered since the last report, and resets them.
+        """
+        with self._lock:
+            methods, self._methods = self._methods, {}
+            max_busy, self.max_busy = self.max_busy, self.busy
+        details = []
+        for method, stats in sorted(methods.items()):
+            details.append(
+                "%s %d (%d failed) in %.1fms avg, %.1fms max, "
+                "waited %.1fms avg" % (
+                    method, stats['count'], stats['errors'],
+                    stats['total_time'] * 1000 / stats['count'],
+                    stats['max_time'] * 1000,
+                    stats['wait_time'] * 1000 / stats['count']))
+        logger.info("CouchDB requests: %s; %d at once at most",
+                    ", ".join(details) or "none", max_busy)
+
+
+class PooledSession(Session):
+    """A CouchDB HTTP session, running at most ``pool_size`` requests at
+    once over keep-alive connections.
+
+    Requests wait up to ``pool_timeout`` seconds for a connection, and
+    ``timeout`` is the sockets timeout. Every request is measured in
+    ``metrics``, which are logged every ``metrics_interval`` seconds if
+    given.
+    """
+    def __init__(self, pool_size=10, timeout=None, pool_timeout=None,
+                 metrics=None, metrics_interval=None, **kwargs):
+        super(PooledSession, self).__init__(timeout=timeout, **kwargs)
+        self.connection_pool = BoundedConnectionPool(timeout, pool_size)
+        self.pool_size = pool_size
+        self.pool_timeout = pool_timeout
+        self.metrics = metrics or RequestsMetrics()
+        self._active = 0
+        self._available = threading.Condition()
+        # Redirections are followed in the same slot.
+        self._local = threading.local()
+        self.metrics_interval = metrics_interval
+        if metrics_interval:
+            thread = threading.Thread(target=self.__report_metrics)
+            thread.daemon = True
+            thread.start()
+
+    def __report_metrics(self):
+        while True:
+            time.sleep(self.metrics_interval)
+            self.metrics.report()
+
+    def __acquire(self):
+        deadline = None
+        if self.pool_timeout is not None:
+            deadline = time.time() + self.pool_timeout
+        with self._available:
+            while self._active >= self.pool_size:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise PoolTimeout("No CouchDB connection available "
+                                          "after %ss" % self.pool_timeout)
+                self._available.wait(remaining)
+            self._active += 1
+
+    def __release(self):
+        with self._available:
+            self._active -= 1
+            self._available.notify()
+
+    def request(self, method, url, *args, **kwargs):
+        if getattr(self._local, 'in_request', False):
+            return super(PooledSession, self).request(method, url,
+                                                      *args, **kwargs)
+        start = time.time()
+        self.__acquire()
+        waited = time.time() - start
+        self.metrics.start()
+        self._local.in_request = True
+        failed = True
+        try:
+            result = super(PooledSession, self).request(method, url,
+                                                        *args, **kwargs)
+            failed = False
+            return result
+        finally:
+            self._local.in_request = False
+            self.__release()
+            duration = time.time() - start - waited
+            self.metrics.record(method, waited, duration, failed)
+            logger.debug("CouchDB %s %s in %.1fms (waited %.1fms)%s",
+                         method, url, duration * 1000, waited * 1000,
+                         " failed" if failed else "")
@@ -1,41 +1,39 @@
 from couchdb.design import ViewDefinition
 
 # Definition of CouchDB design documents, a.k.a. permanent views.
+#
+# Views only emit keys, and the few values needed to answer without reading
+# the documents. Documents are fetched with ``include_docs`` when needed,
+# and directly by ``_id`` otherwise.
 
-""" Models id."""
+""" Models titles and descriptions, by principal allowed to read them."""
 models = ViewDefinition('models', 'by_principals', """
 function(doc) {
   if (doc.type == "definition") {
+    var summary = {title: doc.definition.title,
+                   description: doc.definition.description};
     for (var i = 0; i < doc.permissions.read_definition.length; i++) {
-      var principal = doc.permissions.read_definition[i];
-      emit(principal, doc);
+      emit(doc.permissions.read_definition[i], summary);
     }
   }
 }""")
 
 
-""" Model definitions, by model id."""
-model_definitions = ViewDefinition('definitions', 'all', """
-function(doc) {
-  if (doc.type == "definition") {
-    emit(doc._id, doc);
-  }
-}""")
-
-
 """ Model records, by model name."""
 records = ViewDefinition('records', 'by_model', """
 function(doc) {
   if (doc.type == "record") {
-    emit(doc.model_id, doc);
+    emit(doc.model_id, null);
   }
 }""")
 
-""" Record, by id."""
-records_all = ViewDefinition('records_all', 'all', """
+""" Model records, by model name and author."""
+records_by_author = ViewDefinition('records', 'by_author', """
 function(doc) {
   if (doc.type == "record") {
-    emit(doc._id, doc);
+    for (var i = 0; i < doc.authors.length; i++) {
+      emit([doc.model_id, doc.authors[i]], null);
+    }
   }
 }""")
 
@@ -43,11 +41,13 @@ function(doc) {
 tokens = ViewDefinition('tokens', 'by_name', """
 function(doc){
   if(doc.type == 'token'){
-      emit(doc.credentials.id, doc);
+      emit(doc.credentials.id, null);
   }
 }
 """)
 
+""" Design documents of views that were replaced by ``_id`` lookups."""
+obsolete = ['_design/definitions', '_design/records_all']
 
 l = locals().values()
 docs = [v for v in l if isinstance(v, ViewDefinition)]
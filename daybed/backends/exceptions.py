@@ -12,3 +12,7 @@ class ModelNotFound(Exception):
 
 class RecordNotFound(Exception):
     pass
+
+
+class VersionMismatch(Exception):
+    pass
@@ -1,30 +1,117 @@
+from bisect import bisect_left, bisect_right, insort
 from copy import deepcopy
 import functools
+import threading
 
+import six
+
+from daybed import logger
 from daybed.backends import exceptions as backend_exceptions
+from daybed.backends.memory.journal import Journal
+
+
+def _read_only(self, *args, **kwargs):
+    raise TypeError("Stored documents are read-only.")
+
+
+class FrozenDict(dict):
+    """A dict that cannot be altered. Copies are regular dicts."""
+    __setitem__ = __delitem__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return dict((k, deepcopy(v, memo)) for k, v in self.items())
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self),))
+
+
+class FrozenList(list):
+    """A list that cannot be altered. Copies are regular lists."""
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _read_only
+    append = extend = insert = pop = remove = reverse = sort = _read_only
+
+    def __copy__(self):
+        return list(self)
+
+    def __deepcopy__(self, memo):
+        return [deepcopy(v, memo) for v in self]
+
+    def __reduce__(self):
+        return (self.__class__, (list(self),))
+
+
+def freeze(value):
+    """Returns a read-only deep copy of ``value``."""
+    if isinstance(value, dict):
+        return FrozenDict((k, freeze(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return FrozenList(freeze(v) for v in value)
+    return value
 
 
 class MemoryBackend(object):
+    """Stores documents in memory.
+
+    Stored documents are frozen when written, and never altered afterwards
+    (copy-on-write), hence they can be shared with readers. Readers get a
+    shallow copy, whose nested values are read-only.
+
+    Writes are serialized by a lock per model, and collections are read
+    from snapshots taken under that lock. Hence concurrent requests on
+    different models never wait for each other. The records ids of each
+    model are kept sorted, to serve pages without sorting them.
+
+    If a :class:`~daybed.backends.memory.journal.Journal` is given, every
+    mutation is logged to disk, and the state is restored from it at
+    startup.
+    """
 
     @classmethod
     def load_from_config(cls, config):
         settings = config.registry.settings
         generator = config.maybe_dotted(settings['daybed.id_generator'])
-        return MemoryBackend(generator(config))
 
-    def __init__(self, id_generator):
+        journal = None
+        if settings.get('backend.journal'):
+            journal = Journal(
+                settings['backend.journal'],
+                fsync=settings.get('backend.journal_fsync', 'every_second'),
+                snapshot_every=int(settings.get('backend.snapshot_every',
+                                                10000))
+            )
+        return MemoryBackend(generator(config), journal=journal)
+
+    def __init__(self, id_generator, journal=None):
         # model id generator
         self._generate_id = id_generator
+        # Protects the top-level collections, and the models locks.
+        self._lock = threading.RLock()
         self._init_db()
 
+        self._journal = journal
+        if journal is not None:
+            self._replay()
+            journal.open(self._dump)
+
     def delete_db(self):
-        self._db.clear()
-        self._init_db()
+        with self._lock:
+            self._write('delete_db')
+
+    def _model_lock(self, model_id):
+        with self._lock:
+            return self._models_locks.setdefault(model_id, threading.RLock())
 
     def _init_db(self):
+        self._models_locks = {}
         self._db = {
             'models': {},
             'records': {},
+            'authors': {},
+            'ids': {},
             'permissions': {},
             'tokens': {},
             'credentials_keys': {}
@@ -32,7 +119,8 @@ class MemoryBackend(object):
 
     def get_models(self, principals):
         principals = set(principals)
-        models = self._db['models'].items()
+        with self._lock:
+            models = list(self._db['models'].items())
         return [{"id": id,
                  "title": m["definition"].get("title", id),
                  "description": m["definition"].get("description", "")}
@@ -42,16 +130,16 @@ class MemoryBackend(object):
 
     def __get_raw_model(self, model_id):
         try:
-            return deepcopy(self._db['models'][model_id])
+            return self._db['models'][model_id]
         except KeyError:
             raise backend_exceptions.ModelNotFound(model_id)
 
     def get_model_definition(self, model_id):
-        return self.__get_raw_model(model_id)['definition']
+        return dict(self.__get_raw_model(model_id)['definition'])
 
     def __get_raw_records(self, model_id):
         try:
-            return self._db['records'][model_id].values()
+            return self._db['records'][model_id]
         except KeyError:
             raise backend_exceptions.ModelNotFound(model_id)
 
@@ -61,17 +149,55 @@ class MemoryBackend(object):
 
     def get_records_with_authors(self, model_id, raw_records=None):
         if raw_records is None:
-            raw_records = self.__get_raw_records(model_id)
+            model_records = self.__get_raw_records(model_id)
+            with self._model_lock(model_id):
+                raw_records = list(model_records.values())
         records = []
         for item in raw_records:
-            item['record']['id'] = item['_id']
-            records.append({"authors": deepcopy(item['authors']),
-                            "record": deepcopy(item['record'])})
+            records.append({"authors": list(item['authors']),
+                            "record": dict(item['record'])})
         return records
 
+    def get_paginated_records(self, model_id, limit, cursor=None):
+        """Returns up to ``limit`` records (with their authors) following the
+        ``cursor`` position, and the cursor of the next page (``None`` if
+        this is the last one).
+        """
+        if cursor is not None and not isinstance(cursor, six.string_types):
+            raise ValueError(cursor)
+        model_records = self.__get_raw_records(model_id)
+        with self._model_lock(model_id):
+            records_ids = self._db['ids'].get(model_id, [])
+            start = 0
+            if cursor is not None:
+                start = bisect_right(records_ids, cursor)
+            page_ids = records_ids[start:start + limit]
+            raw_records = [model_records[i] for i in page_ids]
+            last_page = start + limit >= len(records_ids)
+
+        next_cursor = None
+        if not last_page:
+            next_cursor = page_ids[-1]
+
+        records = self.get_records_with_authors(model_id, raw_records)
+        return records, next_cursor
+
+    def get_records_by_authors(self, model_id, authors):
+        """Returns the records of the model written by one of the
+        ``authors``, looked up in the authors index.
+        """
+        model_records = self.__get_raw_records(model_id)
+        with self._model_lock(model_id):
+            authors_index = self._db['authors'].get(model_id, {})
+            records_ids = set()
+            for author in authors:
+                records_ids |= authors_index.get(author, set())
+            raw_records = [model_records[i] for i in records_ids]
+        return self.get_records(model_id, raw_records)
+
     def __get_raw_record(self, model_id, record_id):
         try:
-            return deepcopy(self._db['records'][model_id][record_id])
+            return self._db['records'][model_id][record_id]
         except KeyError:
             raise backend_exceptions.RecordNotFound(
                 u'(%s, %s)' % (model_id, record_id)
@@ -79,24 +205,30 @@ class MemoryBackend(object):
 
     def get_record(self, model_id, record_id):
         doc = self.__get_raw_record(model_id, record_id)
-        record = doc['record']
-        record['id'] = record_id
-        return record
+        return dict(doc['record'])
 
     def get_record_authors(self, model_id, record_id):
         doc = self.__get_raw_record(model_id, record_id)
-        return doc['authors']
+        return list(doc['authors'])
+
+    def get_record_version(self, model_id, record_id):
+        doc = self.__get_raw_record(model_id, record_id)
+        return str(doc.get('version', 0))
+
+    def get_record_with_version(self, model_id, record_id):
+        doc = self.__get_raw_record(model_id, record_id)
+        return dict(doc['record']), str(doc.get('version', 0))
 
     def put_model(self, definition, permissions, model_id=None):
         if model_id is None:
             model_id = self._generate_id(key_exist=self._model_exists)
 
-        self._db['models'][model_id] = {
-            'definition': deepcopy(definition),
+        model = freeze({
+            'definition': definition,
             'permissions': permissions
-        }
-        if model_id not in self._db['records']:
-            self._db['records'][model_id] = {}
+        })
+        with self._lock:
+            self._write('model', model_id, model)
         return model_id
 
     def _record_exists(self, model_id, record_id):
@@ -105,46 +237,89 @@ class MemoryBackend(object):
     def _model_exists(self, model_id):
         return model_id in self._db['records']
 
-    def put_record(self, model_id, record, authors, record_id=None):
-        doc = {
-            'authors': authors,
-            'record': record
-        }
+    def put_record(self, model_id, record, authors, record_id=None,
+                   version=None):
+        with self._model_lock(model_id):
+            return self.__put_record(model_id, record, authors, record_id,
+                                     version)
+
+    def __put_record(self, model_id, record, authors, record_id, version):
+        # Check if the model still exists or raise
+        self.__get_raw_records(model_id)
 
+        old_doc = None
         if record_id is not None:
             try:
                 old_doc = self.__get_raw_record(model_id, record_id)
             except backend_exceptions.RecordNotFound:
-                doc['_id'] = record_id
+                pass
             else:
-                old_doc["record"].update(doc["record"])
-                doc = old_doc
-                doc['authors'] = list(set(authors) | set(old_doc['authors']))
+                merged = dict(old_doc['record'])
+                merged.update(record)
+                record = merged
+                authors = list(set(authors) | set(old_doc['authors']))
         else:
             key_exist = functools.partial(self._record_exists, model_id)
             record_id = self._generate_id(key_exist=key_exist)
-            doc['_id'] = record_id
 
-        self._db['records'][model_id][record_id] = doc
-        return record_id
+        current = old_doc.get('version', 0) if old_doc else 0
+        if version is not None and (not old_doc or str(current) != version):
+            raise backend_exceptions.VersionMismatch(record_id)
 
-    def delete_record(self, model_id, record_id):
-        doc = self.__get_raw_record(model_id, record_id)
-        if doc:
-            del self._db['records'][model_id][record_id]
+        doc = freeze({'_id': record_id,
+                      'authors': authors,
+                      'version': current + 1,
+                      'record': dict(record, id=record_id)})
+        self._write('records', model_id, [doc])
+        return record_id, str(doc['version'])
+
+    def put_records(self, model_id, records, authors):
+        """Creates all the ``records`` at once, and returns their ids."""
+        model_records = self.__get_raw_records(model_id)
+        with self._model_lock(model_id):
+            return self.__put_records(model_id, model_records, records,
+                                      authors)
+
+    def __put_records(self, model_id, model_records, records, authors):
+        docs = {}
+
+        def key_exist(record_id):
+            return record_id in model_records or record_id in docs
+
+        records_ids = []
+        for record in records:
+            record_id = self._generate_id(key_exist=key_exist)
+            docs[record_id] = freeze({'_id': record_id,
+                                      'authors': authors,
+                                      'version': 1,
+                                      'record': dict(record, id=record_id)})
+            records_ids.append(record_id)
+
+        self._write('records', model_id, [docs[i] for i in records_ids])
+        return records_ids
+
+    def delete_record(self, model_id, record_id, version=None):
+        with self._model_lock(model_id):
+            doc = self.__get_raw_record(model_id, record_id)
+            if version is not None and str(doc.get('version', 0)) != version:
+                raise backend_exceptions.VersionMismatch(record_id)
+            self._write('delete_record', model_id, record_id)
         return doc
 
     def delete_records(self, model_id):
-        results = self.get_records(model_id)
-        del self._db['records'][model_id]
+        with self._model_lock(model_id):
+            results = self.get_records(model_id)
+            with self._lock:
+                self._write('delete_records', model_id)
         return results
 
     def delete_model(self, model_id):
         records = self.delete_records(model_id)
-        doc = self._db['models'][model_id]
-        del self._db['models'][model_id]
-        return {"definition": doc["definition"],
-                "permissions": doc["permissions"],
+        with self._lock:
+            doc = self._db['models'][model_id]
+            self._write('delete_model', model_id)
+        return {"definition": dict(doc["definition"]),
+                "permissions": dict(doc["permissions"]),
                 "records": records}
 
     def get_token(self, credentials_id):
@@ -162,15 +337,107 @@ class MemoryBackend(object):
     def store_credentials(self, token, credentials):
         # Check that the token doesn't already exist.
         assert 'id' in credentials and 'key' in credentials
-        try:
-            self.get_token(credentials['id'])
-            raise backend_exceptions.CredentialsAlreadyExist(credentials['id'])
-        except backend_exceptions.CredentialsNotFound:
-            pass
+        with self._lock:
+            try:
+                self.get_token(credentials['id'])
+                raise backend_exceptions.CredentialsAlreadyExist(
+                    credentials['id'])
+            except backend_exceptions.CredentialsNotFound:
+                pass
+
+            self._write('credentials', credentials['id'], token,
+                        credentials['key'])
+
+    def _write(self, operation, *args):
+        """Applies the mutation, then logs it if a journal is used.
+
+        The caller holds the lock protecting the altered collections.
+        """
+        apply = functools.partial(getattr(self, '_apply_%s' % operation),
+                                  *args)
+        if self._journal is None:
+            apply()
+        else:
+            self._journal.write(apply, operation, *args)
+
+    def _apply_model(self, model_id, model):
+        self._db['models'][model_id] = model
+        if model_id not in self._db['records']:
+            self._db['records'][model_id] = {}
+            self._db['authors'][model_id] = {}
+            self._db['ids'][model_id] = []
+
+    def _apply_records(self, model_id, docs):
+        model_records = self._db['records'][model_id]
+        authors_index = self._db['authors'][model_id]
+        records_ids = self._db['ids'][model_id]
+        for doc in docs:
+            if doc['_id'] not in model_records:
+                insort(records_ids, doc['_id'])
+            model_records[doc['_id']] = doc
+            for author in doc['authors']:
+                authors_index.setdefault(author, set()).add(doc['_id'])
+
+    def _apply_delete_record(self, model_id, record_id):
+        doc = self._db['records'][model_id].pop(record_id, None)
+        if doc is not None:
+            records_ids = self._db['ids'][model_id]
+            del records_ids[bisect_left(records_ids, record_id)]
+            authors_index = self._db['authors'][model_id]
+            for author in doc['authors']:
+                authors_index.get(author, set()).discard(record_id)
+
+    def _apply_delete_records(self, model_id):
+        self._db['records'].pop(model_id, None)
+        self._db['authors'].pop(model_id, None)
+        self._db['ids'].pop(model_id, None)
+
+    def _apply_delete_model(self, model_id):
+        self._db['models'].pop(model_id, None)
+        self._models_locks.pop(model_id, None)
+
+    def _apply_credentials(self, credentials_id, token, key):
+        self._db['tokens'][credentials_id] = token
+        self._db['credentials_keys'][credentials_id] = key
+
+    def _apply_delete_db(self):
+        self._init_db()
+
+    def _replay(self):
+        for entry in self._journal.replay():
+            operation, args = entry[0], [freeze(arg) for arg in entry[1:]]
+            try:
+                getattr(self, '_apply_%s' % operation)(*args)
+            except KeyError as e:
+                # Written before the model was deleted (and after a
+                # snapshot of the deletion was taken).
+                logger.warning("Skipping '%s' entry of unknown model %s" %
+                               (operation, e))
+
+    def _dump(self):
+        """Captures the current state, and returns the entries that rebuild
+        it.
+
+        The journal calls it while no write is applied. Stored documents
+        are never altered, hence copying the collections is enough, and the
+        entries are generated afterwards without blocking writes.
+        """
+        models = list(self._db['models'].items())
+        records = dict((model_id, list(model_records.values()))
+                       for model_id, model_records
+                       in self._db['records'].items())
+        credentials = [(i, token, self._db['credentials_keys'][i])
+                       for i, token in self._db['tokens'].items()]
 
-        self._db['tokens'][credentials['id']] = token
-        self._db['credentials_keys'][credentials['id']] = credentials['key']
+        def entries():
+            for credentials_id, token, key in credentials:
+                yield ['credentials', credentials_id, token, key]
+            for model_id, model in models:
+                yield ['model', model_id, model]
+                for doc in records.get(model_id, []):
+                    yield ['records', model_id, [doc]]
+        return entries()
 
     def get_model_permissions(self, model_id):
         doc = self.__get_raw_model(model_id)
-        return doc['permissions']
+        return dict(doc['permissions'])
@@ -0,0 +1,187 @@
+import json
+import os
+import shutil
+import threading
+import time
+
+from daybed import logger
+
+
+FSYNC_POLICIES = ('always', 'every_second', 'never')
+
+
+class Journal(object):
+    """An append-only log of the memory backend mutations, compacted into
+    snapshots.
+
+    Entries are JSON lists (operation name followed by its arguments), one
+    per line. The log is written to ``<path>.log``, and every
+    ``snapshot_every`` entries the whole state is streamed to
+    ``<path>.snapshot``, after which the log starts over.
+
+    ``fsync`` is either ``always`` (each entry is synced before the write
+    returns), ``every_second`` (synced from a background thread) or
+    ``never`` (left to the operating system).
+
+    Writes run concurrently, only appending to the log is serialized: the
+    writes that must be logged in order are serialized by the caller (the
+    memory backend locks the model). Snapshots wait for the writes in
+    progress, and hold the next ones back.
+    """
+    def __init__(self, path, fsync='every_second', snapshot_every=10000):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError("fsync must be one of %s" % (FSYNC_POLICIES,))
+        self.path = path
+        self.fsync = fsync
+        self.snapshot_every = snapshot_every
+        self.log_path = path + '.log'
+        self.snapshot_path = path + '.snapshot'
+        # Log in use while a snapshot is being written.
+        self.previous_log_path = path + '.log.1'
+        self._file = None
+        self._entries = 0
+        self._dirty = False
+        # Protects the log file.
+        self._lock = threading.Lock()
+        self._snapshot_lock = threading.Lock()
+        # Counts the writes in progress, held back during snapshots.
+        self._writes = threading.Condition()
+        self._writing = 0
+        self._snapshotting = False
+
+    def replay(self):
+        """Yields the entries of the last snapshot, then the logged ones."""
+        for path in (self.snapshot_path, self.previous_log_path,
+                     self.log_path):
+            for entry in self.__read(path):
+                yield entry
+
+    def __read(self, path):
+        if not os.path.exists(path):
+            return
+        with open(path) as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # The last entry was not completely written.
+                    logger.warning("Skipping corrupted entry in %s" % path)
+                    return
+
+    def open(self, dump):
+        """Starts appending entries. ``dump`` is a callable returning the
+        entries that rebuild the current state, used for snapshots. It is
+        called while no write is applied, and must capture the state before
+        returning, the entries being consumed afterwards.
+        """
+        self._dump = dump
+        self._file = open(self.log_path, 'a')
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def append(self, *entry):
+        self.write(None, *entry)
+
+    def write(self, apply, *entry):
+        """Calls ``apply`` (if given) and appends the entry, in one step as
+        far as snapshots are concerned. Nothing is appended if ``apply``
+        fails.
+        """
+        line = json.dumps(entry, separators=(',', ':')) + '\n'
+        with self._writes:
+            while self._snapshotting:
+                self._writes.wait()
+            self._writing += 1
+        try:
+            if apply is not None:
+                apply()
+            with self._lock:
+                self._file.write(line)
+                self._file.flush()
+                if self.fsync == 'always':
+                    os.fsync(self._file.fileno())
+                elif self.fsync == 'every_second':
+                    self._dirty = True
+                self._entries += 1
+        finally:
+            with self._writes:
+                self._writing -= 1
+                if not self._writing:
+                    self._writes.notify_all()
+
+    def sync(self):
+        with self._lock:
+            if self._dirty:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._dirty = False
+
+    def _run(self):
+        while True:
+            time.sleep(1)
+            if self._file is None:
+                return
+            if self.fsync == 'every_second':
+                self.sync()
+            if self._entries >= self.snapshot_every:
+                self.snapshot()
+
+    def snapshot(self):
+        """Streams the current state to a new snapshot, and discards the
+        entries it contains.
+        """
+        with self._snapshot_lock:
+            with self._writes:
+                self._snapshotting = True
+                while self._writing:
+                    self._writes.wait()
+            try:
+                entries = self.__switch_log()
+            finally:
+                with self._writes:
+                    self._snapshotting = False
+                    self._writes.notify_all()
+
+            tmp_path = self.snapshot_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                for entry in entries:
+                    f.write(json.dumps(entry, separators=(',', ':')) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_path, self.snapshot_path)
+            os.remove(self.previous_log_path)
+
+    def __switch_log(self):
+        """Starts a new log, and returns the entries of the current state.
+
+        No write is in progress: the state is captured along with the
+        switch, and entries written from now on are replayed over the
+        snapshot.
+        """
+        with self._lock:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            if os.path.exists(self.previous_log_path):
+                # A previous snapshot was interrupted, its entries are
+                # kept until this one is written.
+                with open(self.previous_log_path, 'a') as previous:
+                    with open(self.log_path) as current:
+                        shutil.copyfileobj(current, previous)
+                os.remove(self.log_path)
+            else:
+                os.rename(self.log_path, self.previous_log_path)
+            self._file = open(self.log_path, 'a')
+            self._entries = 0
+            self._dirty = False
+            return self._dump()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._file.close()
+                self._file = None
+                self._dirty = False
@@ -0,0 +1,460 @@
+from contextlib import contextmanager
+import csv
+import json
+import threading
+import time
+
+import psycopg2
+from psycopg2.extras import Json
+from psycopg2.pool import PoolError, ThreadedConnectionPool
+import six
+
+from daybed.backends import exceptions as backend_exceptions
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS models (
+    id TEXT PRIMARY KEY,
+    definition JSONB NOT NULL,
+    permissions JSONB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS models_readers
+    ON models USING GIN ((permissions -> 'read_definition'));
+CREATE TABLE IF NOT EXISTS records (
+    model_id TEXT NOT NULL REFERENCES models (id) ON DELETE CASCADE,
+    record_id TEXT NOT NULL,
+    record JSONB NOT NULL,
+    authors JSONB NOT NULL,
+    version INTEGER NOT NULL DEFAULT 1,
+    PRIMARY KEY (model_id, record_id)
+);
+CREATE INDEX IF NOT EXISTS records_authors ON records USING GIN (authors);
+CREATE INDEX IF NOT EXISTS records_fields
+    ON records USING GIN (record jsonb_path_ops);
+CREATE TABLE IF NOT EXISTS credentials (
+    id TEXT PRIMARY KEY,
+    token TEXT NOT NULL,
+    key TEXT NOT NULL
+);
+"""
+
+
+class BlockingConnectionPool(ThreadedConnectionPool):
+    """A connection pool whose callers wait for a connection to be released
+    when all of them are in use, instead of getting a ``PoolError``.
+
+    They wait up to ``timeout`` seconds, or forever if it is ``None``.
+    """
+    def __init__(self, minconn, maxconn, *args, **kwargs):
+        self.timeout = kwargs.pop('timeout', None)
+        super(BlockingConnectionPool, self).__init__(minconn, maxconn,
+                                                     *args, **kwargs)
+        self._active = 0
+        self._available = threading.Condition()
+
+    def getconn(self, key=None):
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.time() + self.timeout
+        with self._available:
+            while self._active >= self.maxconn:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise PoolError("No PostgreSQL connection available "
+                                        "after %ss" % self.timeout)
+                self._available.wait(remaining)
+            self._active += 1
+        try:
+            return super(BlockingConnectionPool, self).getconn(key)
+        except Exception:
+            self.__release()
+            raise
+
+    def putconn(self, conn, key=None, close=False):
+        try:
+            super(BlockingConnectionPool, self).putconn(conn, key, close)
+        finally:
+            self.__release()
+
+    def __release(self):
+        with self._available:
+            self._active -= 1
+            self._available.notify()
+
+
+class PostgreSQLBackend(object):
+    """Stores records as JSONB rows in PostgreSQL.
+
+    Records are indexed by a single GIN index on their fields, shared by
+    all models, so that filtering records (see :meth:`filter_records`) is
+    done by the server. Connections are taken from a pool shared by the
+    threads, which wait for one when they are all in use.
+    """
+
+    @classmethod
+    def load_from_config(cls, config):
+        settings = config.registry.settings
+        generator = config.maybe_dotted(settings['daybed.id_generator'])
+        pool_timeout = settings.get('backend.pool_timeout')
+        if pool_timeout is not None:
+            pool_timeout = float(pool_timeout)
+        return PostgreSQLBackend(
+            settings.get('backend.db_dsn', 'dbname=daybed'),
+            generator(config),
+            pool_size=int(settings.get('backend.pool_size', 10)),
+            pool_timeout=pool_timeout,
+            batch_size=int(settings.get('backend.batch_size', 1000))
+        )
+
+    def __init__(self, dsn, id_generator, pool_size=10, pool_timeout=None,
+                 batch_size=1000):
+        self._pool = BlockingConnectionPool(1, pool_size, dsn,
+                                            timeout=pool_timeout)
+        self._batch_size = batch_size
+        self._generate_id = id_generator
+
+        with self._cursor() as cursor:
+            cursor.execute(SCHEMA)
+
+    @contextmanager
+    def _cursor(self):
+        """Yields a cursor, whose statements are run in a transaction."""
+        connection = self._pool.getconn()
+        try:
+            with connection:
+                with connection.cursor() as cursor:
+                    yield cursor
+        finally:
+            self._pool.putconn(connection)
+
+    def delete_db(self):
+        with self._cursor() as cursor:
+            cursor.execute('TRUNCATE models, records, credentials')
+
+    def _batches(self, items):
+        """Splits the ``items`` list into lists of ``batch_size`` items."""
+        for i in range(0, len(items), self._batch_size):
+            yield items[i:i + self._batch_size]
+
+    def get_models(self, principals):
+        principals = list(set(principals))
+        if not principals:
+            return []
+        # Models are indexed by the principals allowed to read them.
+        with self._cursor() as cursor:
+            cursor.execute("SELECT id, definition FROM models"
+                           " WHERE permissions -> 'read_definition' ?| %s",
+                           (principals,))
+            rows = cursor.fetchall()
+        return [{"id": model_id,
+                 "title": definition.get("title", model_id),
+                 "description": definition.get("description", "")}
+                for model_id, definition in rows]
+
+    def __get_raw_model(self, model_id, cursor=None):
+        if cursor is None:
+            with self._cursor() as cursor:
+                return self.__get_raw_model(model_id, cursor)
+
+        cursor.execute('SELECT definition, permissions FROM models'
+                       ' WHERE id = %s', (model_id,))
+        row = cursor.fetchone()
+        if row is None:
+            raise backend_exceptions.ModelNotFound(model_id)
+        return {'definition': row[0], 'permissions': row[1]}
+
+    def get_model_definition(self, model_id):
+        return self.__get_raw_model(model_id)['definition']
+
+    def get_model_permissions(self, model_id):
+        return self.__get_raw_model(model_id)['permissions']
+
+    def _model_exists(self, model_id):
+        with self._cursor() as cursor:
+            cursor.execute('SELECT 1 FROM models WHERE id = %s', (model_id,))
+            return cursor.fetchone() is not None
+
+    def __select_records(self, model_id, where='', params=(), limit=None):
+        """Returns the records of the model matching the ``where`` clause,
+        ordered by id.
+        """
+        query = ('SELECT record, authors FROM records'
+                 ' WHERE model_id = %s' + where + ' ORDER BY record_id')
+        params = (model_id,) + tuple(params)
+        if limit is not None:
+            query += ' LIMIT %s'
+            params += (limit,)
+        with self._cursor() as cursor:
+            # Check if the model still exists or raise
+            self.__get_raw_model(model_id, cursor)
+            cursor.execute(query, params)
+            return [{"authors": authors, "record": record}
+                    for record, authors in cursor.fetchall()]
+
+    def get_records(self, model_id, raw_records=None):
+        return [r["record"] for r in
+                self.get_records_with_authors(model_id, raw_records)]
+
+    def get_records_with_authors(self, model_id, raw_records=None):
+        if raw_records is None:
+            raw_records = self.__select_records(model_id)
+        return raw_records
+
+    def get_paginated_records(self, model_id, limit, cursor=None):
+        """Returns up to ``limit`` records (with their authors) following the
+        ``cursor`` position, and the cursor of the next page (``None`` if
+        this is the last one).
+        """
+        return self.filter_records(model_id, {}, limit, cursor)
+
+    def filter_records(self, model_id, filters, limit, cursor=None):
+        """Like :meth:`get_paginated_records`, for the records whose fields
+        have the values given in ``filters``.
+
+        Filters are matched by JSONB containment, using the fields index.
+        """
+        if cursor is not None and not isinstance(cursor, six.string_types):
+            raise ValueError(cursor)
+        where, params = '', []
+        if filters:
+            where += ' AND record @> %s'
+            params.append(Json(filters))
+        if cursor is not None:
+            where += ' AND record_id > %s'
+            params.append(cursor)
+
+        records = self.__select_records(model_id, where, params, limit + 1)
+        next_cursor = None
+        if len(records) > limit:
+            records = records[:limit]
+            next_cursor = records[-1]['record']['id']
+        return records, next_cursor
+
+    def get_records_by_authors(self, model_id, authors):
+        """Returns the records of the model written by one of the
+        ``authors``, looked up in the authors index.
+        """
+        authors = list(set(authors))
+        if not authors:
+            # Check if the model still exists or raise
+            self.__get_raw_model(model_id)
+            return []
+        raw_records = self.__select_records(model_id, ' AND authors ?| %s',
+                                            (authors,))
+        return self.get_records(model_id, raw_records)
+
+    def __get_raw_record(self, model_id, record_id, cursor=None):
+        if cursor is None:
+            with self._cursor() as cursor:
+                return self.__get_raw_record(model_id, record_id, cursor)
+
+        cursor.execute('SELECT record, authors, version FROM records'
+                       ' WHERE model_id = %s AND record_id = %s',
+                       (model_id, record_id))
+        row = cursor.fetchone()
+        if row is None:
+            raise backend_exceptions.RecordNotFound(
+                u'(%s, %s)' % (model_id, record_id)
+            )
+        return {'record': row[0], 'authors': row[1], 'version': row[2]}
+
+    def get_record(self, model_id, record_id):
+        return self.__get_raw_record(model_id, record_id)['record']
+
+    def get_record_authors(self, model_id, record_id):
+        return self.__get_raw_record(model_id, record_id)['authors']
+
+    def get_record_version(self, model_id, record_id):
+        return str(self.__get_raw_record(model_id, record_id)['version'])
+
+    def get_record_with_version(self, model_id, record_id):
+        doc = self.__get_raw_record(model_id, record_id)
+        return doc['record'], str(doc['version'])
+
+    def put_model(self, definition, permissions, model_id=None):
+        if model_id is None:
+            model_id = self._generate_id(key_exist=self._model_exists)
+
+        with self._cursor() as cursor:
+            cursor.execute(
+                'INSERT INTO models (id, definition, permissions)'
+                ' VALUES (%s, %s, %s) ON CONFLICT (id) DO UPDATE'
+                ' SET definition = EXCLUDED.definition,'
+                '     permissions = EXCLUDED.permissions',
+                (model_id, Json(definition), Json(permissions)))
+        return model_id
+
+    def put_record(self, model_id, record, authors, record_id=None,
+                   version=None):
+        if version is not None:
+            return self.__update_record(model_id, record, authors, record_id,
+                                        version)
+
+        # A generated id must not overwrite an existing record: another id
+        # is tried.
+        overwrite = record_id is not None
+        query = ('INSERT INTO records (model_id, record_id, record, authors)'
+                 ' VALUES (%s, %s, %s, %s)')
+        if overwrite:
+            # Authors of the previous version are kept.
+            query += (' ON CONFLICT (model_id, record_id) DO UPDATE'
+                      ' SET record = EXCLUDED.record,'
+                      '     authors = (SELECT jsonb_agg(DISTINCT a)'
+                      '        FROM jsonb_array_elements('
+                      '          records.authors || EXCLUDED.authors) a),'
+                      '     version = records.version + 1')
+        else:
+            query += ' ON CONFLICT (model_id, record_id) DO NOTHING'
+        query += ' RETURNING version'
+
+        with self._cursor() as cursor:
+            while True:
+                if record_id is None:
+                    record_id = self._generate_id()
+                record['id'] = record_id
+                try:
+                    cursor.execute(query, (model_id, record_id, Json(record),
+                                           Json(authors)))
+                except psycopg2.IntegrityError:
+                    raise backend_exceptions.ModelNotFound(model_id)
+                row = cursor.fetchone()
+                if row is not None:
+                    return record_id, str(row[0])
+                record_id = None
+
+    def __update_record(self, model_id, record, authors, record_id,
+                        version):
+        """Updates the record only if it is still at the given version."""
+        record['id'] = record_id
+        with self._cursor() as cursor:
+            cursor.execute(
+                'UPDATE records SET record = %s,'
+                '  authors = (SELECT jsonb_agg(DISTINCT a)'
+                '    FROM jsonb_array_elements(authors || %s) a),'
+                '  version = version + 1'
+                ' WHERE model_id = %s AND record_id = %s'
+                '   AND version::text = %s'
+                ' RETURNING version',
+                (Json(record), Json(authors), model_id, record_id, version))
+            row = cursor.fetchone()
+            if row is None:
+                raise backend_exceptions.VersionMismatch(record_id)
+        return record_id, str(row[0])
+
+    def put_records(self, model_id, records, authors):
+        """Creates all the ``records`` with ``COPY``, by transactions of
+        ``batch_size`` records, and returns their ids.
+        """
+        records_ids = []
+        for batch in self._batches(records):
+            records_ids.extend(self.__copy_records(model_id, batch, authors))
+        return records_ids
+
+    def __copy_records(self, model_id, records, authors):
+        buffer = six.StringIO()
+        writer = csv.writer(buffer)
+        generated = []
+        for record in records:
+            record_id = self._generate_id(
+                key_exist=lambda i: i in generated)
+            generated.append(record_id)
+            record['id'] = record_id
+            writer.writerow([record_id, json.dumps(record)])
+        buffer.seek(0)
+
+        with self._cursor() as cursor:
+            # Check if the model still exists or raise
+            self.__get_raw_model(model_id, cursor)
+
+            # Records are copied in a temporary table first, so that those
+            # whose generated id is taken can be told apart.
+            cursor.execute('CREATE TEMPORARY TABLE records_import'
+                           ' (record_id TEXT, record JSONB) ON COMMIT DROP')
+            cursor.copy_expert('COPY records_import FROM STDIN'
+                               ' WITH (FORMAT csv)', buffer)
+            cursor.execute(
+                'INSERT INTO records (model_id, record_id, record, authors)'
+                ' SELECT %s, record_id, record, %s FROM records_import'
+                ' ON CONFLICT (model_id, record_id) DO NOTHING'
+                ' RETURNING record_id', (model_id, Json(authors)))
+            stored = set(row[0] for row in cursor.fetchall())
+
+        # Records whose generated id was already taken get another one.
+        records_ids = []
+        for record, record_id in zip(records, generated):
+            if record_id not in stored:
+                del record['id']
+                record_id, _ = self.put_record(model_id, record, authors)
+            records_ids.append(record_id)
+        return records_ids
+
+    def delete_record(self, model_id, record_id, version=None):
+        query = 'DELETE FROM records WHERE model_id = %s AND record_id = %s'
+        params = (model_id, record_id)
+        if version is not None:
+            query += ' AND version::text = %s'
+            params += (version,)
+        with self._cursor() as cursor:
+            cursor.execute(query + ' RETURNING record, authors', params)
+            row = cursor.fetchone()
+            if row is None and version is not None:
+                # Raises if the record does not exist.
+                self.__get_raw_record(model_id, record_id, cursor)
+                raise backend_exceptions.VersionMismatch(record_id)
+        if row is None:
+            raise backend_exceptions.RecordNotFound(
+                u'(%s, %s)' % (model_id, record_id)
+            )
+        return {'record': row[0], 'authors': row[1]}
+
+    def delete_records(self, model_id):
+        with self._cursor() as cursor:
+            # Check if the model still exists or raise
+            self.__get_raw_model(model_id, cursor)
+            cursor.execute('DELETE FROM records WHERE model_id = %s'
+                           ' RETURNING record', (model_id,))
+            return [row[0] for row in cursor.fetchall()]
+
+    def delete_model(self, model_id):
+        records = self.delete_records(model_id)
+        with self._cursor() as cursor:
+            cursor.execute('DELETE FROM models WHERE id = %s'
+                           ' RETURNING definition, permissions', (model_id,))
+            row = cursor.fetchone()
+            if row is None:
+                raise backend_exceptions.ModelNotFound(model_id)
+        return {"definition": row[0],
+                "permissions": row[1],
+                "records": records}
+
+    def get_token(self, credentials_id):
+        """Retrieves a token by its id"""
+        with self._cursor() as cursor:
+            cursor.execute('SELECT token FROM credentials WHERE id = %s',
+                           (credentials_id,))
+            row = cursor.fetchone()
+        if row is None:
+            raise backend_exceptions.CredentialsNotFound(credentials_id)
+        return row[0]
+
+    def get_credentials_key(self, credentials_id):
+        """Retrieves a credentials key by its id"""
+        with self._cursor() as cursor:
+            cursor.execute('SELECT key FROM credentials WHERE id = %s',
+                           (credentials_id,))
+            row = cursor.fetchone()
+        if row is None:
+            raise backend_exceptions.CredentialsNotFound(credentials_id)
+        return row[0]
+
+    def store_credentials(self, token, credentials):
+        assert 'id' in credentials and 'key' in credentials
+        with self._cursor() as cursor:
+            cursor.execute('INSERT INTO credentials VALUES (%s, %s, %s)'
+                           ' ON CONFLICT (id) DO NOTHING',
+                           (credentials['id'], token, credentials['key']))
+            if not cursor.rowcount:
+                raise backend_exceptions.CredentialsAlreadyExist(
+                    credentials['id'])
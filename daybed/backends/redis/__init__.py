@@ -1,9 +1,17 @@
 import json
-import functools
 import redis
+import six
 
 from daybed.backends import exceptions as backend_exceptions
 
+from . import scripts
+
+
+#: Version of the indexes maintained along with the data (models readers
+#: sets and records authors sets). Data stored by previous versions is
+#: indexed at startup.
+INDEXES_VERSION = 2
+
 
 class RedisBackend(object):
 
@@ -15,30 +23,90 @@ class RedisBackend(object):
             settings.get('backend.db_host', 'localhost'),
             settings.get('backend.db_port', 6379),
             settings.get('backend.db_index', 0),
-            generator(config)
+            generator(config),
+            int(settings.get('backend.batch_size', 1000))
         )
 
-    def __init__(self, host, port, db, id_generator):
+    def __init__(self, host, port, db, id_generator, batch_size=1000):
         self._db = redis.StrictRedis(host=host, port=port, db=db)
+        self._batch_size = batch_size
 
         # Ping the server to be sure the connection works.
         self._db.ping()
         self._generate_id = id_generator
 
+        self._put_record = self._db.register_script(scripts.put_record)
+        self._delete_record = self._db.register_script(scripts.delete_record)
+
+        self.__build_indexes()
+
     def delete_db(self):
         self._db.flushdb()
+        self._db.set("indexes.version", INDEXES_VERSION)
+
+    def __build_indexes(self):
+        """Indexes the models and records stored by previous versions, which
+        were only looked up with ``KEYS``, and records read one by one.
+        Indexing is idempotent, concurrent startups can run it at once.
+        """
+        version = int(self._db.get("indexes.version") or 0)
+        if version >= INDEXES_VERSION:
+            return
+
+        models_keys = self._db.scan_iter("model.*", count=self._batch_size)
+        for batch in self._batches(models_keys):
+            pipe = self._db.pipeline(transaction=False)
+            for model_key, model in zip(batch, self._db.mget(*batch)):
+                if model is None:
+                    continue
+                model = json.loads(model.decode("utf-8"))
+                pipe.sadd("models", model['id'])
+                for principal in model['permissions'].get('read_definition',
+                                                          []):
+                    pipe.sadd("models.readable.%s" % principal, model_key)
+                self.__build_authors_indexes(model['id'])
+            pipe.execute()
+        self._db.set("indexes.version", INDEXES_VERSION)
+
+    def __build_authors_indexes(self, model_id):
+        records_keys = self._db.sscan_iter("modelrecords.%s" % model_id,
+                                           count=self._batch_size)
+        for batch in self._batches(records_keys):
+            pipe = self._db.pipeline(transaction=False)
+            for record_key, doc in zip(batch, self._db.mget(*batch)):
+                if doc is None:
+                    continue
+                for author in json.loads(doc.decode("utf-8"))['authors']:
+                    pipe.sadd(self.__authors_key(model_id, author),
+                              record_key)
+            pipe.execute()
+
+    def __authors_key(self, model_id, author):
+        return "modelrecords.%s.author.%s" % (model_id, author)
+
+    def __record_keys(self, model_id, record_id, authors):
+        """Returns the keys a record write touches, for ``authors``."""
+        return (["modelrecord.%s.%s" % (model_id, record_id),
+                 "modelrecords.%s" % model_id] +
+                [self.__authors_key(model_id, a) for a in authors])
 
     def get_models(self, principals):
         principals = set(principals)
-        models_id = self._db.keys("model.*")
-        if models_id:
+        if not principals:
+            return []
+        # Models are indexed by the principals allowed to read them.
+        models_keys = self._db.sunion(*[
+            "models.readable.%s" % principal for principal in principals
+        ])
+        if models_keys:
             models = [json.loads(m.decode("utf-8"))
-                      for m in self._db.mget(*models_id) if m]
+                      for m in self._db.mget(*models_keys) if m]
+            # Readers are checked again, in case the sets are behind.
             return [{"id": m['id'],
                      "title": m['definition']['title'],
                      "description": m['definition']['description']}
                     for m in models if principals.intersection(
-                        m['permissions']['read_definition']) != set()]
+                        m['permissions'].get('read_definition', []))]
         else:
             return []
 
@@ -56,18 +124,40 @@ class RedisBackend(object):
         doc = self.__get_raw_model(model_id)
         return doc['permissions']
 
+    def _batches(self, keys):
+        """Splits the ``keys`` iterable into lists of ``batch_size`` keys."""
+        batch = []
+        for key in keys:
+            batch.append(key)
+            if len(batch) >= self._batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def __iter_raw_records(self, records_keys):
+        """Yields the documents of the given records, fetched and decoded
+        by batches.
+        """
+        for batch in self._batches(records_keys):
+            for item in self._db.mget(*batch):
+                if item is not None:
+                    yield json.loads(item.decode("utf-8"))
+
     def __get_raw_records(self, model_id):
         # Check if the model still exists or raise
         self.__get_raw_model(model_id)
 
-        model_records = self._db.smembers(
-            "modelrecords.%s" % model_id
-        )
-        if model_records:
-            return [json.loads(i.decode("utf-8"))
-                    for i in self._db.mget(*model_records)]
-        else:
-            return []
+        def records_keys():
+            # SSCAN may return a key more than once.
+            seen = set()
+            for key in self._db.sscan_iter("modelrecords.%s" % model_id,
+                                           count=self._batch_size):
+                if key not in seen:
+                    seen.add(key)
+                    yield key
+
+        return self.__iter_raw_records(records_keys())
 
     def get_records(self, model_id, raw_records=None):
         return [r["record"] for r in
@@ -77,11 +167,48 @@ class RedisBackend(object):
         if raw_records is None:
             raw_records = self.__get_raw_records(model_id)
         records = []
-        for item in self.__get_raw_records(model_id):
+        for item in raw_records:
             records.append({"authors": item["authors"],
                             "record": item["record"]})
         return records
 
+    def get_paginated_records(self, model_id, limit, cursor=None):
+        """Returns about ``limit`` records (with their authors) following the
+        ``cursor`` position, and the cursor of the next page (``None`` if
+        this is the last one).
+
+        Pages are served with ``SSCAN``, hence ``limit`` is only a hint of
+        the page size. Each page is deduplicated, but a record may still be
+        returned in two pages if the set is resized between them.
+        """
+        if cursor is not None and not isinstance(cursor, six.integer_types):
+            raise ValueError(cursor)
+        # Check if the model still exists or raise
+        self.__get_raw_model(model_id)
+
+        next_cursor, keys = self._db.sscan("modelrecords.%s" % model_id,
+                                           cursor=cursor or 0, count=limit)
+        # SSCAN may return a key more than once, even in the same page.
+        keys = sorted(set(keys))
+        records = self.get_records_with_authors(
+            model_id, self.__iter_raw_records(keys))
+        return records, (int(next_cursor) or None)
+
+    def get_records_by_authors(self, model_id, authors):
+        """Returns the records of the model written by one of the
+        ``authors``, looked up in the authors index.
+        """
+        # Check if the model still exists or raise
+        self.__get_raw_model(model_id)
+
+        if not authors:
+            return []
+        records_keys = self._db.sunion(*[
+            self.__authors_key(model_id, author) for author in authors
+        ])
+        return self.get_records(model_id,
+                                self.__iter_raw_records(records_keys))
+
     def __get_raw_record(self, model_id, record_id):
         record = self._db.get("modelrecord.%s.%s" % (model_id, record_id))
         if record is not None:
@@ -98,6 +225,15 @@ class RedisBackend(object):
         doc = self.__get_raw_record(model_id, record_id)
         return doc['authors']
 
+    def get_record_version(self, model_id, record_id):
+        doc = self.__get_raw_record(model_id, record_id)
+        # Records stored before versions were introduced have none.
+        return str(doc.get('version', 0))
+
+    def get_record_with_version(self, model_id, record_id):
+        doc = self.__get_raw_record(model_id, record_id)
+        return doc['record'], str(doc.get('version', 0))
+
     def _model_exists(self, model_id):
         return self._db.get("model.%s" % model_id) is not None
 
@@ -105,75 +241,153 @@ class RedisBackend(object):
         if model_id is None:
             model_id = self._generate_id(key_exist=self._model_exists)
 
-        self._db.set(
-            "model.%s" % model_id,
-            json.dumps({
+        model_key = "model.%s" % model_id
+        readers = permissions.get('read_definition', [])
+
+        def update(pipe):
+            # The previous readers are read under WATCH: the transaction is
+            # retried if the model changes meanwhile.
+            old_model = pipe.get(model_key)
+            old_readers = []
+            if old_model is not None:
+                old_permissions = json.loads(
+                    old_model.decode("utf-8"))['permissions']
+                old_readers = old_permissions.get('read_definition', [])
+
+            pipe.multi()
+            pipe.set(model_key, json.dumps({
                 'id': model_id,
                 'definition': definition,
                 'permissions': permissions
-            })
-        )
+            }))
+            pipe.sadd("models", model_id)
+            for principal in set(old_readers) - set(readers):
+                pipe.srem("models.readable.%s" % principal, model_key)
+            for principal in readers:
+                pipe.sadd("models.readable.%s" % principal, model_key)
+
+        self._db.transaction(update, model_key)
         return model_id
 
-    def _record_exists(self, model_id, record_id):
-        record = self._db.get("modelrecord.%s.%s" % (model_id, record_id))
-        return record is not None
-
-    def put_record(self, model_id, record, authors, record_id=None):
-        doc = {
-            'authors': authors,
-            'record': record
-        }
-
-        if record_id is not None:
-            try:
-                old_doc = self.__get_raw_record(model_id, record_id)
-            except backend_exceptions.RecordNotFound:
-                pass
-            else:
-                authors = list(set(authors) | set(old_doc['authors']))
-                doc['authors'] = authors
-                old_doc.update(doc)
-                doc = old_doc
-        else:
-            key_exist = functools.partial(self._record_exists, model_id)
-            record_id = self._generate_id(key_exist=key_exist)
-
-        doc['record']['id'] = record_id
-        self._db.set(
-            "modelrecord.%s.%s" % (model_id, record_id),
-            json.dumps(doc)
-        )
-        self._db.sadd(
-            "modelrecords.%s" % model_id,
-            "modelrecord.%s.%s" % (model_id, record_id)
-        )
-        return record_id
+    def put_record(self, model_id, record, authors, record_id=None,
+                   version=None):
+        # A generated id must not overwrite an existing record: the script
+        # refuses it, and another id is tried.
+        overwrite = record_id is not None
+        while True:
+            if record_id is None:
+                record_id = self._generate_id()
+            record['id'] = record_id
+            # The authors sets of the previous version are updated too.
+            sets_authors = set(authors)
+            if overwrite:
+                try:
+                    old_doc = self.__get_raw_record(model_id, record_id)
+                    sets_authors.update(old_doc['authors'])
+                except backend_exceptions.RecordNotFound:
+                    pass
+            sets_authors = sorted(sets_authors)
+            stored = self._put_record(
+                keys=self.__record_keys(model_id, record_id, sets_authors),
+                args=[json.dumps(record),
+                      json.dumps(authors),
+                      json.dumps(sets_authors),
+                      '0' if overwrite else '1',
+                      version or ''])
+            if stored == -2:
+                # Authors changed meanwhile.
+                continue
+            if stored == -1:
+                raise backend_exceptions.VersionMismatch(record_id)
+            if stored:
+                return record_id, str(stored)
+            record_id = None
+
+    def put_records(self, model_id, records, authors):
+        """Creates all the ``records`` in a single pipeline, and returns
+        their ids.
+        """
+        # Check if the model still exists or raise
+        self.__get_raw_model(model_id)
 
-    def delete_record(self, model_id, record_id):
-        doc = self.__get_raw_record(model_id, record_id)
-        if doc:
-            self._db.delete("modelrecord.%s.%s" % (model_id, record_id))
-            self._db.srem(
-                "modelrecords.%s" % model_id,
-                "modelrecord.%s.%s" % (model_id, record_id)
-            )
-            return doc
+        records_ids = []
+        pipe = self._db.pipeline(transaction=False)
+        for record in records:
+            record_id = self._generate_id()
+            record['id'] = record_id
+            self._put_record(
+                keys=self.__record_keys(model_id, record_id, authors),
+                args=[json.dumps(record),
+                      json.dumps(authors),
+                      json.dumps(authors),
+                      '1', ''],
+                client=pipe)
+            records_ids.append(record_id)
+        stored = pipe.execute()
+
+        # Records whose generated id was already taken get another one.
+        for i, record in enumerate(records):
+            if not stored[i]:
+                records_ids[i], _ = self.put_record(model_id, record,
+                                                    authors)
+        return records_ids
+
+    def delete_record(self, model_id, record_id, version=None):
+        while True:
+            authors = self.__get_raw_record(model_id, record_id)['authors']
+            doc = self._delete_record(
+                keys=self.__record_keys(model_id, record_id, authors),
+                args=[json.dumps(authors), version or ''])
+            if doc is None:
+                raise backend_exceptions.RecordNotFound(
+                    u'(%s, %s)' % (model_id, record_id)
+                )
+            if doc == -1:
+                raise backend_exceptions.VersionMismatch(record_id)
+            if doc != -2:
+                # Otherwise authors changed meanwhile.
+                return json.loads(doc.decode("utf-8"))
 
     def delete_records(self, model_id):
-        records = self.get_records(model_id)
-        existing_records_keys = [
-            "modelrecord.%s.%s" % (model_id, r["id"]) for r in records
-        ]
+        records = self.get_records_with_authors(model_id)
+        authors = set()
+        existing_records_keys = []
+        for r in records:
+            authors.update(r["authors"])
+            existing_records_keys.append(
+                "modelrecord.%s.%s" % (model_id, r["record"]["id"]))
         existing_records_keys.append("modelrecords.%s" % model_id)
+        existing_records_keys.extend([
+            self.__authors_key(model_id, author) for author in authors
+        ])
 
-        self._db.delete(*existing_records_keys)
-        return records
+        pipe = self._db.pipeline()
+        for batch in self._batches(existing_records_keys):
+            pipe.delete(*batch)
+        pipe.execute()
+        return [r["record"] for r in records]
 
     def delete_model(self, model_id):
-        doc = self.__get_raw_model(model_id)
-        doc["records"] = self.delete_records(model_id)
-        self._db.delete("model.%s" % model_id)
+        self.__get_raw_model(model_id)
+        records = self.delete_records(model_id)
+
+        model_key = "model.%s" % model_id
+
+        def delete(pipe):
+            model = pipe.get(model_key)
+            if model is None:
+                raise backend_exceptions.ModelNotFound(model_id)
+            doc = json.loads(model.decode("utf-8"))
+
+            pipe.multi()
+            pipe.delete(model_key)
+            pipe.srem("models", model_id)
+            for principal in doc["permissions"].get('read_definition', []):
+                pipe.srem("models.readable.%s" % principal, model_key)
+            return doc
+
+        doc = self._db.transaction(delete, model_key, value_from_callable=True)
+        doc["records"] = records
         return {
             "definition": doc["definition"],
             "records": doc["records"],
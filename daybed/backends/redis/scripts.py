@@ -0,0 +1,118 @@
+# Server-side Lua scripts, so that each record write is atomic. Every key
+# they touch is given in KEYS, as Redis Cluster requires.
+
+""" Store a record, merging its authors with the ones of the previous version,
+and increment its version.
+
+KEYS[1]: record key, KEYS[2]: model records set, KEYS[3...]: authors sets
+of the given authors and of the previous version ones.
+ARGV[1]: JSON encoded record, ARGV[2]: JSON encoded authors,
+ARGV[3]: JSON encoded authors of the sets in KEYS[3...], in the same order,
+ARGV[4]: "1" to refuse to overwrite a record,
+ARGV[5]: expected current version, or "" to write whatever the version.
+
+Returns 0 if the record exists and should not be overwritten, -1 if its
+version is not the expected one, -2 if the set of an author is missing
+(authors changed meanwhile), or the new version.
+"""
+put_record = """
+local old = redis.call('GET', KEYS[1])
+if old and ARGV[4] == '1' then
+  return 0
+end
+if old then
+  old = cjson.decode(old)
+end
+
+local sets = {}
+for i, author in ipairs(cjson.decode(ARGV[3])) do
+  sets[author] = KEYS[i + 2]
+end
+
+local version = 0
+if old and old['version'] then
+  version = old['version']
+end
+if ARGV[5] ~= '' and (not old or tostring(version) ~= ARGV[5]) then
+  return -1
+end
+
+local authors = {}
+local seen = {}
+local function add_authors(list)
+  for _, author in ipairs(list) do
+    if not seen[author] then
+      seen[author] = true
+      table.insert(authors, author)
+    end
+  end
+end
+add_authors(cjson.decode(ARGV[2]))
+if old then
+  add_authors(old['authors'])
+end
+for _, author in ipairs(authors) do
+  if not sets[author] then
+    return -2
+  end
+end
+
+local encoded = '[]'
+if #authors > 0 then
+  encoded = cjson.encode(authors)
+end
+redis.call('SET', KEYS[1],
+           '{"authors": ' .. encoded .. ', "version": ' .. (version + 1) ..
+           ', "record": ' .. ARGV[1] .. '}')
+redis.call('SADD', KEYS[2], KEYS[1])
+for _, author in ipairs(authors) do
+  redis.call('SADD', sets[author], KEYS[1])
+end
+return version + 1
+"""
+
+
+""" Delete a record and its references in the model and authors sets.
+
+KEYS[1]: record key, KEYS[2]: model records set, KEYS[3...]: authors sets
+of the record.
+ARGV[1]: JSON encoded authors of the sets in KEYS[3...], in the same order,
+ARGV[2]: expected current version, or "" to delete whatever the version.
+
+Returns the deleted document, nil if it does not exist, -1 if its version
+is not the expected one, or -2 if the set of one of its authors is missing
+(authors changed meanwhile).
+"""
+delete_record = """
+local doc = redis.call('GET', KEYS[1])
+if not doc then
+  return false
+end
+local decoded = cjson.decode(doc)
+
+local version = 0
+if decoded['version'] then
+  version = decoded['version']
+end
+if ARGV[2] ~= '' and tostring(version) ~= ARGV[2] then
+  return -1
+end
+
+local sets = {}
+for i, author in ipairs(cjson.decode(ARGV[1])) do
+  sets[author] = KEYS[i + 2]
+end
+local authors = decoded['authors']
+for _, author in ipairs(authors) do
+  if not sets[author] then
+    return -2
+  end
+end
+
+redis.call('DEL', KEYS[1])
+redis.call('SREM', KEYS[2], KEYS[1])
+for _, author in ipairs(authors) do
+  redis.call('SREM', sets[author], KEYS[1])
+end
+return doc
+"""
@@ -0,0 +1,388 @@
+from contextlib import contextmanager
+import json
+import sqlite3
+import threading
+
+import six
+
+from daybed.backends import exceptions as backend_exceptions
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS models (
+    id TEXT PRIMARY KEY,
+    definition TEXT NOT NULL,
+    permissions TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS models_readers (
+    principal TEXT NOT NULL,
+    model_id TEXT NOT NULL,
+    PRIMARY KEY (principal, model_id)
+);
+CREATE TABLE IF NOT EXISTS records (
+    model_id TEXT NOT NULL,
+    record_id TEXT NOT NULL,
+    record TEXT NOT NULL,
+    authors TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    PRIMARY KEY (model_id, record_id)
+);
+CREATE TABLE IF NOT EXISTS records_authors (
+    model_id TEXT NOT NULL,
+    author TEXT NOT NULL,
+    record_id TEXT NOT NULL,
+    PRIMARY KEY (model_id, author, record_id)
+);
+CREATE INDEX IF NOT EXISTS records_authors_record
+    ON records_authors (model_id, record_id);
+CREATE TABLE IF NOT EXISTS credentials (
+    id TEXT PRIMARY KEY,
+    token TEXT NOT NULL,
+    key TEXT NOT NULL
+);
+"""
+
+
+class SQLiteBackend(object):
+    """Stores documents in a SQLite database file.
+
+    Records are stored as JSON, indexed by model and by author. Each thread
+    uses its own connection, and the database is opened in WAL mode so that
+    readers are not blocked by writers.
+    """
+
+    @classmethod
+    def load_from_config(cls, config):
+        settings = config.registry.settings
+        generator = config.maybe_dotted(settings['daybed.id_generator'])
+        return SQLiteBackend(
+            settings.get('backend.db_path', 'daybed.sqlite'),
+            generator(config),
+            int(settings.get('backend.batch_size', 1000))
+        )
+
+    def __init__(self, path, id_generator, batch_size=1000):
+        self._path = path
+        self._batch_size = batch_size
+        self._generate_id = id_generator
+        self._local = threading.local()
+
+        self._db.executescript(SCHEMA)
+
+    @property
+    def _db(self):
+        """The connection of the current thread."""
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            # Transactions are handled explicitly, see ``_transaction``.
+            db = sqlite3.connect(self._path, timeout=30,
+                                 isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+            self._local.transactions = 0
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        """Runs the block in a write transaction, or in the current one if
+        it is nested.
+        """
+        db = self._db
+        if self._local.transactions:
+            self._local.transactions += 1
+            try:
+                yield db
+            finally:
+                self._local.transactions -= 1
+            return
+
+        db.execute('BEGIN IMMEDIATE')
+        self._local.transactions = 1
+        try:
+            yield db
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        else:
+            db.execute('COMMIT')
+        finally:
+            self._local.transactions = 0
+
+    def delete_db(self):
+        with self._transaction() as db:
+            for table in ('models', 'models_readers', 'records',
+                          'records_authors', 'credentials'):
+                db.execute('DELETE FROM %s' % table)
+
+    def _batches(self, items):
+        """Splits the ``items`` list into lists of ``batch_size`` items."""
+        for i in range(0, len(items), self._batch_size):
+            yield items[i:i + self._batch_size]
+
+    def get_models(self, principals):
+        principals = list(set(principals))
+        if not principals:
+            return []
+        # Models are indexed by the principals allowed to read them.
+        rows = self._db.execute(
+            'SELECT id, definition FROM models WHERE id IN ('
+            '  SELECT model_id FROM models_readers'
+            '  WHERE principal IN (%s))' % ','.join('?' * len(principals)),
+            principals)
+        models = []
+        for model_id, definition in rows:
+            definition = json.loads(definition)
+            models.append({"id": model_id,
+                           "title": definition.get("title", model_id),
+                           "description": definition.get("description", "")})
+        return models
+
+    def __get_raw_model(self, model_id):
+        row = self._db.execute(
+            'SELECT definition, permissions FROM models WHERE id = ?',
+            (model_id,)).fetchone()
+        if row is None:
+            raise backend_exceptions.ModelNotFound(model_id)
+        return {'definition': json.loads(row[0]),
+                'permissions': json.loads(row[1])}
+
+    def get_model_definition(self, model_id):
+        return self.__get_raw_model(model_id)['definition']
+
+    def get_model_permissions(self, model_id):
+        return self.__get_raw_model(model_id)['permissions']
+
+    def _model_exists(self, model_id):
+        row = self._db.execute('SELECT 1 FROM models WHERE id = ?',
+                               (model_id,)).fetchone()
+        return row is not None
+
+    def __decode_records(self, rows):
+        return [{"authors": json.loads(authors),
+                 "record": json.loads(record)}
+                for record, authors in rows]
+
+    def get_records(self, model_id, raw_records=None):
+        return [r["record"] for r in
+                self.get_records_with_authors(model_id, raw_records)]
+
+    def get_records_with_authors(self, model_id, raw_records=None):
+        if raw_records is None:
+            # Check if the model still exists or raise
+            self.__get_raw_model(model_id)
+            raw_records = self.__decode_records(self._db.execute(
+                'SELECT record, authors FROM records WHERE model_id = ?',
+                (model_id,)))
+        return raw_records
+
+    def get_paginated_records(self, model_id, limit, cursor=None):
+        """Returns up to ``limit`` records (with their authors) following the
+        ``cursor`` position, and the cursor of the next page (``None`` if
+        this is the last one).
+        """
+        if cursor is not None and not isinstance(cursor, six.string_types):
+            raise ValueError(cursor)
+        # Check if the model still exists or raise
+        self.__get_raw_model(model_id)
+
+        rows = self._db.execute(
+            'SELECT record_id, record, authors FROM records'
+            ' WHERE model_id = ? AND record_id > ?'
+            ' ORDER BY record_id LIMIT ?',
+            (model_id, cursor or '', limit + 1)).fetchall()
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = rows[-1][0]
+        records = self.__decode_records([row[1:] for row in rows])
+        return records, next_cursor
+
+    def get_records_by_authors(self, model_id, authors):
+        """Returns the records of the model written by one of the
+        ``authors``, looked up in the authors index.
+        """
+        # Check if the model still exists or raise
+        self.__get_raw_model(model_id)
+
+        authors = list(set(authors))
+        if not authors:
+            return []
+        rows = self._db.execute(
+            'SELECT record, authors FROM records'
+            ' WHERE model_id = ? AND record_id IN ('
+            '  SELECT record_id FROM records_authors'
+            '  WHERE model_id = ? AND author IN (%s))'
+            ' ORDER BY record_id' % ','.join('?' * len(authors)),
+            [model_id, model_id] + authors)
+        return self.get_records(model_id, self.__decode_records(rows))
+
+    def __get_raw_record(self, model_id, record_id):
+        row = self._db.execute(
+            'SELECT record, authors, version FROM records'
+            ' WHERE model_id = ? AND record_id = ?',
+            (model_id, record_id)).fetchone()
+        if row is None:
+            raise backend_exceptions.RecordNotFound(
+                u'(%s, %s)' % (model_id, record_id)
+            )
+        doc = self.__decode_records([row[:2]])[0]
+        doc['version'] = row[2]
+        return doc
+
+    def get_record(self, model_id, record_id):
+        return self.__get_raw_record(model_id, record_id)['record']
+
+    def get_record_authors(self, model_id, record_id):
+        return self.__get_raw_record(model_id, record_id)['authors']
+
+    def get_record_version(self, model_id, record_id):
+        return str(self.__get_raw_record(model_id, record_id)['version'])
+
+    def get_record_with_version(self, model_id, record_id):
+        doc = self.__get_raw_record(model_id, record_id)
+        return doc['record'], str(doc['version'])
+
+    def _record_exists(self, model_id, record_id):
+        row = self._db.execute(
+            'SELECT 1 FROM records WHERE model_id = ? AND record_id = ?',
+            (model_id, record_id)).fetchone()
+        return row is not None
+
+    def put_model(self, definition, permissions, model_id=None):
+        if model_id is None:
+            model_id = self._generate_id(key_exist=self._model_exists)
+
+        readers = set(permissions.get('read_definition', []))
+        with self._transaction() as db:
+            db.execute('INSERT OR REPLACE INTO models VALUES (?, ?, ?)',
+                       (model_id, json.dumps(definition),
+                        json.dumps(permissions)))
+            db.execute('DELETE FROM models_readers WHERE model_id = ?',
+                       (model_id,))
+            db.executemany('INSERT INTO models_readers VALUES (?, ?)',
+                           [(principal, model_id) for principal in readers])
+        return model_id
+
+    def __insert_records(self, db, model_id, docs):
+        db.executemany(
+            'INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?)',
+            [(model_id, doc['record']['id'], json.dumps(doc['record']),
+              json.dumps(doc['authors']), doc.get('version', 1))
+             for doc in docs])
+        db.executemany(
+            'INSERT OR IGNORE INTO records_authors VALUES (?, ?, ?)',
+            [(model_id, author, doc['record']['id'])
+             for doc in docs for author in doc['authors']])
+
+    def put_record(self, model_id, record, authors, record_id=None,
+                   version=None):
+        with self._transaction() as db:
+            if not self._model_exists(model_id):
+                raise backend_exceptions.ModelNotFound(model_id)
+
+            current = 0
+            if record_id is not None:
+                try:
+                    old_doc = self.__get_raw_record(model_id, record_id)
+                except backend_exceptions.RecordNotFound:
+                    pass
+                else:
+                    authors = list(set(authors) | set(old_doc['authors']))
+                    current = old_doc['version']
+            else:
+                record_id = self._generate_id(
+                    key_exist=lambda i: self._record_exists(model_id, i))
+
+            if version is not None and (not current or
+                                        str(current) != version):
+                raise backend_exceptions.VersionMismatch(record_id)
+
+            record['id'] = record_id
+            self.__insert_records(db, model_id, [{'record': record,
+                                                  'authors': authors,
+                                                  'version': current + 1}])
+        return record_id, str(current + 1)
+
+    def put_records(self, model_id, records, authors):
+        """Creates all the ``records`` by transactions of ``batch_size``
+        records, and returns their ids.
+        """
+        # Check if the model still exists or raise
+        self.__get_raw_model(model_id)
+
+        records_ids = []
+        for batch in self._batches(records):
+            generated = set()
+
+            def key_exist(record_id):
+                return (record_id in generated or
+                        self._record_exists(model_id, record_id))
+
+            with self._transaction() as db:
+                docs = []
+                for record in batch:
+                    record_id = self._generate_id(key_exist=key_exist)
+                    generated.add(record_id)
+                    record['id'] = record_id
+                    docs.append({'record': record, 'authors': authors})
+                self.__insert_records(db, model_id, docs)
+            records_ids.extend(doc['record']['id'] for doc in docs)
+        return records_ids
+
+    def delete_record(self, model_id, record_id, version=None):
+        with self._transaction() as db:
+            doc = self.__get_raw_record(model_id, record_id)
+            if version is not None and str(doc['version']) != version:
+                raise backend_exceptions.VersionMismatch(record_id)
+            db.execute('DELETE FROM records'
+                       ' WHERE model_id = ? AND record_id = ?',
+                       (model_id, record_id))
+            db.execute('DELETE FROM records_authors'
+                       ' WHERE model_id = ? AND record_id = ?',
+                       (model_id, record_id))
+        return doc
+
+    def delete_records(self, model_id):
+        with self._transaction() as db:
+            records = self.get_records(model_id)
+            db.execute('DELETE FROM records WHERE model_id = ?', (model_id,))
+            db.execute('DELETE FROM records_authors WHERE model_id = ?',
+                       (model_id,))
+        return records
+
+    def delete_model(self, model_id):
+        with self._transaction() as db:
+            doc = self.__get_raw_model(model_id)
+            records = self.delete_records(model_id)
+            db.execute('DELETE FROM models WHERE id = ?', (model_id,))
+            db.execute('DELETE FROM models_readers WHERE model_id = ?',
+                       (model_id,))
+        return {"definition": doc["definition"],
+                "permissions": doc["permissions"],
+                "records": records}
+
+    def get_token(self, credentials_id):
+        """Retrieves a token by its id"""
+        row = self._db.execute('SELECT token FROM credentials WHERE id = ?',
+                               (credentials_id,)).fetchone()
+        if row is None:
+            raise backend_exceptions.CredentialsNotFound(credentials_id)
+        return row[0]
+
+    def get_credentials_key(self, credentials_id):
+        """Retrieves a credentials key by its id"""
+        row = self._db.execute('SELECT key FROM credentials WHERE id = ?',
+                               (credentials_id,)).fetchone()
+        if row is None:
+            raise backend_exceptions.CredentialsNotFound(credentials_id)
+        return row[0]
+
+    def store_credentials(self, token, credentials):
+        assert 'id' in credentials and 'key' in credentials
+        try:
+            with self._transaction() as db:
+                db.execute('INSERT INTO credentials VALUES (?, ?, ?)',
+                           (credentials['id'], token, credentials['key']))
+        except sqlite3.IntegrityError:
+            raise backend_exceptions.CredentialsAlreadyExist(credentials['id'])
@@ -23,6 +23,13 @@ class RecordCreated(object):
         self.request = request
 
 
+class RecordsCreated(object):
+    def __init__(self, model_id, records, request):
+        self.model_id = model_id
+        self.records = records
+        self.request = request
+
+
 class RecordUpdated(object):
     def __init__(self, model_id, record_id, request):
         self.model_id = model_id
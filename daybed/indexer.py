@@ -1,7 +1,14 @@
+import atexit
+import hashlib
 import json
+import os
+import threading
+import time
 
 import elasticsearch
-from elasticsearch.exceptions import RequestError, ElasticsearchException
+from elasticsearch.exceptions import (RequestError, ElasticsearchException,
+                                      NotFoundError)
+from pyramid.settings import asbool
 
 from daybed import logger
 
@@ -13,11 +20,242 @@ class SearchError(Exception):
         self.status_code, self.error, self.info = args[:3]
 
 
+class ReindexError(Exception):
+    """Exception raised when the index filled by a reindex was replaced by
+    another one meanwhile.
+    """
+
+
+def record_as_mapping(definition, record):
+    """Transforms the record to an Elasticsearch document compatible with
+    the mapping built from its model definition.
+    """
+    field_types = {}
+    for field in definition['fields']:
+        field_name = field.get('name')
+        field_type = field['type']
+        field_types[field_name] = field_type
+
+    mapping = record.copy()
+    for key, value in mapping.items():
+        field_type = field_types.get(key)
+        if field_type in ('line', 'polygon'):
+            geojson = {
+                'line': 'Linestring',
+                'polygon': 'Polygon'
+            }
+            mapping[key] = {
+                'type': geojson[field_type],
+                'coordinates': value
+            }
+        if field_type == 'point':
+            mapping[key] = {'lon': value[0], 'lat': value[1]}
+        if field_type == 'list':
+            mapping[key] = json.dumps(value)
+    return mapping
+
+
+# Type of the documents marking the records deleted during a reindex.
+DELETED_TYPE = 'daybed_deleted'
+
+
+def create_actions(model_id, index, definition, records):
+    """Returns the ``_bulk`` actions creating the documents of ``records`` in
+    ``index``.
+    """
+    actions = []
+    for record in records:
+        actions.append({'create': {'_index': index,
+                                   '_type': model_id,
+                                   '_id': record['id']}})
+        actions.append(record_as_mapping(definition, record))
+    return actions
+
+
+class BulkIndexingQueue(object):
+    """Collects indexing actions, and sends them to Elasticsearch by batches
+    through the ``_bulk`` API, from a background thread.
+
+    Batches are sent when ``batch_size`` actions are queued, or every
+    ``flush_interval`` seconds. The queue is drained when closed, at the
+    latest when the process exits.
+
+    If a ``journal`` file is given (one per process), actions are appended
+    to it as they are queued. On flush, it is moved to
+    ``<journal>.pending`` and sent from there: batches that could not be
+    sent, and the actions queued before a crash, are sent again on next
+    flushes, by the next process if needed. Without journal, actions
+    queued when the process is killed are lost: the ``daybed-reindex``
+    command rebuilds the indices of the affected models from the backend.
+    """
+    def __init__(self, client, batch_size=500, flush_interval=1.0,
+                 journal=None):
+        self.client = client
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.journal = journal
+        self._journal_file = None
+        self._actions = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.close)
+
+    def push(self, action, source=None):
+        """Queues an action (and its document for index actions)."""
+        actions = [action] if source is None else [action, source]
+        with self._lock:
+            self._actions.extend(actions)
+            if self.journal:
+                self.__append_journal(actions)
+            full = len(self._actions) >= self.batch_size
+        if full:
+            self._wakeup.set()
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def close(self):
+        """Stops the background thread, and sends the queued actions."""
+        if self._closed:
+            return
+        self._closed = True
+        self._wakeup.set()
+        self._thread.join()
+        self.flush()
+
+    def flush(self):
+        """Sends the queued actions, and the journaled ones if any."""
+        with self._flush_lock:
+            with self._lock:
+                actions, self._actions = self._actions, []
+                if self.journal:
+                    self.__rotate_journal()
+            if not self.journal:
+                if actions and not self.__send(actions):
+                    logger.error("%s indexing actions lost." % len(actions))
+                return
+            # The queued actions are journaled with the previous ones.
+            pending = self.journal + '.pending'
+            if os.path.exists(pending):
+                actions = self.__read_journal(pending)
+                if not actions or self.__send(actions):
+                    os.remove(pending)
+
+    def __send(self, actions):
+        try:
+            response = self.client.bulk(body=actions)
+        except ElasticsearchException as e:
+            logger.error(e)
+            return False
+        if response.get('errors'):
+            logger.error("Some documents could not be indexed: %s" %
+                         [i for i in response['items']
+                          if 'error' in list(i.values())[0]])
+        return True
+
+    def __append_journal(self, actions):
+        if self._journal_file is None:
+            self._journal_file = open(self.journal, 'a')
+        for action in actions:
+            self._journal_file.write(json.dumps(action) + '\n')
+        # Handed to the system, to survive the process.
+        self._journal_file.flush()
+
+    def __rotate_journal(self):
+        """Moves the journaled actions to the pending ones."""
+        if self._journal_file is not None:
+            self._journal_file.close()
+            self._journal_file = None
+        if not os.path.exists(self.journal):
+            return
+        pending = self.journal + '.pending'
+        if not os.path.exists(pending):
+            os.rename(self.journal, pending)
+            return
+        with open(self.journal) as journal, open(pending, 'a') as f:
+            for line in journal:
+                f.write(line)
+        os.remove(self.journal)
+
+    def __read_journal(self, path):
+        with open(path) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+
 class ElasticSearchIndexer(object):
+    """Indexes the records of each model in Elasticsearch.
+
+    Searches and writes go through an alias named after the model, which
+    points to a versioned index (``<alias>_v<version>``). When a model
+    definition changes, its records are copied to a new index with the new
+    mapping by batches of ``reindex_batch_size``, and the alias is swapped
+    once done (see :meth:`reindex`), from a background thread when
+    the model is updated through the API.
+
+    Models are only reindexed if their mapping changed, which is told by
+    its fingerprint kept in the mapping ``_meta``. Updates received while
+    a model is reindexed are coalesced into one more reindex.
+
+    While the new index is filled, a second alias (``<alias>_reindexing``)
+    points to it: every process looks these aliases up from a background
+    thread every ``reindex_delay / 2`` seconds, to write records in both
+    indices. With a ``reindex_delay`` of 0, they are looked up on every
+    write instead.
+    """
+
+    @classmethod
+    def load_from_config(cls, config):
+        from daybed import build_list
 
-    def __init__(self, hosts, prefix):
+        settings = config.registry.settings
+        hosts = build_list(settings.get('elasticsearch.hosts',
+                                        "localhost:9200"))
+        prefix = settings.get('elasticsearch.indices_prefix', 'daybed_')
+        queue_settings = None
+        if asbool(settings.get('elasticsearch.bulk_indexing', False)):
+            queue_settings = dict(
+                batch_size=int(settings.get('elasticsearch.batch_size', 500)),
+                flush_interval=float(
+                    settings.get('elasticsearch.flush_interval', 1.0)),
+                journal=settings.get('elasticsearch.journal')
+            )
+        return ElasticSearchIndexer(
+            hosts, prefix, queue_settings,
+            reindex_batch_size=int(
+                settings.get('elasticsearch.reindex_batch_size', 500)),
+            reindex_delay=float(
+                settings.get('elasticsearch.reindex_delay', 2.0))
+        )
+
+    def __init__(self, hosts, prefix, queue_settings=None,
+                 reindex_batch_size=500, reindex_delay=2.0):
         self.client = elasticsearch.Elasticsearch(hosts)
         self.prefix = lambda x: u'%s_%s' % (prefix, x)
+        self.reindex_batch_size = reindex_batch_size
+        self.reindex_delay = reindex_delay
+        # Without queue, documents are indexed (and refreshed) one by one,
+        # during the request.
+        self.queue = None
+        if queue_settings is not None:
+            self.queue = BulkIndexingQueue(self.client, **queue_settings)
+        # Indices being filled, by reindexing alias, as last looked up by
+        # the watcher thread.
+        self._next_indices = {}
+        self._watcher = None
+        # Reindexes started on models updates, by model id, and the models
+        # updated again meanwhile.
+        self._reindexes = {}
+        self._pending_reindexes = set()
+        self._lock = threading.Lock()
 
     def search(self, model_id, query, params):
         supported_params = ['sort', 'from', 'source', 'fields', 'size']
@@ -33,12 +271,35 @@ class ElasticSearchIndexer(object):
             logger.error(e)  # big fail
             raise
 
+    def versioned_index(self, model_id, version):
+        return u'%s_v%s' % (self.prefix(model_id), version)
+
+    def current_index(self, model_id):
+        """Returns the index behind the model alias, and its version.
+
+        The index is ``None`` if there is none, and the version is ``0`` if
+        it is not versioned (created before aliases were used).
+        """
+        alias = self.prefix(model_id)
+        try:
+            indices = list(self.client.indices.get_alias(name=alias).keys())
+        except NotFoundError:
+            indices = []
+        if indices:
+            index = indices[0]
+            return index, int(index.rsplit('_v', 1)[1])
+        if self.client.indices.exists(index=alias):
+            return alias, 0
+        return None, 0
+
     def on_model_created(self, event):
-        indexname = self.prefix(event.model_id)
+        alias = self.prefix(event.model_id)
         try:
-            if not self.client.indices.exists(index=indexname):
+            if not self.client.indices.exists(index=alias):
                 logger.debug("Create index for model '%s'" % event.model_id)
-                self.client.indices.create(index=self.prefix(event.model_id))
+                index = self.versioned_index(event.model_id, 1)
+                self.client.indices.create(index=index)
+                self.client.indices.put_alias(index=index, name=alias)
         except ElasticsearchException as e:
             logger.error(e)
 
@@ -47,19 +308,251 @@ class ElasticSearchIndexer(object):
         self.__put_mapping(event.model_id, definition)
 
     def on_model_updated(self, event):
-        logger.debug("Update mapping of model '%s'" % event.model_id)
+        model_id = event.model_id
+        with self._lock:
+            if model_id in self._reindexes:
+                # Reindexed again once the running reindex is done.
+                self._pending_reindexes.add(model_id)
+                return
+            # Out of the request, with the backend shared by requests.
+            thread = threading.Thread(target=self.__reindex,
+                                      args=(event.request.registry.backend,
+                                            model_id))
+            thread.daemon = True
+            self._reindexes[model_id] = thread
+        thread.start()
+
+    def __reindex(self, db, model_id):
+        while True:
+            try:
+                definition = db.get_model_definition(model_id)
+                if self.mapping_changed(model_id, definition):
+                    logger.debug("Reindex records of model '%s'" % model_id)
+                    self.reindex(db, model_id)
+            except Exception as e:
+                logger.error(e)
+            with self._lock:
+                if model_id not in self._pending_reindexes:
+                    del self._reindexes[model_id]
+                    return
+                self._pending_reindexes.remove(model_id)
+
+    def wait_reindexes(self):
+        """Waits until the reindexes started on models updates are done."""
+        with self._lock:
+            threads = list(self._reindexes.values())
+        for thread in threads:
+            thread.join()
+
+    def mapping_changed(self, model_id, definition):
+        """Tells if the mapping of the ``definition`` differs from the one
+        of the model index.
+        """
+        meta = self._definition_as_mapping(definition)['_meta']
         try:
-            self.client.indices.delete_mapping(
-                index=self.prefix(event.model_id),
-                doc_type=event.model_id
-            )
+            mappings = self.client.indices.get_mapping(
+                index=self.prefix(model_id), doc_type=model_id)
+        except NotFoundError:
+            return True
+        for index_mappings in mappings.values():
+            mapping = index_mappings.get('mappings', {}).get(model_id, {})
+            return mapping.get('_meta') != meta
+        return True
+
+    def reindex(self, db, model_id, progress=None):
+        """Copies the records of the model from the backend ``db`` to a new
+        index, with the mapping of its current definition, then points the
+        model alias to it. Searches are served by the previous index until
+        then.
+
+        Records written meanwhile, by any process, are indexed in both. The
+        number of records copied is returned, and passed to ``progress``
+        after each batch if given.
+        """
+        definition = db.get_model_definition(model_id)
+        previous, index = self.create_next_index(model_id, definition)
+        try:
+            count = 0
+            cursor = None
+            while True:
+                results, cursor = db.get_paginated_records(
+                    model_id, self.reindex_batch_size, cursor)
+                records = [r['record'] for r in results]
+                self.bulk_create(create_actions(model_id, index, definition,
+                                                records))
+                count += len(results)
+                if progress is not None:
+                    progress(count)
+                if cursor is None:
+                    break
+            self.switch_index(model_id, previous, index)
+        except Exception:
+            self.client.indices.delete(index=index, ignore=404)
+            raise
+
+        logger.debug("Reindexed %s records of model '%s' in %s" %
+                     (count, model_id, index))
+        return count
+
+    def reindexing_alias(self, model_id):
+        return u'%s_reindexing' % self.prefix(model_id)
+
+    def next_index(self, model_id):
+        """Returns the index being filled by a reindex of the model, or
+        ``None``.
+        """
+        try:
+            indices = list(self.client.indices.get_alias(
+                name=self.reindexing_alias(model_id)).keys())
+        except NotFoundError:
+            indices = []
+        return indices[0] if indices else None
+
+    def __lookup_next_indices(self):
+        """Looks up the indices being filled by reindexes of any model."""
+        try:
+            aliases = self.client.indices.get_alias(
+                name=self.reindexing_alias('*'))
+        except NotFoundError:
+            aliases = {}
+        next_indices = {}
+        for index, info in aliases.items():
+            for alias in info.get('aliases', {}):
+                next_indices[alias] = index
+        self._next_indices = next_indices
+
+    def __watch_next_indices(self):
+        while True:
+            time.sleep(self.reindex_delay / 2)
+            try:
+                self.__lookup_next_indices()
+            except ElasticsearchException as e:
+                logger.error(e)
+
+    def __start_watcher(self):
+        with self._lock:
+            if self._watcher is not None:
+                return
+            # Looked up once before the first write.
+            self._watcher = threading.Thread(
+                target=self.__watch_next_indices)
+            self._watcher.daemon = True
+            try:
+                self.__lookup_next_indices()
+            finally:
+                self._watcher.start()
+
+    def create_next_index(self, model_id, definition):
+        """Creates the next version of the model index, with the mapping of
+        the ``definition``, and points the reindexing alias to it.
+
+        An index left by an unfinished reindex is deleted. Returns once
+        every process writes records in the new index, with the index
+        currently behind the model alias, and the new one.
+        """
+        previous, version = self.current_index(model_id)
+        unfinished = self.next_index(model_id)
+        if unfinished is not None:
+            logger.warning("Discard index %s of an unfinished reindex" %
+                           unfinished)
+            version = max(version, int(unfinished.rsplit('_v', 1)[1]))
+            self.client.indices.delete(index=unfinished, ignore=404)
+        index = self.versioned_index(model_id, version + 1)
+        # Could have been created again by late writes.
+        self.client.indices.delete(index=index, ignore=404)
+        self.client.indices.create(index=index, body={
+            'mappings': {model_id: self._definition_as_mapping(definition)},
+            'aliases': {self.reindexing_alias(model_id): {}}
+        })
+        # Records written before other processes see the new index are
+        # read from the backend afterwards.
+        time.sleep(self.reindex_delay)
+        return previous, index
+
+    def bulk_create(self, actions):
+        """Sends ``_bulk`` actions built with :func:`create_actions`.
+        Documents that already exist are left untouched, and those of
+        records deleted meanwhile are removed.
+        """
+        if not actions:
+            return
+        response = self.client.bulk(body=actions)
+        if response.get('errors'):
+            failed = [item for item in response['items']
+                      if item['create'].get('status') != 409]
+            if failed:
+                logger.error("Some documents could not be reindexed: %s" %
+                             failed)
+
+        # Writers mark deleted records before deleting their documents:
+        # those deleted before being created here are marked.
+        created = [action['create'] for action in actions[::2]]
+        index = created[0]['_index']
+        response = self.client.mget(index=index, doc_type=DELETED_TYPE,
+                                    body={'ids': [c['_id'] for c in created]})
+        deleted = set(doc['_id'] for doc in response['docs']
+                      if doc.get('found'))
+        actions = [{'delete': c} for c in created if c['_id'] in deleted]
+        if actions:
+            self.client.bulk(body=actions)
+
+    def switch_index(self, model_id, previous, index):
+        """Points the model alias to ``index`` instead of ``previous``, and
+        deletes the latter.
+
+        Raises :class:`ReindexError` if ``index`` is no longer the one being
+        filled.
+        """
+        alias = self.prefix(model_id)
+        reindexing_alias = self.reindexing_alias(model_id)
+        if self.next_index(model_id) != index:
+            raise ReindexError("Index %s of model '%s' was replaced by "
+                               "another reindex." % (index, model_id))
+        self.client.indices.refresh(index=index)
+        actions = [{'remove': {'index': index, 'alias': reindexing_alias}},
+                   {'add': {'index': index, 'alias': alias}}]
+        if previous == alias:
+            # Indices created before aliases were used are named after the
+            # model: the alias can only be created once it is deleted.
+            self.client.indices.delete(index=previous)
+            previous = None
+        elif previous is not None:
+            actions.insert(0, {'remove': {'index': previous,
+                                          'alias': alias}})
+        self.client.indices.update_aliases(body={'actions': actions})
+        if previous is not None:
+            self.client.indices.delete(index=previous, ignore=404)
+
+    def _indices(self, model_id):
+        """Returns the indices where records of the model are written: the
+        model alias, and the index being filled if any.
+        """
+        try:
+            if self.reindex_delay:
+                self.__start_watcher()
+                index = self._next_indices.get(
+                    self.reindexing_alias(model_id))
+            else:
+                index = self.next_index(model_id)
         except ElasticsearchException as e:
             logger.error(e)
-        definition = event.request.db.get_model_definition(event.model_id)
-        self.__put_mapping(event.model_id, definition)
+            index = None
+        if index is None:
+            return [self.prefix(model_id)]
+        return [self.prefix(model_id), index]
 
     def on_model_deleted(self, event):
         logger.debug("Delete index of model '%s'" % event.model_id)
+        if self.queue is not None:
+            # Pending actions would create the index again.
+            self.queue.flush()
+        try:
+            # The index filled by an unfinished reindex too.
+            index = self.next_index(event.model_id)
+            if index is not None:
+                self.client.indices.delete(index=index, ignore=404)
+        except ElasticsearchException as e:
+            logger.error(e)
         try:
             self.client.indices.delete(index=self.prefix(event.model_id))
         except ElasticsearchException as e:
@@ -72,6 +565,31 @@ class ElasticSearchIndexer(object):
         record = event.request.db.get_record(event.model_id, event.record_id)
         self.__index(event.model_id, definition, event.record_id, record)
 
+    def on_records_created(self, event):
+        logger.debug("Index %s records of model '%s'" % (len(event.records),
+                                                         event.model_id))
+        definition = event.request.db.get_model_definition(event.model_id)
+        if self.queue is not None:
+            for record in event.records:
+                self.__index(event.model_id, definition, record['id'], record)
+            return
+
+        actions = []
+        for index in self._indices(event.model_id):
+            for record in event.records:
+                actions.append({'index': {'_index': index,
+                                          '_id': record['id']}})
+                actions.append(self._record_as_mapping(definition, record))
+        if not actions:
+            return
+        try:
+            self.client.bulk(index=self.prefix(event.model_id),
+                             doc_type=event.model_id,
+                             body=actions,
+                             refresh=True)
+        except ElasticsearchException as e:
+            logger.error(e)
+
     def on_record_updated(self, event):
         logger.debug("Reindex record %s of model '%s'" % (event.record_id,
                                                           event.model_id))
@@ -82,11 +600,33 @@ class ElasticSearchIndexer(object):
     def on_record_deleted(self, event):
         logger.debug("Unindex record %s of model '%s'" % (event.record_id,
                                                           event.model_id))
+        alias = self.prefix(event.model_id)
+        for index in self._indices(event.model_id):
+            if index != alias:
+                # Not to be copied if read before being deleted.
+                self.__mark_deleted(index, event.record_id)
+            if self.queue is not None:
+                self.queue.push({'delete': {'_index': index,
+                                            '_type': event.model_id,
+                                            '_id': event.record_id}})
+                continue
+            try:
+                self.client.delete(index=index,
+                                   doc_type=event.model_id,
+                                   id=event.record_id,
+                                   refresh=True)
+            except ElasticsearchException as e:
+                logger.error(e)
+
+    def __mark_deleted(self, index, record_id):
+        if self.queue is not None:
+            self.queue.push({'index': {'_index': index,
+                                       '_type': DELETED_TYPE,
+                                       '_id': record_id}}, {})
+            return
         try:
-            self.client.delete(index=self.prefix(event.model_id),
-                               doc_type=event.model_id,
-                               id=event.record_id,
-                               refresh=True)
+            self.client.index(index=index, doc_type=DELETED_TYPE,
+                              id=record_id, body={})
         except ElasticsearchException as e:
             logger.error(e)
 
@@ -122,15 +662,21 @@ class ElasticSearchIndexer(object):
         the mapping built from its model definition.
         """
         mapping_record = self._record_as_mapping(definition, record)
-        try:
-            index = self.client.index(index=self.prefix(model_id),
-                                      doc_type=model_id,
-                                      id=record_id,
-                                      body=mapping_record,
-                                      refresh=True)
-            return index
-        except ElasticsearchException as e:
-            logger.error(e)
+        for index in self._indices(model_id):
+            if self.queue is not None:
+                self.queue.push({'index': {'_index': index,
+                                           '_type': model_id,
+                                           '_id': record_id}},
+                                mapping_record)
+                continue
+            try:
+                self.client.index(index=index,
+                                  doc_type=model_id,
+                                  id=record_id,
+                                  body=mapping_record,
+                                  refresh=True)
+            except ElasticsearchException as e:
+                logger.error(e)
 
     def _definition_as_mapping(self, definition):
         fields = definition['fields']
@@ -165,32 +711,14 @@ class ElasticSearchIndexer(object):
                 mappings[fieldname] = mapping
             return mappings
 
+        properties = field_list(fields)
+        fingerprint = hashlib.sha1(
+            json.dumps(properties, sort_keys=True).encode('utf-8'))
         mapping = {
-            'properties': field_list(fields)
+            'properties': properties,
+            '_meta': {'daybed_mapping': fingerprint.hexdigest()}
         }
         return mapping
 
     def _record_as_mapping(self, definition, record):
-        field_types = {}
-        for field in definition['fields']:
-            field_name = field.get('name')
-            field_type = field['type']
-            field_types[field_name] = field_type
-
-        mapping = record.copy()
-        for key, value in mapping.items():
-            field_type = field_types.get(key)
-            if field_type in ('line', 'polygon'):
-                geojson = {
-                    'line': 'Linestring',
-                    'polygon': 'Polygon'
-                }
-                mapping[key] = {
-                    'type': geojson[field_type],
-                    'coordinates': value
-                }
-            if field_type == 'point':
-                mapping[key] = {'lon': value[0], 'lat': value[1]}
-            if field_type == 'list':
-                mapping[key] = json.dumps(value)
-        return mapping
+        return record_as_mapping(definition, record)
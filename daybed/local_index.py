@@ -0,0 +1,510 @@
+"""An in-process search engine, answering the most common subset of the
+Elasticsearch query DSL (``match_all``, ``term``, ``terms``, ``match``,
+``range``, ``bool`` and ``filtered`` queries, ``sort``, ``from`` and
+``size``) with the same response shape.
+
+Records are kept in memory, in an inverted index of their terms and in
+sorted indexes of their values per field. The index of a model is built
+from the backend the first time it is needed, and then maintained from
+the API events.
+
+The indexes live in the memory of each process, and only follow the
+records written through it: the application must be served by a single
+process (one worker) when it is used.
+"""
+import bisect
+import heapq
+import json
+import math
+import numbers
+import re
+import threading
+import time
+from collections import defaultdict, OrderedDict
+
+import six
+
+from daybed import logger
+from daybed.backends.exceptions import ModelNotFound
+from daybed.indexer import SearchError, record_as_mapping
+
+
+WORDS = re.compile(r'\w+', re.UNICODE)
+
+
+class QueryError(ValueError):
+    """Raised when a query is invalid or not supported."""
+
+
+def analyze(text):
+    """Splits a text into lowercase terms."""
+    return [word.lower() for word in WORDS.findall(text)]
+
+
+def flatten(document, prefix=''):
+    """Yields the ``(field, value)`` leaves of a document. Fields of objects
+    are named with dots, and lists give one leaf per item.
+    """
+    for key, value in six.iteritems(document):
+        name = prefix + key
+        for item in (value if isinstance(value, list) else [value]):
+            if isinstance(item, dict):
+                for leaf in flatten(item, name + '.'):
+                    yield leaf
+            elif item is not None:
+                yield name, item
+
+
+def value_terms(value):
+    """Returns the terms a value is found with."""
+    if isinstance(value, six.string_types):
+        return set(analyze(value))
+    return set([value])
+
+
+def sort_key(value):
+    """Returns the key a value is ordered with, ``None`` if it cannot be.
+    Numbers come before strings (dates are ISO 8601 strings).
+    """
+    if isinstance(value, six.string_types):
+        return (1, value)
+    if isinstance(value, numbers.Number):
+        return (0, value)
+    return None
+
+
+def as_list(clauses):
+    if isinstance(clauses, dict):
+        return [clauses]
+    return list(clauses or [])
+
+
+def single_field(params, kind):
+    if not isinstance(params, dict) or len(params) != 1:
+        raise QueryError("%s query expects a single field" % kind)
+    return list(params.items())[0]
+
+
+class ModelIndex(object):
+    """The documents of a model, their terms and their sorted values."""
+
+    def __init__(self, definition=None):
+        # The model definition the documents were mapped with.
+        self.definition = definition
+        self.documents = {}
+        # field -> term -> documents ids
+        self.terms = defaultdict(dict)
+        # field -> (sorted keys, documents ids in the same order)
+        self.values = defaultdict(lambda: ([], []))
+
+    def add(self, doc_id, source):
+        for field, key in self.__add_terms(doc_id, source):
+            keys, ids = self.values[field]
+            position = bisect.bisect_right(keys, key)
+            keys.insert(position, key)
+            ids.insert(position, doc_id)
+
+    def extend(self, documents):
+        """Adds the ``(doc_id, source)`` pairs at once: the values of each
+        field are sorted once, instead of being inserted one by one.
+        """
+        values = defaultdict(list)
+        for doc_id, source in OrderedDict(documents).items():
+            for field, key in self.__add_terms(doc_id, source):
+                values[field].append((key, doc_id))
+        for field, pairs in six.iteritems(values):
+            keys, ids = self.values[field]
+            pairs = list(zip(keys, ids)) + pairs
+            # Stable: documents with equal values stay in insertion order.
+            pairs.sort(key=lambda pair: pair[0])
+            self.values[field] = ([pair[0] for pair in pairs],
+                                  [pair[1] for pair in pairs])
+
+    def __add_terms(self, doc_id, source):
+        """Indexes the terms of the document, and returns the ``(field,
+        sort key)`` of its values to be added to the sorted ones.
+        """
+        self.remove(doc_id)
+        self.documents[doc_id] = source
+        keys = []
+        for field, value in flatten(source):
+            terms = self.terms[field]
+            for term in value_terms(value):
+                terms.setdefault(term, set()).add(doc_id)
+            key = sort_key(value)
+            if key is not None:
+                keys.append((field, key))
+        return keys
+
+    def remove(self, doc_id):
+        source = self.documents.pop(doc_id, None)
+        if source is None:
+            return
+        for field, value in flatten(source):
+            terms = self.terms[field]
+            for term in value_terms(value):
+                ids = terms.get(term)
+                if ids is not None:
+                    ids.discard(doc_id)
+                    if not ids:
+                        del terms[term]
+            key = sort_key(value)
+            if key is not None:
+                keys, ids = self.values[field]
+                position = bisect.bisect_left(keys, key)
+                while position < len(keys) and keys[position] == key:
+                    if ids[position] == doc_id:
+                        del keys[position]
+                        del ids[position]
+                        break
+                    position += 1
+
+    def __idf(self, matching):
+        return 1.0 + math.log(float(len(self.documents)) / (1 + matching))
+
+    def query(self, clause):
+        """Returns the scores of the documents matching the query clause, by
+        document id.
+        """
+        if not isinstance(clause, dict) or len(clause) != 1:
+            raise QueryError("Invalid query clause: %r" % (clause,))
+        kind, params = list(clause.items())[0]
+        method = getattr(self, '_query_%s' % kind, None)
+        if method is None:
+            raise QueryError("Unsupported query: %s" % kind)
+        return method(params)
+
+    def _query_match_all(self, params):
+        return dict.fromkeys(self.documents, 1.0)
+
+    def _query_term(self, params):
+        field, value = single_field(params, "term")
+        if isinstance(value, dict):
+            value = value.get('value')
+        ids = self.terms[field].get(value, ())
+        return dict.fromkeys(ids, self.__idf(len(ids)))
+
+    def _query_terms(self, params):
+        field, values = single_field(params, "terms")
+        scores = {}
+        for value in as_list(values):
+            scores.update(self._query_term({field: value}))
+        return scores
+
+    def _query_match(self, params):
+        field, value = single_field(params, "match")
+        operator = 'or'
+        if isinstance(value, dict):
+            operator = value.get('operator', 'or').lower()
+            value = value.get('query')
+        terms = value_terms(value)
+        scores = {}
+        for term in terms:
+            for doc_id, score in six.iteritems(
+                    self._query_term({field: term})):
+                scores[doc_id] = scores.get(doc_id, 0) + score
+        if operator == 'and':
+            matching = [self.terms[field].get(term, set()) for term in terms]
+            common = set.intersection(*matching) if matching else set()
+            scores = dict((doc_id, score) for doc_id, score
+                          in six.iteritems(scores) if doc_id in common)
+        return scores
+
+    def _query_range(self, params):
+        field, bounds = single_field(params, "range")
+        keys, ids = self.values[field]
+        start, end = 0, len(keys)
+        for name, bound in six.iteritems(bounds):
+            key = sort_key(bound)
+            if key is None:
+                raise QueryError("Invalid %s bound: %r" % (name, bound))
+            if name == 'gte':
+                start = max(start, bisect.bisect_left(keys, key))
+            elif name == 'gt':
+                start = max(start, bisect.bisect_right(keys, key))
+            elif name == 'lte':
+                end = min(end, bisect.bisect_right(keys, key))
+            elif name == 'lt':
+                end = min(end, bisect.bisect_left(keys, key))
+            else:
+                raise QueryError("Unsupported range parameter: %s" % name)
+        return dict.fromkeys(ids[start:end], 1.0)
+
+    def _query_bool(self, params):
+        must = as_list(params.get('must'))
+        filters = as_list(params.get('filter'))
+        should = as_list(params.get('should'))
+        must_not = as_list(params.get('must_not'))
+        minimum = int(params.get('minimum_should_match',
+                                 0 if must or filters else 1))
+
+        scores = None
+        for clause in must + filters:
+            matching = self.query(clause)
+            scored = clause in must
+            if scores is None:
+                scores = matching if scored else dict.fromkeys(matching, 0.0)
+                continue
+            scores = dict((doc_id, score + (matching[doc_id] if scored
+                                            else 0.0))
+                          for doc_id, score in six.iteritems(scores)
+                          if doc_id in matching)
+        if scores is None:
+            if should:
+                scores = dict.fromkeys(self.documents, 0.0)
+            else:
+                scores = self._query_match_all({})
+
+        if should:
+            matched = defaultdict(int)
+            for clause in should:
+                for doc_id, score in six.iteritems(self.query(clause)):
+                    if doc_id in scores:
+                        scores[doc_id] += score
+                        matched[doc_id] += 1
+            scores = dict((doc_id, score) for doc_id, score
+                          in six.iteritems(scores)
+                          if matched[doc_id] >= minimum)
+
+        for clause in must_not:
+            for doc_id in self.query(clause):
+                scores.pop(doc_id, None)
+        return scores
+
+    def _query_filtered(self, params):
+        scores = self.query(params.get('query', {'match_all': {}}))
+        if 'filter' in params:
+            matching = self.query(params['filter'])
+            scores = dict((doc_id, score) for doc_id, score
+                          in six.iteritems(scores) if doc_id in matching)
+        return scores
+
+    def __value(self, doc_id, field, descending):
+        """Returns the sort key of the document for a field: its smallest
+        value, or its largest one in descending order.
+        """
+        keys = [sort_key(value) for name, value
+                in flatten(self.documents[doc_id]) if name == field]
+        keys = [key for key in keys if key is not None]
+        if not keys:
+            return None
+        return max(keys) if descending else min(keys)
+
+    def sort(self, scores, sort, limit):
+        """Returns the ids of the first ``limit`` matching documents, in the
+        order given by the ``sort`` specifications (by score if none).
+        """
+        if not sort:
+            return heapq.nsmallest(limit, scores,
+                                   key=lambda i: (-scores[i], i))
+
+        if len(sort) == 1 and sort[0][0] != '_score':
+            # Walk the sorted values of the field.
+            field, descending = sort[0]
+            keys, ids = self.values[field]
+            ordered = reversed(ids) if descending else ids
+            result = []
+            seen = set()
+            for doc_id in ordered:
+                if len(result) >= limit:
+                    return result
+                if doc_id in scores and doc_id not in seen:
+                    seen.add(doc_id)
+                    result.append(doc_id)
+            # Documents without value come last.
+            missing = sorted(set(scores) - seen)
+            return result + missing[:max(0, limit - len(result))]
+
+        ordered = sorted(scores)
+        for field, descending in reversed(sort):
+            if field == '_score':
+                ordered.sort(key=lambda i: scores[i], reverse=descending)
+                continue
+            values = dict((i, self.__value(i, field, descending))
+                          for i in ordered)
+            # Missing values come last, in both orders.
+            present = [i for i in ordered if values[i] is not None]
+            absent = [i for i in ordered if values[i] is None]
+            present.sort(key=lambda i: values[i], reverse=descending)
+            ordered = present + absent
+        return ordered[:limit]
+
+    def sort_values(self, doc_id, sort, scores):
+        values = []
+        for field, descending in sort:
+            if field == '_score':
+                values.append(scores[doc_id])
+                continue
+            key = self.__value(doc_id, field, descending)
+            values.append(key[1] if key is not None else None)
+        return values
+
+
+def parse_sort(sort):
+    """Returns ``[(field, descending)]`` from the ``sort`` of the body, or
+    of the querystring (``field:desc,other``).
+    """
+    if isinstance(sort, six.string_types):
+        specs = []
+        for spec in sort.split(','):
+            field, _, order = spec.strip().partition(':')
+            specs.append((field, order.lower() == 'desc'))
+        return specs
+
+    specs = []
+    for spec in as_list(sort):
+        if isinstance(spec, six.string_types):
+            specs.append((spec, spec == '_score'))
+            continue
+        field, order = single_field(spec, "sort")
+        if isinstance(order, dict):
+            order = order.get('order', 'asc')
+        specs.append((field, order.lower() == 'desc'))
+    return specs
+
+
+class LocalIndexer(object):
+    """Indexes records in memory, and searches them without Elasticsearch.
+
+    The indexes of models are built from the backend ``db`` when first
+    needed, for example after a restart, under a lock of their own: other
+    models can be searched meanwhile. Records written by other processes
+    are not indexed: see the module documentation.
+    """
+
+    @classmethod
+    def load_from_config(cls, config):
+        return LocalIndexer(db=config.registry.backend)
+
+    def __init__(self, db=None):
+        self.db = db
+        self._models = {}
+        # Locks of the models, and of this dict.
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def __model_lock(self, model_id):
+        with self._lock:
+            return self._locks.setdefault(model_id, threading.Lock())
+
+    def __model_index(self, model_id, db=None):
+        """Returns the index of the model, built from the backend if needed.
+        The lock of the model must be held.
+        """
+        index = self._models.get(model_id)
+        if index is None:
+            index = ModelIndex()
+            db = db or self.db
+            if db is not None:
+                self.__fill(index, db, model_id)
+            self._models[model_id] = index
+        return index
+
+    def __fill(self, index, db, model_id):
+        try:
+            definition = index.definition = db.get_model_definition(model_id)
+            documents = []
+            cursor = None
+            while True:
+                results, cursor = db.get_paginated_records(model_id, 1000,
+                                                           cursor)
+                for result in results:
+                    record = result['record']
+                    documents.append((record['id'],
+                                      record_as_mapping(definition, record)))
+                if cursor is None:
+                    break
+            index.extend(documents)
+        except ModelNotFound:
+            pass
+        logger.debug("Indexed %s records of model '%s'" %
+                     (len(index.documents), model_id))
+
+    def search(self, model_id, query, params):
+        try:
+            body = json.loads(query) if query else {}
+            if not isinstance(body, dict):
+                raise QueryError("The query must be an object")
+            size = int(params.get('size', body.get('size', 10)))
+            start = int(params.get('from', body.get('from', 0)))
+            sort = parse_sort(params.get('sort', body.get('sort')))
+        except (ValueError, AttributeError) as e:
+            raise SearchError(400, 'SearchParseException', six.text_type(e))
+
+        started = time.time()
+        with self.__model_lock(model_id):
+            index = self.__model_index(model_id)
+            try:
+                scores = index.query(body.get('query', {'match_all': {}}))
+            except (QueryError, AttributeError, TypeError) as e:
+                raise SearchError(400, 'QueryParsingException',
+                                  six.text_type(e))
+            hits = []
+            for doc_id in index.sort(scores, sort, start + size)[start:]:
+                hit = {'_index': model_id,
+                       '_type': model_id,
+                       '_id': doc_id,
+                       '_score': None if sort else scores[doc_id],
+                       '_source': index.documents[doc_id]}
+                if sort:
+                    hit['sort'] = index.sort_values(doc_id, sort, scores)
+                hits.append(hit)
+
+        return {
+            'took': int((time.time() - started) * 1000),
+            'timed_out': False,
+            '_shards': {'total': 1, 'successful': 1, 'failed': 0},
+            'hits': {
+                'total': len(scores),
+                'max_score': (max(scores.values())
+                              if scores and not sort else None),
+                'hits': hits
+            }
+        }
+
+    def __index_records(self, db, model_id, records):
+        """Indexes the ``(record_id, record)`` pairs, with the definition
+        the index was built with.
+        """
+        with self.__model_lock(model_id):
+            index = self.__model_index(model_id, db)
+            if index.definition is None:
+                index.definition = db.get_model_definition(model_id)
+            for record_id, record in records:
+                index.add(record_id,
+                          record_as_mapping(index.definition, record))
+
+    def on_model_created(self, event):
+        with self.__model_lock(event.model_id):
+            self.__model_index(event.model_id, event.request.db)
+
+    def on_model_updated(self, event):
+        logger.debug("Rebuild index of model '%s'" % event.model_id)
+        with self.__model_lock(event.model_id):
+            self._models.pop(event.model_id, None)
+            self.__model_index(event.model_id, event.request.db)
+
+    def on_model_deleted(self, event):
+        with self.__model_lock(event.model_id):
+            self._models.pop(event.model_id, None)
+
+    def on_record_created(self, event):
+        # The record as validated and written by the view.
+        self.__index_records(event.request.db, event.model_id,
+                             [(event.record_id, event.request.data_clean)])
+
+    def on_records_created(self, event):
+        self.__index_records(event.request.db, event.model_id,
+                             [(r['id'], r) for r in event.records])
+
+    on_record_updated = on_record_created
+
+    def on_record_deleted(self, event):
+        with self.__model_lock(event.model_id):
+            index = self._models.get(event.model_id)
+            if index is not None:
+                index.remove(event.record_id)
+
+    def delete_indices(self):
+        with self._lock:
+            self._models.clear()
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 from collections import defaultdict
+
 from six import iteritems
 from pyramid.interfaces import IAuthorizationPolicy
 from pyramid.security import Authenticated, Everyone
@@ -19,6 +20,78 @@ PERMISSIONS_SET = set([
 ])
 
 
+# Permissions granted by the authorization policy settings.
+POLICY_PERMISSIONS_SET = set([
+    'create_model', 'create_token', 'manage_token', 'manage_tokens'
+])
+
+
+# Sets of permissions are handled as integers, with a bit per permission.
+PERMISSIONS_BITS = dict(
+    (name, 1 << i) for i, name in
+    enumerate(sorted(PERMISSIONS_SET | POLICY_PERMISSIONS_SET)))
+
+# Permissions names of the bitmasks met so far.
+_masks_permissions = {}
+
+
+def permission_bit(name):
+    """Returns the bit of the permission ``name``."""
+    return PERMISSIONS_BITS[name]
+
+
+def permissions_mask(names):
+    """Returns the bitmask of the permissions ``names``."""
+    mask = 0
+    for name in names:
+        mask |= permission_bit(name)
+    return mask
+
+
+def mask_permissions(mask):
+    """Returns the frozen set of permissions names of a bitmask."""
+    try:
+        return _masks_permissions[mask]
+    except KeyError:
+        names = frozenset(name for name, bit in PERMISSIONS_BITS.items()
+                          if mask & bit)
+        return _masks_permissions.setdefault(mask, names)
+
+
+def permissions_matrix(permissions):
+    """Compiles the model permissions ``{perm: [credentials_ids]}`` into
+    ``{credentials_id: bitmask}``. Unknown permissions grant nothing, and
+    are left out.
+    """
+    matrix = defaultdict(int)
+    for perm, credentials_ids in iteritems(permissions):
+        bit = PERMISSIONS_BITS.get(perm, 0)
+        for credentials_id in credentials_ids:
+            matrix[credentials_id] |= bit
+    return dict(matrix)
+
+
+def model_permissions_mask(db, model_id, principals):
+    """Returns the bitmask of the model permissions granted to the
+    ``principals``.
+
+    Backends that keep the permissions compiled (see
+    :class:`daybed.backends.cache.CachedBackend` and
+    :class:`daybed.backends.cache.RequestBackend`) are only asked for the
+    permissions matrix, otherwise it is compiled here.
+    """
+    try:
+        get_matrix = db.get_model_permissions_matrix
+    except AttributeError:
+        matrix = permissions_matrix(db.get_model_permissions(model_id))
+    else:
+        matrix = get_matrix(model_id)
+    mask = 0
+    for principal in principals:
+        mask |= matrix.get(principal, 0)
+    return mask
+
+
 def default_model_permissions(credentials_id):
     """ Give all permissions to the model creator.
     Permissions of models created by anonymous (i.e. ``Everyone``)
@@ -67,6 +140,15 @@ def merge_permissions(original, specified):
     return dict_set2list(permissions)
 
 
+def _split(perms):
+    """Returns the bitmask of the permissions names, and the compiled
+    nested conditions.
+    """
+    names = [perm for perm in perms if not hasattr(perm, 'compile')]
+    nested = [perm.compile() for perm in perms if hasattr(perm, 'compile')]
+    return permissions_mask(names), nested
+
+
 class Any(list):
     def matches(self, permissions):
         check = False
@@ -77,6 +159,16 @@ class Any(list):
                 check |= perm in permissions
         return check
 
+    def compile(self):
+        """Returns a predicate on permissions bitmasks."""
+        accepted, nested = _split(self)
+
+        def matches(mask):
+            if mask & accepted:
+                return True
+            return any(predicate(mask) for predicate in nested)
+        return matches
+
 
 class All(list):
     def matches(self, permissions):
@@ -88,9 +180,20 @@ class All(list):
                 check &= perm in permissions
         return check
 
+    def compile(self):
+        """Returns a predicate on permissions bitmasks."""
+        required, nested = _split(self)
+
+        def matches(mask):
+            if mask & required != required:
+                return False
+            return all(predicate(mask) for predicate in nested)
+        return matches
+
 
 AUTHORS_PERMISSIONS = set(['update_own_records', 'delete_own_records',
                            'read_own_records'])
+AUTHORS_MASK = permissions_mask(AUTHORS_PERMISSIONS)
 
 VIEWS_PERMISSIONS_REQUIRED = {
     'get_models':      All(),
@@ -118,6 +221,10 @@ VIEWS_PERMISSIONS_REQUIRED = {
     'delete_token':    All(['manage_tokens']),
 }
 
+VIEWS_PERMISSIONS_PREDICATES = dict(
+    (view, required.compile())
+    for view, required in iteritems(VIEWS_PERMISSIONS_REQUIRED))
+
 
 @implementer(IAuthorizationPolicy)
 class DaybedAuthorizationPolicy(object):
@@ -150,46 +257,40 @@ class DaybedAuthorizationPolicy(object):
         principals has access to the given permission.
         """
         principals = set(principals)
-        permissions_required = VIEWS_PERMISSIONS_REQUIRED[permission]
-        current_permissions = set()
+        matches = VIEWS_PERMISSIONS_PREDICATES[permission]
+        mask = 0
 
-        if principals.intersection(self.model_creators):
-            current_permissions.add("create_model")
+        if not principals.isdisjoint(self.model_creators):
+            mask |= permission_bit("create_model")
 
-        if principals.intersection(self.token_creators):
-            current_permissions.add("create_token")
+        if not principals.isdisjoint(self.token_creators):
+            mask |= permission_bit("create_token")
 
-        if principals.intersection(self.token_managers):
-            current_permissions.add("manage_token")
+        if not principals.isdisjoint(self.token_managers):
+            mask |= permission_bit("manage_token")
 
         model_id = context.model_id
         if model_id is not None:
             try:
-                model_permissions = context.db.get_model_permissions(model_id)
+                mask |= model_permissions_mask(context.db, model_id,
+                                               principals)
             except backend_exceptions.ModelNotFound:
-                model_permissions = {}
                 if permission != 'post_model':
                     # Prevent unauthorized error to shadow 404 responses
                     return True
-            finally:
-                for perm_name, credentials_ids in iteritems(model_permissions):
-                    # If one of the principals is in the valid credentials_ids
-                    # for this permission, grant the permission.
-                    if principals.intersection(credentials_ids):
-                        current_permissions.add(perm_name)
 
         # Remove author's permissions if a record is involved, and if it
         # does not belong to the token.
         record_id = context.record_id
-        if record_id is not None:
+        if record_id is not None and mask & AUTHORS_MASK:
             try:
                 authors = context.db.get_record_authors(model_id, record_id)
             except backend_exceptions.RecordNotFound:
                 authors = []
-            finally:
-                if not principals.intersection(authors):
-                    current_permissions -= AUTHORS_PERMISSIONS
+            if principals.isdisjoint(authors):
+                mask &= ~AUTHORS_MASK
 
+        current_permissions = mask_permissions(mask)
         logger.debug("Current permissions: %s", current_permissions)
 
         # Expose permissions and principals for in_view checks
@@ -197,7 +298,7 @@ class DaybedAuthorizationPolicy(object):
         context.request.principals = principals
 
         # Check view permission matches token permissions.
-        return permissions_required.matches(current_permissions)
+        return matches(mask)
 
     def principals_allowed_by_permission(self, context, permission):
         raise NotImplementedError()  # PRAGMA NOCOVER
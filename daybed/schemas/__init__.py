@@ -97,7 +97,8 @@ class TypeField(object):
 
     @classmethod
     def validation(cls, *args, **kwargs):
-        keys = ['name', 'label', 'hint', 'validator', 'missing']
+        keys = ['name', 'label', 'hint', 'validator', 'missing',
+                'preparer']
         specified = [key for key in keys if key in kwargs.keys()]
         options = dict(zip(specified, [kwargs.get(k) for k in specified]))
         # If field is not required, use missing
@@ -3,7 +3,6 @@ import datetime
 
 from pyramid.i18n import TranslationString as _
 from colander import (
-    deferred,
     SchemaNode,
     String,
     OneOf,
@@ -20,6 +19,7 @@ from colander import (
     DateTime,
     Mapping,
     drop,
+    null,
 )
 
 from . import registry, TypeField, TypeFieldNode
@@ -202,8 +202,16 @@ class AutoNowMixin(object):
     def validation(cls, **kwargs):
         autonow = kwargs.get('autonow', cls.autonow)
         if autonow:
-            kwargs['missing'] = cls.auto_value
-        return super(AutoNowMixin, cls).validation(**kwargs).bind()
+            # Resolved on each deserialization, since compiled schemas are
+            # cached.
+            kwargs['preparer'] = cls.auto_prepare
+        return super(AutoNowMixin, cls).validation(**kwargs)
+
+    @classmethod
+    def auto_prepare(cls, value):
+        if value is null:
+            return cls.auto_value()
+        return value
 
 
 @registry.add('date')
@@ -212,8 +220,8 @@ class DateField(AutoNowMixin, TypeField):
     node = Date
     hint = _('A date (yyyy-mm-dd)')
 
-    @deferred
-    def auto_value(node, kw):
+    @staticmethod
+    def auto_value():
         return datetime.date.today()
 
 
@@ -223,8 +231,8 @@ class DateTimeField(AutoNowMixin, TypeField):
     node = DateTime
     hint = _('A date with time (yyyy-mm-ddTHH:MM)')
 
-    @deferred
-    def auto_value(node, kw):
+    @staticmethod
+    def auto_value():
         return datetime.datetime.now()
 
 
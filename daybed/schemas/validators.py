@@ -1,9 +1,15 @@
 from __future__ import absolute_import
 from functools import partial
 from copy import deepcopy
+import hashlib
 import json
 import datetime
 import collections
+import threading
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
 
 import six
 from colander import (
@@ -41,6 +47,51 @@ class RecordSchema(SchemaNode):
                 self.add(schema)
 
 
+class RecordSchemaCache(object):
+    """A process-wide LRU cache of compiled :class:`RecordSchema`, by model id
+    and definition hash.
+    """
+    def __init__(self, size=100):
+        self.size = size
+        self._schemas = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, model_id, definition):
+        serialized = json.dumps(definition, sort_keys=True)
+        key = (model_id, hashlib.md5(serialized.encode('utf-8')).hexdigest())
+        with self._lock:
+            schema = self._schemas.pop(key, None)
+            if schema is not None:
+                # Move it to the most recently used end.
+                self._schemas[key] = schema
+                return schema
+
+        schema = RecordSchema(definition)
+        with self._lock:
+            self._schemas[key] = schema
+            while len(self._schemas) > self.size:
+                self._schemas.popitem(last=False)
+        return schema
+
+    def invalidate(self, model_id):
+        with self._lock:
+            for key in [k for k in self._schemas if k[0] == model_id]:
+                del self._schemas[key]
+
+
+record_schemas = RecordSchemaCache()
+
+
+def get_record_schema(model_id, definition):
+    """Returns the compiled record schema of the model definition."""
+    return record_schemas.get(model_id, definition)
+
+
+def invalidate_record_schema(event):
+    """Drops the compiled record schemas of an updated or deleted model."""
+    record_schemas.invalidate(event.model_id)
+
+
 class ModelSchema(SchemaNode):
     """A model is a mapping with a mandatory ``definition``, and optionnal
     ``permissions`` or ``records`` (empty if not provided).
@@ -185,7 +236,7 @@ def record_validator(request):
 
     try:
         definition = request.db.get_model_definition(model_id)
-        schema = RecordSchema(definition)
+        schema = get_record_schema(model_id, definition)
         validator(request, schema)
     except ModelNotFound:
         request.errors.add('path', 'modelname',
@@ -0,0 +1,234 @@
+"""Rebuilds the Elasticsearch indices of models from the backend::
+
+    $ daybed-reindex conf/production.ini model1 model2 --workers 4
+
+Records are read by batches, turned into documents by worker processes and
+loaded into a new index with ``_bulk``. The model alias is pointed to it
+once all records are loaded, searches are served by the previous index
+until then. Running applications write records in both indices meanwhile,
+writes do not need to be stopped.
+
+With ``--checkpoint``, the progress is saved after each batch, and an
+interrupted run resumes from there when started again with the same file.
+Applications keep writing in the new index until then, unless the model is
+reindexed by another run or changed meanwhile: the model is then reindexed
+from scratch.
+"""
+import argparse
+import collections
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+from pyramid.paster import bootstrap, setup_logging
+
+from daybed import logger
+from daybed.backends.exceptions import ModelNotFound
+from daybed.indexer import create_actions, ReindexError
+
+
+class InlinePool(object):
+    """Runs the tasks in the current process, with the interface of
+    :class:`multiprocessing.pool.Pool`.
+    """
+    class Result(object):
+        def __init__(self, value):
+            self.value = value
+
+        def get(self):
+            return self.value
+
+    def apply_async(self, func, args):
+        return self.Result(func(*args))
+
+    def close(self):
+        pass
+
+    def join(self):
+        pass
+
+
+class Checkpoints(object):
+    """Progress of each model, saved in a JSON file."""
+    def __init__(self, path=None):
+        self.path = path
+        self._models = {}
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                self._models = json.load(f)
+
+    def get(self, model_id):
+        return self._models.get(model_id)
+
+    def save(self, model_id, **state):
+        self._models[model_id] = state
+        if self.path is None:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self._models, f)
+        os.rename(tmp_path, self.path)
+
+
+class Throttle(object):
+    """Waits as long as needed not to exceed ``max_rate`` records per
+    second (no limit if ``0``).
+    """
+    def __init__(self, max_rate=0):
+        self.max_rate = max_rate
+        self.started = time.time()
+
+    def wait(self, count):
+        if not self.max_rate:
+            return
+        delay = self.started + count / float(self.max_rate) - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class Reindexer(object):
+    """Copies the records of models from the backend ``db`` to new
+    indices of ``indexer``.
+
+    Batches of ``batch_size`` records are transformed by ``workers``
+    processes (in the current one if ``0``), while the next ones are read.
+    """
+    def __init__(self, db, indexer, batch_size=500, workers=0, max_rate=0,
+                 checkpoints=None, progress=None):
+        self.db = db
+        self.indexer = indexer
+        self.batch_size = batch_size
+        self.workers = workers
+        self.max_rate = max_rate
+        self.checkpoints = checkpoints or Checkpoints()
+        self.progress = progress or (lambda model_id, count, rate: None)
+
+    def run(self, models_ids):
+        if self.workers:
+            pool = multiprocessing.Pool(self.workers)
+        else:
+            pool = InlinePool()
+        try:
+            for model_id in models_ids:
+                self.reindex(pool, model_id)
+        finally:
+            pool.close()
+            pool.join()
+
+    def reindex(self, pool, model_id):
+        state = self.checkpoints.get(model_id)
+        if state and state['done']:
+            logger.info("Model '%s' was already reindexed." % model_id)
+            return state['count']
+
+        definition = self.db.get_model_definition(model_id)
+        if state and self.indexer.next_index(model_id) != state['index']:
+            logger.warning("Index %s of model '%s' was replaced, reindex it "
+                           "again." % (state['index'], model_id))
+            state = None
+        if state:
+            logger.info("Resume reindexing of model '%s' after %s records." %
+                        (model_id, state['count']))
+            previous, index = state['previous'], state['index']
+            cursor, count = state['cursor'], state['count']
+            if state['loaded']:
+                # Interrupted after the last batch.
+                return self.__finish(model_id, previous, index, count)
+        else:
+            previous, index = self.indexer.create_next_index(model_id,
+                                                             definition)
+            cursor, count = None, 0
+            self.checkpoints.save(model_id, previous=previous, index=index,
+                                  cursor=None, count=0, loaded=False,
+                                  done=False)
+
+        throttle = Throttle(self.max_rate)
+        loaded = 0
+        # Batches being transformed, in reading order.
+        pending = collections.deque()
+        started = time.time()
+        while True:
+            results, cursor = self.db.get_paginated_records(
+                model_id, self.batch_size, cursor)
+            records = [r['record'] for r in results]
+            pending.append((pool.apply_async(create_actions,
+                                             (model_id, index, definition,
+                                              records)),
+                            cursor, len(records)))
+            last = cursor is None
+            while pending and (last or len(pending) > 2 * self.workers):
+                result, batch_cursor, size = pending.popleft()
+                self.indexer.bulk_create(result.get())
+                loaded += size
+                count += size
+                self.checkpoints.save(model_id, previous=previous,
+                                      index=index, cursor=batch_cursor,
+                                      count=count,
+                                      loaded=batch_cursor is None,
+                                      done=False)
+                self.progress(model_id, count,
+                              loaded / max(time.time() - started, 1e-6))
+                throttle.wait(loaded)
+            if last:
+                break
+
+        return self.__finish(model_id, previous, index, count)
+
+    def __finish(self, model_id, previous, index, count):
+        self.indexer.switch_index(model_id, previous, index)
+        self.checkpoints.save(model_id, previous=previous, index=index,
+                              cursor=None, count=count, loaded=True,
+                              done=True)
+        return count
+
+
+def print_progress(model_id, count, rate):
+    sys.stdout.write("%s: %s records (%.0f/s)\n" % (model_id, count, rate))
+    sys.stdout.flush()
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        description="Rebuild the search indices of models from the backend.")
+    parser.add_argument('config_uri', help="Daybed configuration file")
+    parser.add_argument('models_ids', nargs='+', metavar='model_id',
+                        help="Models to reindex")
+    parser.add_argument('--batch-size', type=int, default=None,
+                        help="Records read and loaded at once (default: "
+                             "elasticsearch.reindex_batch_size)")
+    parser.add_argument('--workers', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="Processes transforming the records, 0 to do "
+                             "it in the main process (default: %(default)s)")
+    parser.add_argument('--max-rate', type=float, default=0,
+                        help="Maximum records loaded per second (default: "
+                             "no limit)")
+    parser.add_argument('--checkpoint', default=None,
+                        help="File where progress is saved, to resume an "
+                             "interrupted run")
+    args = parser.parse_args(argv[1:])
+
+    setup_logging(args.config_uri)
+    env = bootstrap(args.config_uri)
+    registry = env['registry']
+    indexer = registry.index
+    if not hasattr(indexer, 'create_next_index'):
+        env['closer']()
+        parser.error("Only Elasticsearch indices can be rebuilt")
+    reindexer = Reindexer(registry.backend, indexer,
+                          batch_size=(args.batch_size or
+                                      indexer.reindex_batch_size),
+                          workers=args.workers,
+                          max_rate=args.max_rate,
+                          checkpoints=Checkpoints(args.checkpoint),
+                          progress=print_progress)
+    try:
+        reindexer.run(args.models_ids)
+    except ModelNotFound as e:
+        parser.error("Unknown model %s" % e)
+    except ReindexError as e:
+        parser.error(str(e))
+    finally:
+        env['closer']()
@@ -3,7 +3,13 @@ try:
     import unittest2 as unittest
 except ImportError:
     import unittest  # NOQA
+from distutils.spawn import find_executable
+import atexit
 import base64
+import os
+import shutil
+import subprocess
+import tempfile
 
 import six
 import webtest
@@ -26,8 +32,11 @@ class BaseWebTest(unittest.TestCase):
     It setups the database before each test and delete it after.
     """
 
+    def get_app(self):
+        return webtest.TestApp("config:conf/tests.ini", relative_to='.')
+
     def setUp(self):
-        self.app = webtest.TestApp("config:conf/tests.ini", relative_to='.')
+        self.app = self.get_app()
         self.app.RequestClass = PrefixedRequestClass
 
         self.db = self.app.app.registry.backend
@@ -64,3 +73,85 @@ def force_unicode(data):
         return type(data)(map(force_unicode, data))
     else:
         return data
+
+
+class LocalPostgreSQL(object):
+    """A throwaway PostgreSQL server, created by ``initdb`` in a temporary
+    directory and run by ``pg_ctl``. It only listens on a Unix socket in
+    that directory.
+
+    Its programs are looked up in ``bin_dir``, in the ``PATH`` or in the
+    directory given by ``pg_config --bindir``.
+    """
+    def __init__(self, bin_dir=None):
+        self.bin_dir = bin_dir or self.find_bin_dir()
+        self.base_dir = None
+
+    @staticmethod
+    def find_bin_dir():
+        initdb = find_executable('initdb')
+        if initdb:
+            return os.path.dirname(initdb)
+        try:
+            output = subprocess.check_output(['pg_config', '--bindir'])
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        bin_dir = output.decode('utf-8').strip()
+        # pg_config comes with the client libraries, not with the server.
+        if os.path.exists(os.path.join(bin_dir, 'initdb')):
+            return bin_dir
+
+    @property
+    def data_dir(self):
+        return os.path.join(self.base_dir, 'data')
+
+    @property
+    def dsn(self):
+        return 'host=%s dbname=postgres user=postgres' % self.base_dir
+
+    def run(self, program, *args):
+        with open(os.path.join(self.base_dir, 'postgresql.log'), 'a') as log:
+            subprocess.check_call((os.path.join(self.bin_dir, program),) +
+                                  args, stdout=log, stderr=log)
+
+    def start(self):
+        self.base_dir = tempfile.mkdtemp(prefix='daybed-postgresql-')
+        try:
+            self.run('initdb', '-D', self.data_dir, '-U', 'postgres',
+                     '-A', 'trust')
+            self.run('pg_ctl', 'start', '-w', '-D', self.data_dir, '-o',
+                     "-F -k %s -c listen_addresses=''" % self.base_dir)
+        except Exception:
+            shutil.rmtree(self.base_dir)
+            raise
+
+    def stop(self):
+        try:
+            self.run('pg_ctl', 'stop', '-w', '-m', 'fast', '-D', self.data_dir)
+        finally:
+            shutil.rmtree(self.base_dir)
+
+
+_postgresql = {}
+
+
+def postgresql_dsn():
+    """Returns the DSN of the PostgreSQL database to run the tests against.
+
+    It is read from ``DAYBED_TEST_POSTGRESQL_DSN``, or else a
+    :class:`LocalPostgreSQL` server is started for the whole test run.
+    Returns ``None`` if PostgreSQL is not installed.
+    """
+    dsn = os.environ.get('DAYBED_TEST_POSTGRESQL_DSN')
+    if dsn:
+        return dsn
+    if 'server' not in _postgresql:
+        server = LocalPostgreSQL()
+        if server.bin_dir is None:
+            _postgresql['server'] = None
+        else:
+            server.start()
+            atexit.register(server.stop)
+            _postgresql['server'] = server
+    server = _postgresql['server']
+    return server and server.dsn
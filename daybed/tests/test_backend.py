@@ -1,9 +1,17 @@
 try:
-    from unittest2 import TestCase
+    from unittest2 import SkipTest, TestCase, skipIf
 except ImportError:
-    from unittest import TestCase  # flake8: noqa
+    from unittest import SkipTest, TestCase, skipIf  # flake8: noqa
 from collections import defaultdict
+from copy import deepcopy
 from uuid import uuid4
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
 
 import mock
 import six
@@ -14,12 +22,27 @@ from daybed.backends import exceptions as backend_exceptions
 from daybed.backends.couchdb import (
     CouchDBBackendConnectionError, CouchDBBackend
 )
+from daybed.backends.cache import CachedBackend, RequestBackend, TTLCache
 from daybed.backends.memory import MemoryBackend
+from daybed.backends.memory.journal import Journal
 from daybed.backends.redis import RedisBackend
+from daybed.backends.sqlite import SQLiteBackend
+try:
+    from daybed.backends.postgresql import (
+        BlockingConnectionPool, PoolError, PostgreSQLBackend
+    )
+    from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+except ImportError:  # psycopg2 is optional.
+    PostgreSQLBackend = None
 from redis.exceptions import ConnectionError
 
 from daybed.backends.couchdb.views import docs as couchdb_views
+from daybed.backends.couchdb.session import (
+    BoundedConnectionPool, PooledSession, PoolTimeout
+)
 from daybed.backends.id_generators import KoremutakeGenerator
+from daybed.permissions import permissions_matrix
+from daybed.tests.support import postgresql_dsn
 from daybed.tokens import get_hawk_credentials
 
 
@@ -121,6 +144,18 @@ class BackendTestBase(object):
         self._create_model()
         self.assertEqual(self.db.get_models(["unknown"]), [])
 
+    def test_get_models_follows_permissions_changes(self):
+        self._create_model()
+        self.db.put_model(self.definition, {'read_definition': ['Remy']},
+                          'modelname')
+        self.assertEqual(self.db.get_models(["Alexis"]), [])
+        self.assertEqual(len(self.db.get_models(["Remy"])), 1)
+
+    def test_get_models_ignores_deleted_models(self):
+        self._create_model()
+        self.db.delete_model('modelname')
+        self.assertEqual(self.db.get_models(["Remy", "Alexis"]), [])
+
     def test_get_model_permissions(self):
         self._create_model()
         self.assertEqual(self.db.get_model_permissions('modelname'), {
@@ -133,7 +168,7 @@ class BackendTestBase(object):
 
         # When we put a new version of a record, we should keep the list of
         # authors.
-        item_id = self.db.put_record('modelname', self.record, ['Remy'])
+        item_id, _ = self.db.put_record('modelname', self.record, ['Remy'])
         self.db.put_record('modelname', self.record, ['Alexis'], item_id)
 
         authors = self.db.get_record_authors('modelname', item_id)
@@ -157,10 +192,77 @@ class BackendTestBase(object):
         del records[0]['record']['id']
         self.assertDictEqual(records[0], {'authors': [u'author'], 'record': {u'age': 7}})
 
+    def test_get_records_by_authors(self):
+        self._create_model()
+        self.db.put_record('modelname', {'age': 1}, ['Alexis'], 'alexis')
+        self.db.put_record('modelname', {'age': 2}, ['Remy'], 'remy')
+        self.db.put_record('modelname', {'age': 3}, ['Remy'], 'both')
+        self.db.put_record('modelname', {'age': 3}, ['Alexis'], 'both')
+
+        records = self.db.get_records_by_authors('modelname', ['Alexis'])
+        self.assertEqual(sorted(r['id'] for r in records), ['alexis', 'both'])
+        records = self.db.get_records_by_authors('modelname',
+                                                 ['Alexis', 'Remy'])
+        self.assertEqual(sorted(r['id'] for r in records),
+                         ['alexis', 'both', 'remy'])
+        self.assertEqual(self.db.get_records_by_authors('modelname',
+                                                        ['unknown']), [])
+
+    def test_get_records_by_authors_follows_deletions(self):
+        self._create_model()
+        self.db.put_record('modelname', self.record, ['Alexis'], 'record')
+        self.db.delete_record('modelname', 'record')
+        self.assertEqual(self.db.get_records_by_authors('modelname',
+                                                        ['Alexis']), [])
+
+    def test_put_records(self):
+        self._create_model()
+        records_ids = self.db.put_records('modelname',
+                                          [{'age': 1}, {'age': 2}],
+                                          ['Alexis'])
+        self.assertEqual(len(set(records_ids)), 2)
+        self.assertEqual(self.db.get_record('modelname', records_ids[1]),
+                         {'age': 2, 'id': records_ids[1]})
+        self.assertEqual(self.db.get_record_authors('modelname',
+                                                    records_ids[0]),
+                         ['Alexis'])
+        records = self.db.get_records_by_authors('modelname', ['Alexis'])
+        self.assertEqual(len(records), 2)
+
+    def test_put_records_unknown_model(self):
+        self.assertRaises(backend_exceptions.ModelNotFound,
+                          self.db.put_records, 'unknown', [self.record],
+                          ['Alexis'])
+
     def test_get_records_empty(self):
         self._create_model()
         self.assertEqual(self.db.get_records('modelname'), [])
 
+    def test_get_paginated_records(self):
+        self._create_model()
+        for i in range(5):
+            self.db.put_record('modelname', {'age': i}, ['author'])
+
+        ages = []
+        records, cursor = self.db.get_paginated_records('modelname', 2)
+        ages.extend([r['record']['age'] for r in records])
+        while cursor is not None:
+            records, cursor = self.db.get_paginated_records('modelname', 2,
+                                                            cursor)
+            for record in records:
+                self.assertEqual(record['authors'], ['author'])
+            ages.extend([r['record']['age'] for r in records])
+        self.assertEqual(sorted(ages), list(range(5)))
+
+    def test_get_paginated_records_empty(self):
+        self._create_model()
+        self.assertEqual(self.db.get_paginated_records('modelname', 2),
+                         ([], None))
+
+    def test_get_paginated_records_unknown_model(self):
+        self.assertRaises(backend_exceptions.ModelNotFound,
+                          self.db.get_paginated_records, 'unknown', 2)
+
     def test_get_record(self):
         self._create_model()
         self.db.put_record('modelname', self.record, ['author'], 'record')
@@ -174,6 +276,56 @@ class BackendTestBase(object):
         self.assertEqual(self.db.get_record_authors('modelname', 'record'),
                          ['author'])
 
+    def test_record_version_changes_when_written(self):
+        self._create_model()
+        self.db.put_record('modelname', self.record, ['author'], 'record')
+        version = self.db.get_record_version('modelname', 'record')
+        self.db.put_record('modelname', self.record, ['author'], 'record')
+        self.assertNotEqual(self.db.get_record_version('modelname', 'record'),
+                            version)
+
+    def test_put_record_returns_the_new_version(self):
+        self._create_model()
+        record_id, version = self.db.put_record('modelname', self.record,
+                                                ['author'])
+        self.assertEqual(version,
+                         self.db.get_record_version('modelname', record_id))
+        _, version = self.db.put_record('modelname', {'age': 8}, ['author'],
+                                        record_id, version=version)
+        self.assertEqual(version,
+                         self.db.get_record_version('modelname', record_id))
+
+    def test_get_record_with_version(self):
+        self._create_model()
+        self.db.put_record('modelname', self.record, ['author'], 'record')
+        record, version = self.db.get_record_with_version('modelname',
+                                                          'record')
+        self.assertEqual(record, {'age': 7, 'id': 'record'})
+        self.assertEqual(version,
+                         self.db.get_record_version('modelname', 'record'))
+        self.assertRaises(backend_exceptions.RecordNotFound,
+                          self.db.get_record_with_version, 'modelname',
+                          'unknown')
+
+    def test_put_record_with_version(self):
+        self._create_model()
+        self.db.put_record('modelname', self.record, ['author'], 'record')
+        version = self.db.get_record_version('modelname', 'record')
+        self.db.put_record('modelname', {'age': 8}, ['author'], 'record',
+                           version=version)
+        self.assertEqual(self.db.get_record('modelname', 'record')['age'], 8)
+        # The version read is now outdated.
+        self.assertRaises(backend_exceptions.VersionMismatch,
+                          self.db.put_record, 'modelname', {'age': 9},
+                          ['author'], 'record', version=version)
+        self.assertEqual(self.db.get_record('modelname', 'record')['age'], 8)
+
+    def test_put_record_with_version_requires_record(self):
+        self._create_model()
+        self.assertRaises(backend_exceptions.VersionMismatch,
+                          self.db.put_record, 'modelname', self.record,
+                          ['author'], 'record', version='1')
+
     def test_delete_record(self):
         self._create_model()
         self.db.put_record('modelname', self.record, ['author'], 'record')
@@ -181,6 +333,21 @@ class BackendTestBase(object):
         self.assertRaises(backend_exceptions.RecordNotFound, self.db.get_record,
                           'modelname', 'record')
 
+    def test_delete_record_with_version(self):
+        self._create_model()
+        self.db.put_record('modelname', self.record, ['author'], 'record')
+        version = self.db.get_record_version('modelname', 'record')
+        self.db.put_record('modelname', {'age': 8}, ['author'], 'record')
+        # The version read is now outdated.
+        self.assertRaises(backend_exceptions.VersionMismatch,
+                          self.db.delete_record, 'modelname', 'record',
+                          version=version)
+        self.assertEqual(self.db.get_record('modelname', 'record')['age'], 8)
+        version = self.db.get_record_version('modelname', 'record')
+        self.db.delete_record('modelname', 'record', version=version)
+        self.assertRaises(backend_exceptions.RecordNotFound,
+                          self.db.get_record, 'modelname', 'record')
+
     def test_get_model_definition(self):
         self._create_model()
         self.assertEquals(self.db.get_model_definition('modelname'),
@@ -228,6 +395,31 @@ class TestCouchDBBackend(BackendTestBase, TestCase):
                 id_generator=self.id_generator
             )
 
+    def test_delete_records_by_batches(self):
+        self.db._batch_size = 2
+        self._create_model()
+        records_ids = self.db.put_records('modelname',
+                                          [{'age': i} for i in range(5)],
+                                          ['Alexis'])
+        records = self.db.delete_records('modelname')
+        self.assertEqual(sorted(r['id'] for r in records),
+                         sorted(records_ids))
+        self.assertEqual(self.db.get_records('modelname'), [])
+
+    def test_delete_records_can_return_ids_only(self):
+        self.db._return_deleted_records = False
+        self._create_model()
+        self.db.put_record('modelname', self.record, ['Alexis'], 'record')
+        self.assertEqual(self.db.delete_records('modelname'),
+                         [{'id': 'record'}])
+        self.assertEqual(self.db.get_records('modelname'), [])
+
+    def test_obsolete_views_are_removed(self):
+        db = self.db.server[self.db.db_name]
+        db['_design/records_all'] = {'views': {}}
+        self.db.sync_views()
+        self.assertNotIn('_design/records_all', db)
+
     @mock.patch('daybed.backends.couchdb.CouchDBBackend.__init__')
     def test_load_from_config(self, constructor_mock):
         constructor_mock.return_value = None
@@ -236,6 +428,75 @@ class TestCouchDBBackend(BackendTestBase, TestCase):
         self.assertTrue(constructor_mock.called)
 
 
+class TestCouchDBSession(TestCase):
+
+    def setUp(self):
+        self.session = PooledSession(pool_size=2, pool_timeout=0.1)
+        patch = mock.patch('couchdb.http.Session.request',
+                           return_value=(200, {}, None))
+        self.request = patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_requests_are_measured(self):
+        self.session.request('GET', 'http://localhost:5984/db')
+        self.request.side_effect = socket.error
+        self.assertRaises(socket.error, self.session.request,
+                          'PUT', 'http://localhost:5984/db')
+        stats = self.session.metrics.stats()
+        self.assertEqual(stats['busy'], 0)
+        self.assertEqual(stats['methods']['GET']['count'], 1)
+        self.assertEqual(stats['methods']['GET']['errors'], 0)
+        self.assertEqual(stats['methods']['PUT']['errors'], 1)
+
+    @mock.patch('daybed.backends.couchdb.session.logger.info')
+    def test_metrics_are_logged_and_reset_on_report(self, info_mock):
+        self.session.request('GET', 'http://localhost:5984/db')
+        self.session.metrics.report()
+        line = info_mock.call_args[0][0] % info_mock.call_args[0][1:]
+        self.assertIn('GET 1 (0 failed)', line)
+        self.assertEqual(self.session.metrics.stats()['methods'], {})
+
+    def test_metrics_are_reported_every_interval(self):
+        reported = threading.Event()
+        metrics = mock.MagicMock()
+        metrics.report.side_effect = reported.set
+        PooledSession(metrics=metrics, metrics_interval=0.05)
+        self.assertTrue(reported.wait(5))
+
+    def test_requests_wait_for_an_available_connection(self):
+        started = []
+        finish = threading.Event()
+
+        def request(*args, **kwargs):
+            started.append(True)
+            finish.wait()
+
+        self.request.side_effect = request
+        threads = [threading.Thread(target=self.session.request,
+                                    args=('GET', 'http://localhost:5984'))
+                   for i in range(2)]
+        for thread in threads:
+            thread.start()
+        while len(started) < 2:
+            time.sleep(0.01)
+        try:
+            self.assertRaises(PoolTimeout, self.session.request,
+                              'GET', 'http://localhost:5984')
+        finally:
+            finish.set()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(self.session.metrics.stats()['max_busy'], 2)
+
+    def test_idle_connections_are_limited(self):
+        pool = BoundedConnectionPool(None, size=1)
+        connections = [mock.MagicMock(), mock.MagicMock()]
+        for connection in connections:
+            pool.release('http://localhost:5984', connection)
+        self.assertFalse(connections[0].close.called)
+        self.assertTrue(connections[1].close.called)
+
+
 class TestRedisBackend(BackendTestBase, TestCase):
 
     def setUp(self):
@@ -259,6 +520,91 @@ class TestRedisBackend(BackendTestBase, TestCase):
                 id_generator=self.id_generator
             )
 
+    def test_generated_id_never_overwrites_a_record(self):
+        self._create_model()
+        self.db.put_record('modelname', {'age': 1}, ['Alexis'], 'taken')
+        self.db._generate_id = mock.Mock(side_effect=['taken', 'free'])
+        record_id, _ = self.db.put_record('modelname', {'age': 2}, ['Remy'])
+        self.assertEqual(record_id, 'free')
+        self.assertEqual(self.db.get_record('modelname', 'taken')['age'], 1)
+
+    def test_records_are_read_by_batches(self):
+        self.db._batch_size = 2
+        self._create_model()
+        for i in range(5):
+            self.db.put_record('modelname', {'age': i}, ['Alexis'])
+        with mock.patch.object(self.db._db, 'mget',
+                               wraps=self.db._db.mget) as mget:
+            records = self.db.get_records('modelname')
+        self.assertEqual(sorted(r['age'] for r in records), list(range(5)))
+        self.assertEqual(mget.call_count, 3)
+
+    def _restart(self):
+        self.db = RedisBackend(host='localhost', port=6379, db=5,
+                               id_generator=self.id_generator)
+
+    def test_paginated_records_are_deduplicated_per_page(self):
+        self._create_model()
+        self.db.put_record('modelname', self.record, ['Alexis'])
+        cursor, keys = self.db._db.sscan('modelrecords.modelname')
+        with mock.patch.object(self.db._db, 'sscan',
+                               return_value=(cursor, keys * 2)):
+            records, cursor = self.db.get_paginated_records('modelname', 10)
+        self.assertEqual(len(records), 1)
+        self.assertIsNone(cursor)
+
+    def test_models_of_previous_versions_are_indexed_at_startup(self):
+        self.db._db.set('model.old', json.dumps({
+            'id': 'old',
+            'definition': self.definition,
+            'permissions': {'read_definition': ['Alexis']}}))
+        self.db._db.delete('indexes.version')
+        self._restart()
+        self.assertEqual([m['id'] for m in self.db.get_models(['Alexis'])],
+                         ['old'])
+        self.assertEqual(self.db.get_models(['Remy']), [])
+
+    def test_records_of_previous_versions_are_indexed_at_startup(self):
+        self._create_model()
+        self.db.put_record('modelname', self.record, ['Alexis'], 'a')
+        self.db._db.delete('modelrecords.modelname.author.Alexis')
+        self.db._db.delete('indexes.version')
+        self._restart()
+        records = self.db.get_records_by_authors('modelname', ['Alexis'])
+        self.assertEqual([r['id'] for r in records], ['a'])
+
+    def test_scripts_refuse_missing_authors_sets(self):
+        self._create_model()
+        self.db.put_record('modelname', self.record, ['Alexis'], 'a')
+        keys = ['modelrecord.modelname.a', 'modelrecords.modelname']
+        self.assertEqual(self.db._put_record(
+            keys=keys, args=[json.dumps(self.record), '["Remy"]', '[]',
+                             '0', '']), -2)
+        self.assertEqual(self.db._delete_record(keys=keys,
+                                                args=['[]', '']), -2)
+
+    def test_authors_sets_are_updated_on_overwrite(self):
+        self._create_model()
+        self.db.put_record('modelname', self.record, ['Alexis'], 'a')
+        self.db.put_record('modelname', {'age': 8}, ['Remy'], 'a')
+        for author in ('Alexis', 'Remy'):
+            records = self.db.get_records_by_authors('modelname', [author])
+            self.assertEqual([r['age'] for r in records], [8])
+        self.db.delete_record('modelname', 'a')
+        self.assertEqual(self.db.get_records_by_authors('modelname',
+                                                        ['Alexis', 'Remy']),
+                         [])
+
+    def test_stale_readers_entries_are_ignored(self):
+        self._create_model()
+        self.db._db.sadd('models.readable.Mathieu', 'model.modelname')
+        self.assertEqual(self.db.get_models(['Mathieu']), [])
+
+    def test_delete_unknown_record_raises(self):
+        self._create_model()
+        self.assertRaises(backend_exceptions.RecordNotFound,
+                          self.db.delete_record, 'modelname', 'unknown')
+
     @mock.patch('daybed.backends.redis.RedisBackend.__init__')
     def test_load_from_config(self, constructor_mock):
         constructor_mock.return_value = None
@@ -272,3 +618,707 @@ class TestMemoryBackend(BackendTestBase, TestCase):
     def setUp(self):
         self.db = MemoryBackend(self.id_generator)
         super(TestMemoryBackend, self).setUp()
+
+    def test_concurrent_writes_on_different_models(self):
+        def write(model_id):
+            self.db.put_model({'title': model_id}, {}, model_id)
+            for i in range(100):
+                self.db.put_record(model_id, {'i': i}, ['Alexis'])
+            self.db.put_records(model_id, [{'i': i} for i in range(100)],
+                                ['Remy'])
+
+        threads = [threading.Thread(target=write, args=('model%s' % i,))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for i in range(8):
+            model_id = 'model%s' % i
+            self.assertEqual(len(self.db.get_records(model_id)), 200)
+            by_remy = self.db.get_records_by_authors(model_id, ['Remy'])
+            self.assertEqual(len(by_remy), 100)
+
+    def test_records_can_be_read_while_written(self):
+        self._create_model()
+        errors = []
+
+        def write():
+            for i in range(500):
+                record_id, _ = self.db.put_record('modelname', {'i': i},
+                                                  ['Alexis'])
+                if i % 2:
+                    self.db.delete_record('modelname', record_id)
+
+        def read():
+            try:
+                for i in range(100):
+                    self.db.get_records('modelname')
+                    self.db.get_paginated_records('modelname', 10)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=write)]
+        threads += [threading.Thread(target=read) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(self.db.get_records('modelname')), 250)
+
+    def test_paginated_records_follow_writes_in_ids_order(self):
+        self._create_model()
+        for record_id in ('d', 'b', 'a', 'c'):
+            self.db.put_record('modelname', self.record, ['Alexis'],
+                               record_id)
+        self.db.put_record('modelname', {'age': 8}, ['Alexis'], 'b')
+        self.db.delete_record('modelname', 'c')
+        records, cursor = self.db.get_paginated_records('modelname', 2)
+        self.assertEqual([r['record']['id'] for r in records], ['a', 'b'])
+        records, cursor = self.db.get_paginated_records('modelname', 2,
+                                                        cursor)
+        self.assertEqual([r['record']['id'] for r in records], ['d'])
+        self.assertIsNone(cursor)
+
+    def test_stored_records_are_isolated_from_callers(self):
+        self._create_model()
+        record = {'age': 7, 'tags': ['a']}
+        self.db.put_record('modelname', record, ['Alexis'], 'record')
+        record['tags'].append('b')
+        read = self.db.get_record('modelname', 'record')
+        read['age'] = 8
+        self.assertRaises(TypeError, read['tags'].append, 'c')
+        self.assertEqual(self.db.get_record('modelname', 'record'),
+                         {'age': 7, 'tags': ['a'], 'id': 'record'})
+
+    def test_stored_records_can_be_copied(self):
+        self._create_model()
+        self.db.put_record('modelname', {'tags': ['a']}, ['Alexis'], 'record')
+        record = deepcopy(self.db.get_record('modelname', 'record'))
+        record['tags'].append('b')
+        self.assertEqual(record['tags'], ['a', 'b'])
+
+
+class TestJournaledMemoryBackend(BackendTestBase, TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'daybed')
+        self.db = self._open()
+        super(TestJournaledMemoryBackend, self).setUp()
+
+    def tearDown(self):
+        self.db._journal.close()
+        shutil.rmtree(self.tempdir)
+
+    def _open(self, **kwargs):
+        return MemoryBackend(self.id_generator,
+                             journal=Journal(self.path, **kwargs))
+
+    def _restart(self, **kwargs):
+        self.db._journal.close()
+        self.db = self._open(**kwargs)
+
+    def test_state_is_restored_after_restart(self):
+        self._create_model()
+        self._create_model('other')
+        token, credentials = get_hawk_credentials()
+        self.db.store_credentials(token, credentials)
+        self.db.put_record('modelname', self.record, ['Alexis'], 'a')
+        self.db.put_record('modelname', {'age': 8}, ['Remy'], 'a')
+        self.db.put_records('modelname', [{'age': 1}, {'age': 2}], ['Remy'])
+        deleted, _ = self.db.put_record('modelname', self.record, ['Remy'])
+        self.db.delete_record('modelname', deleted)
+        self.db.delete_model('other')
+        records = self.db.get_records_with_authors('modelname')
+
+        self._restart()
+        self.assertEqual(self.db.get_model_definition('modelname'),
+                         self.definition)
+        self.assertRaises(backend_exceptions.ModelNotFound,
+                          self.db.get_model_definition, 'other')
+        self.assertEqual(self.db.get_token(credentials['id']), token)
+        self.assertEqual(
+            sorted(self.db.get_records_with_authors('modelname'),
+                   key=lambda r: r['record']['id']),
+            sorted(records, key=lambda r: r['record']['id']))
+        self.assertEqual(len(self.db.get_records_by_authors('modelname',
+                                                            ['Remy'])), 3)
+
+    def test_snapshot_compacts_the_log(self):
+        self._create_model()
+        for i in range(10):
+            self.db.put_record('modelname', {'age': i}, ['Alexis'], 'a')
+        self.db._journal.snapshot()
+        self.db.put_record('modelname', {'age': 42}, ['Alexis'], 'b')
+
+        with open(self.path + '.snapshot') as f:
+            self.assertEqual(len(f.readlines()), 2)
+        with open(self.path + '.log') as f:
+            self.assertEqual(len(f.readlines()), 1)
+        self.assertFalse(os.path.exists(self.path + '.log.1'))
+
+        self._restart()
+        self.assertEqual(self.db.get_record('modelname', 'a')['age'], 9)
+        self.assertEqual(self.db.get_record('modelname', 'b')['age'], 42)
+
+    def test_interrupted_snapshot_is_recovered(self):
+        self._create_model()
+        self.db.put_record('modelname', self.record, ['Alexis'], 'a')
+        self.db._journal.close()
+        os.rename(self.path + '.log', self.path + '.log.1')
+        with open(self.path + '.snapshot.tmp', 'w') as f:
+            f.write('["model",')
+
+        self.db = self._open()
+        self.db.put_record('modelname', {'age': 8}, ['Alexis'], 'b')
+        self.db._journal.snapshot()
+        self._restart()
+        self.assertEqual(len(self.db.get_records('modelname')), 2)
+
+    def test_snapshot_is_taken_at_log_switch(self):
+        self._create_model()
+        self.db.put_record('modelname', self.record, ['Alexis'], 'a')
+        dump = self.db._journal._dump
+
+        def dump_while_writing():
+            entries = dump()
+
+            def streamed():
+                # Written while the snapshot is streamed.
+                self.db.put_record('modelname', {'age': 8}, ['Alexis'], 'b')
+                self.db.delete_model('modelname')
+                for entry in entries:
+                    yield entry
+            return streamed()
+
+        self.db._journal._dump = dump_while_writing
+        self.db._journal.snapshot()
+        with open(self.path + '.snapshot') as f:
+            self.assertEqual(len(f.readlines()), 2)
+
+        self._restart()
+        self.assertRaises(backend_exceptions.ModelNotFound,
+                          self.db.get_model_definition, 'modelname')
+
+    def test_writes_on_different_models_are_applied_concurrently(self):
+        self._create_model()
+        self._create_model('other')
+        applying = threading.Event()
+        resume = threading.Event()
+        apply_records = self.db._apply_records
+
+        def slow_apply_records(model_id, docs):
+            if model_id == 'modelname':
+                applying.set()
+                resume.wait()
+            apply_records(model_id, docs)
+
+        self.db._apply_records = slow_apply_records
+        thread = threading.Thread(target=self.db.put_record,
+                                  args=('modelname', self.record, ['Alexis'],
+                                        'a'))
+        thread.start()
+        applying.wait()
+        other = threading.Thread(target=self.db.put_record,
+                                 args=('other', self.record, ['Alexis'], 'b'))
+        other.start()
+        other.join(5)
+        written = not other.is_alive()
+        resume.set()
+        thread.join()
+        other.join()
+        self.assertTrue(written)
+
+        self._restart()
+        self.assertEqual(self.db.get_record('other', 'b')['age'], 7)
+        self.assertEqual(self.db.get_record('modelname', 'a')['age'], 7)
+
+    def test_snapshot_waits_for_writes_in_progress(self):
+        self._create_model()
+        applying = threading.Event()
+        resume = threading.Event()
+        apply_records = self.db._apply_records
+
+        def slow_apply_records(model_id, docs):
+            applying.set()
+            resume.wait()
+            apply_records(model_id, docs)
+
+        self.db._apply_records = slow_apply_records
+        thread = threading.Thread(target=self.db.put_record,
+                                  args=('modelname', self.record, ['Alexis'],
+                                        'a'))
+        thread.start()
+        applying.wait()
+        snapshot = threading.Thread(target=self.db._journal.snapshot)
+        snapshot.start()
+        time.sleep(0.05)
+        resume.set()
+        thread.join()
+        snapshot.join()
+
+        with open(self.path + '.snapshot') as f:
+            self.assertEqual(len(f.readlines()), 2)
+        self._restart()
+        self.assertEqual(self.db.get_record('modelname', 'a')['age'], 7)
+
+    def test_entries_of_deleted_models_are_skipped(self):
+        self._create_model()
+        self.db._journal.close()
+        with open(self.path + '.log', 'a') as f:
+            f.write('["delete_records","modelname"]\n')
+            f.write('["delete_model","modelname"]\n')
+            f.write('["delete_record","modelname","a"]\n')
+
+        self.db = self._open()
+        self.assertRaises(backend_exceptions.ModelNotFound,
+                          self.db.get_model_definition, 'modelname')
+
+    def test_failed_writes_are_not_logged(self):
+        self.assertRaises(backend_exceptions.ModelNotFound,
+                          self.db.put_record, 'unknown', self.record,
+                          ['Alexis'], 'a')
+        self._restart()
+        self.assertFalse(os.path.getsize(self.path + '.log'))
+
+    def test_truncated_entry_is_skipped(self):
+        self._create_model()
+        self.db.put_record('modelname', self.record, ['Alexis'], 'a')
+        self.db._journal.close()
+        with open(self.path + '.log', 'a') as f:
+            f.write('["records","modelname",[{"_id"')
+
+        self.db = self._open()
+        self.assertEqual(self.db.get_record('modelname', 'a')['age'], 7)
+
+    def test_entries_are_synced_according_to_policy(self):
+        self._restart(fsync='always')
+        with mock.patch('os.fsync') as fsync:
+            self._create_model()
+            self.assertTrue(fsync.called)
+
+        self._restart(fsync='never')
+        with mock.patch('os.fsync') as fsync:
+            self._create_model()
+            self.db._journal.sync()
+            self.assertFalse(fsync.called)
+
+    def test_unknown_fsync_policy_is_refused(self):
+        self.assertRaises(ValueError, Journal, self.path, fsync='sometimes')
+
+
+class TestSQLiteBackend(BackendTestBase, TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'daybed.sqlite')
+        self.db = SQLiteBackend(self.path, self.id_generator, batch_size=2)
+        super(TestSQLiteBackend, self).setUp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_database_uses_wal_mode(self):
+        mode = self.db._db.execute('PRAGMA journal_mode').fetchone()[0]
+        self.assertEqual(mode, 'wal')
+
+    def test_records_are_stored_on_disk(self):
+        self._create_model()
+        self.db.put_record('modelname', self.record, ['Alexis'], 'record')
+        db = SQLiteBackend(self.path, self.id_generator)
+        self.assertEqual(db.get_record('modelname', 'record'),
+                         {'age': 7, 'id': 'record'})
+
+    def test_put_records_by_batches(self):
+        self._create_model()
+        records_ids = self.db.put_records('modelname',
+                                          [{'age': i} for i in range(5)],
+                                          ['Alexis'])
+        self.assertEqual(len(set(records_ids)), 5)
+        self.assertEqual(len(self.db.get_records('modelname')), 5)
+
+    def test_failed_transactions_are_rolled_back(self):
+        self._create_model()
+        self.db.put_record('modelname', self.record, ['Alexis'], 'record')
+        with mock.patch.object(self.db, 'get_records', side_effect=ValueError):
+            self.assertRaises(ValueError, self.db.delete_model, 'modelname')
+        self.assertEqual(self.db.get_record('modelname', 'record'),
+                         {'age': 7, 'id': 'record'})
+
+    def test_threads_use_their_own_connection(self):
+        self._create_model()
+        connections = []
+
+        def write(i):
+            connections.append(self.db._db)
+            for j in range(20):
+                self.db.put_record('modelname', {'age': j}, ['Alexis'])
+
+        threads = [threading.Thread(target=write, args=(i,))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(connections)), 4)
+        self.assertEqual(len(self.db.get_records('modelname')), 80)
+
+
+@skipIf(PostgreSQLBackend is None, "psycopg2 is not installed")
+class TestPostgreSQLBackend(BackendTestBase, TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dsn = postgresql_dsn()
+        if cls.dsn is None:
+            raise SkipTest("PostgreSQL is not installed")
+
+    def setUp(self):
+        self.db = PostgreSQLBackend(self.dsn, self.id_generator, batch_size=2)
+        super(TestPostgreSQLBackend, self).setUp()
+
+    def tearDown(self):
+        self.db.delete_db()
+        self.db._pool.closeall()
+
+    def test_records_fields_are_indexed(self):
+        with self.db._cursor() as cursor:
+            # The table is too small for the index to be chosen otherwise.
+            cursor.execute("SET LOCAL enable_seqscan = off")
+            cursor.execute("EXPLAIN SELECT * FROM records"
+                           " WHERE record @> '{\"age\": 1}'")
+            plan = ' '.join(row[0] for row in cursor.fetchall())
+        self.assertIn('records_fields', plan)
+
+    def test_filter_records(self):
+        self._create_model()
+        self.db.put_records('modelname',
+                            [{'age': i % 2} for i in range(5)], ['Alexis'])
+        records, cursor = self.db.filter_records('modelname', {'age': 1}, 1)
+        self.assertEqual(records[0]['record']['age'], 1)
+        records, cursor = self.db.filter_records('modelname', {'age': 1}, 1,
+                                                 cursor)
+        self.assertEqual(records[0]['record']['age'], 1)
+        self.assertIsNone(cursor)
+
+    def test_put_records_by_batches(self):
+        self._create_model()
+        records_ids = self.db.put_records('modelname',
+                                          [{'age': i} for i in range(5)],
+                                          ['Alexis'])
+        self.assertEqual(len(set(records_ids)), 5)
+        self.assertEqual(len(self.db.get_records('modelname')), 5)
+
+    def test_put_record_unknown_model(self):
+        self.assertRaises(backend_exceptions.ModelNotFound,
+                          self.db.put_record, 'unknown', self.record,
+                          ['Alexis'])
+
+
+@skipIf(PostgreSQLBackend is None, "psycopg2 is not installed")
+class TestPostgreSQLPool(TestCase):
+
+    def setUp(self):
+        def connect(*args):
+            connection = mock.MagicMock(closed=False)
+            connection.info.transaction_status = TRANSACTION_STATUS_IDLE
+            return connection
+
+        patch = mock.patch('psycopg2.pool.psycopg2.connect',
+                           side_effect=connect)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.pool = BlockingConnectionPool(2, 2, 'dbname=daybed',
+                                           timeout=0.1)
+
+    def test_connections_are_reused(self):
+        connection = self.pool.getconn()
+        self.pool.putconn(connection)
+        self.assertEqual(self.pool.getconn(), connection)
+
+    def test_getconn_times_out_when_all_connections_are_used(self):
+        self.pool.getconn()
+        self.pool.getconn()
+        self.assertRaises(PoolError, self.pool.getconn)
+
+    def test_getconn_waits_for_a_connection_to_be_released(self):
+        connections = [self.pool.getconn(), self.pool.getconn()]
+        self.pool.timeout = None
+        timer = threading.Timer(0.05, self.pool.putconn, (connections[0],))
+        timer.start()
+        self.assertEqual(self.pool.getconn(), connections[0])
+        timer.join()
+
+
+class TestCachedBackend(BackendTestBase, TestCase):
+
+    def setUp(self):
+        self.backend = MemoryBackend(self.id_generator)
+        self.db = CachedBackend(self.backend)
+        super(TestCachedBackend, self).setUp()
+
+    def test_model_definition_is_read_once(self):
+        self._create_model()
+        with mock.patch.object(self.backend, 'get_model_definition',
+                               wraps=self.backend.get_model_definition) as get:
+            self.db.get_model_definition('modelname')
+            self.db.get_model_definition('modelname')
+        self.assertEqual(get.call_count, 1)
+
+    def test_cached_definition_cannot_be_altered(self):
+        self._create_model()
+        self.db.get_model_definition('modelname')['title'] = 'altered'
+        self.assertEqual(self.db.get_model_definition('modelname'),
+                         self.definition)
+
+    def test_cache_is_invalidated_when_model_is_written(self):
+        self._create_model()
+        self.db.get_model_permissions('modelname')
+        self.db.put_model(self.definition, {'read_definition': ['Remy']},
+                          'modelname')
+        self.assertEqual(self.db.get_model_permissions('modelname'),
+                         {'read_definition': ['Remy']})
+
+    def test_permissions_matrix_is_compiled_when_written(self):
+        self._create_model()
+        with mock.patch.object(self.backend, 'get_model_permissions') as get:
+            matrix = self.db.get_model_permissions_matrix('modelname')
+        self.assertFalse(get.called)
+        self.assertEqual(matrix, permissions_matrix(self.permissions))
+
+    def test_permissions_matrix_is_invalidated_when_model_is_written(self):
+        self._create_model()
+        self.db.get_model_permissions_matrix('modelname')
+        self.backend.put_model(self.definition, {'read_definition': ['Remy']},
+                               'modelname')
+        self.db._invalidate('modelname')
+        self.assertEqual(self.db.get_model_permissions_matrix('modelname'),
+                         permissions_matrix({'read_definition': ['Remy']}))
+
+    def test_cache_is_invalidated_by_other_processes(self):
+        invalidation = RedisBackend(host='localhost', port=6379, db=5,
+                                    id_generator=self.id_generator)._db
+        self.db = CachedBackend(self.backend, invalidation=invalidation,
+                                channel='daybed.tests')
+        other = CachedBackend(self.backend, invalidation=invalidation,
+                              channel='daybed.tests')
+        self._create_model()
+        self.db.get_model_definition('modelname')
+        other.put_model({'title': 'updated'}, self.permissions, 'modelname')
+        for i in range(20):
+            if self.db.get_model_definition('modelname') != self.definition:
+                break
+            time.sleep(0.05)
+        self.assertEqual(self.db.get_model_definition('modelname'),
+                         {'title': 'updated'})
+
+    @mock.patch('daybed.backends.cache.logger.exception')
+    @mock.patch('daybed.backends.cache.time.sleep')
+    def test_invalidations_are_listened_again_after_failures(self, sleep,
+                                                             log_exception):
+        class Stop(BaseException):
+            pass
+
+        sleep.side_effect = [None, None, Stop]
+        failing = mock.MagicMock()
+        failing.listen.side_effect = ConnectionError
+        resubscribed = mock.MagicMock()
+        resubscribed.listen.return_value = iter([
+            {'type': 'subscribe', 'channel': b'daybed.tests', 'data': 1},
+            {'type': 'message', 'channel': b'daybed.tests',
+             'data': b'other'}])
+        self.db._invalidation = mock.MagicMock()
+        self.db._invalidation.pubsub.side_effect = [ConnectionError,
+                                                    resubscribed]
+        self._create_model()
+        self.db.get_model_definition('modelname')
+
+        self.assertRaises(Stop, self.db._listen, failing)
+        self.assertTrue(failing.close.called)
+        self.assertEqual([call[0][0] for call in sleep.call_args_list],
+                         [1, 2, 1])
+        self.assertEqual(log_exception.call_count, 3)
+        # Cleared when subscribed again.
+        with mock.patch.object(self.backend, 'get_model_definition',
+                               wraps=self.backend.get_model_definition) as get:
+            self.db.get_model_definition('modelname')
+        self.assertEqual(get.call_count, 1)
+
+    def test_definition_read_before_an_invalidation_is_not_cached(self):
+        self._create_model()
+        read = self.backend.get_model_definition
+
+        def get_model_definition(model_id):
+            definition = read(model_id)
+            # Updated by another process while being read.
+            self.backend.put_model({'title': 'updated'}, self.permissions,
+                                   model_id)
+            self.db._forget(model_id)
+            return definition
+
+        with mock.patch.object(self.backend, 'get_model_definition',
+                               side_effect=get_model_definition):
+            self.assertEqual(self.db.get_model_definition('modelname'),
+                             self.definition)
+        self.assertEqual(self.db.get_model_definition('modelname'),
+                         {'title': 'updated'})
+
+    def test_unknown_credentials_read_before_being_stored_are_not_cached(
+            self):
+        token, credentials = get_hawk_credentials()
+        read = self.backend.get_credentials_key
+
+        def get_credentials_key(credentials_id):
+            try:
+                return read(credentials_id)
+            finally:
+                self.db.store_credentials(token, credentials)
+
+        with mock.patch.object(self.backend, 'get_credentials_key',
+                               side_effect=get_credentials_key):
+            self.assertRaises(backend_exceptions.CredentialsNotFound,
+                              self.db.get_credentials_key, credentials['id'])
+        self.assertEqual(self.db.get_credentials_key(credentials['id']),
+                         credentials['key'])
+
+    def test_credentials_key_is_read_once(self):
+        token, credentials = get_hawk_credentials()
+        self.db.store_credentials(token, credentials)
+        with mock.patch.object(self.backend, 'get_credentials_key',
+                               wraps=self.backend.get_credentials_key) as get:
+            for i in range(2):
+                key = self.db.get_credentials_key(credentials['id'])
+                self.assertEqual(key, credentials['key'])
+        self.assertEqual(get.call_count, 1)
+
+    def test_unknown_credentials_are_cached_until_stored(self):
+        token, credentials = get_hawk_credentials()
+        with mock.patch.object(self.backend, 'get_credentials_key',
+                               wraps=self.backend.get_credentials_key) as get:
+            for i in range(2):
+                self.assertRaises(backend_exceptions.CredentialsNotFound,
+                                  self.db.get_credentials_key,
+                                  credentials['id'])
+        self.assertEqual(get.call_count, 1)
+        self.db.store_credentials(token, credentials)
+        self.assertEqual(self.db.get_credentials_key(credentials['id']),
+                         credentials['key'])
+
+    def test_unknown_credentials_are_cached_briefly(self):
+        self.db = CachedBackend(self.backend, credentials_negative_ttl=-1)
+        token, credentials = get_hawk_credentials()
+        self.assertRaises(backend_exceptions.CredentialsNotFound,
+                          self.db.get_credentials_key, credentials['id'])
+        # Stored by another process.
+        self.backend.store_credentials(token, credentials)
+        self.assertEqual(self.db.get_credentials_key(credentials['id']),
+                         credentials['key'])
+
+    def test_credentials_are_invalidated_by_other_processes(self):
+        invalidation = RedisBackend(host='localhost', port=6379, db=5,
+                                    id_generator=self.id_generator)._db
+        self.db = CachedBackend(self.backend, invalidation=invalidation,
+                                channel='daybed.tests')
+        other = CachedBackend(self.backend, invalidation=invalidation,
+                              channel='daybed.tests')
+        token, credentials = get_hawk_credentials()
+        self.assertRaises(backend_exceptions.CredentialsNotFound,
+                          self.db.get_credentials_key, credentials['id'])
+        other.store_credentials(token, credentials)
+        for i in range(20):
+            try:
+                self.db.get_credentials_key(credentials['id'])
+                break
+            except backend_exceptions.CredentialsNotFound:
+                time.sleep(0.05)
+        self.assertEqual(self.db.get_credentials_key(credentials['id']),
+                         credentials['key'])
+
+
+class TestRequestBackend(BackendTestBase, TestCase):
+
+    def setUp(self):
+        self.backend = MemoryBackend(self.id_generator)
+        self.db = RequestBackend(self.backend)
+        super(TestRequestBackend, self).setUp()
+
+    def test_record_is_read_once(self):
+        self._create_model()
+        self.db.put_record('modelname', self.record, ['Alexis'], 'record')
+        with mock.patch.object(self.backend, 'get_record_authors',
+                               wraps=self.backend.get_record_authors) as get:
+            self.db.get_record_authors('modelname', 'record')
+            self.db.get_record_authors('modelname', 'record')
+        self.assertEqual(get.call_count, 1)
+
+    def test_unknown_model_is_looked_up_once(self):
+        with mock.patch.object(self.backend, 'get_model_definition',
+                               wraps=self.backend.get_model_definition) as get:
+            for i in range(2):
+                self.assertRaises(backend_exceptions.ModelNotFound,
+                                  self.db.get_model_definition, 'unknown')
+        self.assertEqual(get.call_count, 1)
+
+    def test_credentials_key_is_read_once(self):
+        token, credentials = get_hawk_credentials()
+        with mock.patch.object(self.backend, 'get_credentials_key',
+                               wraps=self.backend.get_credentials_key) as get:
+            self.assertRaises(backend_exceptions.CredentialsNotFound,
+                              self.db.get_credentials_key, credentials['id'])
+            self.db.store_credentials(token, credentials)
+            for i in range(2):
+                key = self.db.get_credentials_key(credentials['id'])
+                self.assertEqual(key, credentials['key'])
+        self.assertEqual(get.call_count, 2)
+
+    def test_record_is_read_again_once_written(self):
+        self._create_model()
+        self.db.put_record('modelname', {'age': 1}, ['Alexis'], 'record')
+        self.db.get_record('modelname', 'record')
+        self.db.put_record('modelname', {'age': 2}, ['Alexis'], 'record')
+        self.assertEqual(self.db.get_record('modelname', 'record')['age'], 2)
+
+
+class TestTTLCache(TestCase):
+
+    def test_entries_expire(self):
+        cache = TTLCache(ttl=-1)
+        cache.set('key', 'value')
+        self.assertRaises(KeyError, cache.get, 'key')
+
+    def test_entries_ttl_can_be_given(self):
+        cache = TTLCache(ttl=60)
+        cache.set('key', 'value', ttl=-1)
+        self.assertRaises(KeyError, cache.get, 'key')
+
+    def test_values_read_before_a_deletion_are_not_stored(self):
+        cache = TTLCache()
+        generation = cache.stamp()
+        cache.delete('key')
+        cache.set('key', 'stale', generation=generation)
+        self.assertRaises(KeyError, cache.get, 'key')
+        cache.set('key', 'value', generation=cache.stamp())
+        self.assertEqual(cache.get('key'), 'value')
+
+    def test_values_read_before_a_write_or_clear_are_not_stored(self):
+        cache = TTLCache()
+        generation = cache.stamp()
+        cache.set('key', 'fresh')
+        cache.set('key', 'stale', generation=generation)
+        self.assertEqual(cache.get('key'), 'fresh')
+        generation = cache.stamp()
+        cache.clear()
+        cache.set('key', 'stale', generation=generation)
+        self.assertRaises(KeyError, cache.get, 'key')
+
+    def test_least_recently_used_entries_are_dropped(self):
+        cache = TTLCache(size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertRaises(KeyError, cache.get, 'b')
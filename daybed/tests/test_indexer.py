@@ -1,15 +1,43 @@
 import decimal
 import json
 import copy
+import os
+import tempfile
+import threading
 import mock
 
+from daybed.backends.id_generators import KoremutakeGenerator
+from daybed.backends.memory import MemoryBackend
 from daybed.schemas import registry
 from daybed import indexer
 
-from .support import BaseWebTest
+from .support import BaseWebTest, unittest
 from .test_views import MODEL_DEFINITION, MODEL_RECORD
 
 
+def mock_aliases(client, current='test_model_v1'):
+    """Makes the ``client`` mock resolve the model alias to ``current``,
+    and the aliases given on index creation to the created index.
+    """
+    aliases = {}
+
+    def create(index, body=None):
+        for alias in (body or {}).get('aliases', {}):
+            aliases[alias] = index
+
+    def get_alias(name):
+        if name in aliases:
+            return {aliases[name]: {}}
+        if current is None or name.endswith('_reindexing'):
+            raise indexer.NotFoundError
+        return {current: {}}
+
+    client.indices.create.side_effect = create
+    client.indices.get_alias.side_effect = get_alias
+    client.mget.return_value = {'docs': []}
+    return aliases
+
+
 class ModelsIndicesTest(BaseWebTest):
 
     @mock.patch('elasticsearch.client.indices.IndicesClient.create')
@@ -69,12 +97,53 @@ class ModelsIndicesTest(BaseWebTest):
         self.assertEqual(delete_mock.call_count, 0)
 
     @mock.patch('elasticsearch.client.indices.IndicesClient.delete_mapping')
-    def test_existing_mapping_is_deleted_on_put(self, delete_mapping_mock):
+    def test_existing_mapping_is_not_deleted_on_put(self, delete_mapping_mock):
         self.app.put_json('/models/test', MODEL_DEFINITION,
                           headers=self.headers)
         self.app.put_json('/models/test', MODEL_DEFINITION,
                           headers=self.headers)
-        self.assertEqual(delete_mapping_mock.call_count, 1)
+        self.assertEqual(delete_mapping_mock.call_count, 0)
+
+    @mock.patch('elasticsearch.client.indices.IndicesClient.update_aliases')
+    def test_existing_records_are_reindexed_on_put(self, update_aliases_mock):
+        self.app.put_json('/models/test', MODEL_DEFINITION,
+                          headers=self.headers)
+        definition = copy.deepcopy(MODEL_DEFINITION)
+        definition['definition']['fields'].append({'name': 'nickname',
+                                                   'type': 'string'})
+        self.app.put_json('/models/test', definition,
+                          headers=self.headers)
+        self.indexer.wait_reindexes()
+        self.assertEqual(update_aliases_mock.call_count, 1)
+
+    @mock.patch('daybed.indexer.ElasticSearchIndexer.mapping_changed')
+    @mock.patch('daybed.indexer.ElasticSearchIndexer.reindex')
+    def test_records_are_not_reindexed_if_mapping_is_unchanged(
+            self, reindex_mock, mapping_changed_mock):
+        mapping_changed_mock.return_value = False
+        self.app.put_json('/models/test', MODEL_DEFINITION,
+                          headers=self.headers)
+        self.app.put_json('/models/test', MODEL_DEFINITION,
+                          headers=self.headers)
+        self.indexer.wait_reindexes()
+        self.assertTrue(mapping_changed_mock.called)
+        self.assertFalse(reindex_mock.called)
+
+    @mock.patch('daybed.indexer.logger.error')
+    @mock.patch('daybed.indexer.ElasticSearchIndexer.mapping_changed',
+                return_value=True)
+    @mock.patch('daybed.indexer.ElasticSearchIndexer.reindex')
+    def test_model_is_updated_if_reindex_fails(self, reindex_mock,
+                                               mapping_changed_mock,
+                                               error_mock):
+        error = ValueError('backend failure')
+        reindex_mock.side_effect = error
+        self.app.put_json('/models/test', MODEL_DEFINITION,
+                          headers=self.headers)
+        self.app.put_json('/models/test', MODEL_DEFINITION,
+                          headers=self.headers)
+        self.indexer.wait_reindexes()
+        error_mock.assert_called_with(error)
 
     @mock.patch('elasticsearch.client.indices.IndicesClient.delete')
     def test_index_deleted_on_model_deletion(self, delete_index_mock):
@@ -86,6 +155,18 @@ class ModelsIndicesTest(BaseWebTest):
             index=self.app.app.registry.index.prefix('test')
         )
 
+    @mock.patch('daybed.indexer.ElasticSearchIndexer.next_index',
+                return_value='daybed_tests_test_v2')
+    @mock.patch('elasticsearch.client.indices.IndicesClient.delete')
+    def test_index_being_filled_deleted_on_model_deletion(
+            self, delete_index_mock, next_index_mock):
+        self.app.put_json('/models/test', MODEL_DEFINITION,
+                          headers=self.headers)
+        self.app.delete('/models/test',
+                        headers=self.headers)
+        delete_index_mock.assert_any_call(index='daybed_tests_test_v2',
+                                          ignore=404)
+
     @mock.patch('daybed.indexer.logger.error')
     @mock.patch('elasticsearch.client.indices.IndicesClient.delete')
     def test_no_exception_on_model_deletion_when_index_fails(self,
@@ -122,6 +203,13 @@ class RecordsIndicesTest(BaseWebTest):
                                headers=self.headers)
         self.assertEqual(index_mock.call_count, 3)
 
+    @mock.patch('elasticsearch.client.Elasticsearch.bulk')
+    def test_records_indexed_at_once_on_bulk_post(self, bulk_mock):
+        self.app.post_json('/models/test/bulk', [MODEL_RECORD] * 3,
+                           headers=self.headers)
+        self.assertEqual(bulk_mock.call_count, 1)
+        self.assertEqual(len(bulk_mock.call_args[1]['body']), 6)
+
     @mock.patch('elasticsearch.client.Elasticsearch.index')
     def test_record_indexed_on_put(self, index_mock):
         self.app.put_json('/models/test/records/1', MODEL_RECORD,
@@ -168,26 +256,39 @@ class RecordsIndicesTest(BaseWebTest):
                         headers=self.headers)
         self.assertTrue(error_mock.called)
 
-    @mock.patch('elasticsearch.client.Elasticsearch.index')
-    def test_record_indexed_on_model_post(self, index_mock):
+    def indexed_ids(self, bulk_mock, model_id='test'):
+        """Returns the ids of the records indexed with ``_bulk`` in the
+        model index.
+        """
+        return [action['index']['_id']
+                for call in bulk_mock.call_args_list
+                for action in call[1]['body'][::2]
+                if action.get('index', {}).get('_index') ==
+                self.indexer.prefix(model_id)]
+
+    @mock.patch('elasticsearch.client.Elasticsearch.bulk')
+    def test_records_indexed_at_once_on_model_post(self, bulk_mock):
         definition = MODEL_DEFINITION.copy()
         for i in range(3):
             definition.setdefault('records', []).append(MODEL_RECORD)
-        self.app.post_json('/models', definition,
-                           headers=self.headers)
-        self.assertEqual(index_mock.call_count, 3)
-
-    @mock.patch('elasticsearch.client.Elasticsearch.index')
-    def test_record_indexed_on_model_put(self, index_mock):
+        resp = self.app.post_json('/models', definition,
+                                  headers=self.headers)
+        self.assertEqual(bulk_mock.call_count, 1)
+        self.assertEqual(len(self.indexed_ids(bulk_mock, resp.json['id'])),
+                         3)
+
+    @mock.patch('elasticsearch.client.Elasticsearch.bulk')
+    def test_records_indexed_at_once_on_model_put(self, bulk_mock):
         definition = MODEL_DEFINITION.copy()
         for i in range(3):
             definition.setdefault('records', []).append(MODEL_RECORD)
         self.app.put_json('/models/test', definition,
                           headers=self.headers)
-        self.assertEqual(index_mock.call_count, 3)
+        self.assertEqual(len(self.indexed_ids(bulk_mock)), 3)
 
-    @mock.patch('elasticsearch.client.Elasticsearch.index')
-    def test_existing_records_unindexed_on_model_put(self, delete_mock):
+    @mock.patch('elasticsearch.client.Elasticsearch.bulk')
+    def test_no_records_indexed_on_model_put_without_records(self,
+                                                             bulk_mock):
         no_records = MODEL_DEFINITION.copy()
         with_records = MODEL_DEFINITION.copy()
         for i in range(3):
@@ -196,7 +297,8 @@ class RecordsIndicesTest(BaseWebTest):
                           headers=self.headers)
         self.app.put_json('/models/test', no_records,
                           headers=self.headers)
-        self.assertEqual(delete_mock.call_count, 3)
+        self.indexer.wait_reindexes()
+        self.assertEqual(len(self.indexed_ids(bulk_mock)), 3)
 
 
 ALL_FIELDS_DEFINITION = {
@@ -424,3 +526,272 @@ class SpatialSearchTest(BaseWebTest):
         }
         results = self.spatialSearch(bbox_match)
         self.assertEqual(len(results), 2)
+
+
+class BulkIndexingQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = mock.MagicMock()
+        self.client.bulk.return_value = {'errors': False, 'items': []}
+        self.queue = indexer.BulkIndexingQueue(self.client, batch_size=10,
+                                               flush_interval=60)
+
+    def test_actions_are_sent_at_once_on_flush(self):
+        self.queue.push({'index': {'_id': '1'}}, {'age': 1})
+        self.queue.push({'delete': {'_id': '2'}})
+        self.queue.flush()
+        self.client.bulk.assert_called_once_with(body=[
+            {'index': {'_id': '1'}}, {'age': 1}, {'delete': {'_id': '2'}}
+        ])
+
+    def test_queued_actions_are_sent_when_closed(self):
+        self.queue.push({'delete': {'_id': '1'}})
+        self.queue.close()
+        self.assertFalse(self.queue._thread.is_alive())
+        self.client.bulk.assert_called_once_with(body=[
+            {'delete': {'_id': '1'}}
+        ])
+
+    @mock.patch('daybed.indexer.atexit.register')
+    def test_queue_is_closed_at_exit(self, register_mock):
+        queue = indexer.BulkIndexingQueue(self.client, flush_interval=60)
+        register_mock.assert_called_with(queue.close)
+        queue.close()
+
+    def test_nothing_is_sent_if_queue_is_empty(self):
+        self.queue.flush()
+        self.assertFalse(self.client.bulk.called)
+
+    @mock.patch('daybed.indexer.logger.error')
+    def test_failed_actions_are_journaled_and_sent_again(self, error_mock):
+        journal = tempfile.mktemp()
+        self.queue.journal = journal
+        self.client.bulk.side_effect = indexer.ElasticsearchException
+        self.queue.push({'delete': {'_id': '1'}})
+        self.queue.flush()
+        self.assertTrue(os.path.exists(journal + '.pending'))
+
+        self.client.bulk.side_effect = None
+        self.client.bulk.reset_mock()
+        self.queue.push({'delete': {'_id': '2'}})
+        self.queue.flush()
+        self.client.bulk.assert_called_once_with(body=[
+            {'delete': {'_id': '1'}}, {'delete': {'_id': '2'}}
+        ])
+        self.assertFalse(os.path.exists(journal))
+        self.assertFalse(os.path.exists(journal + '.pending'))
+
+    def test_queued_actions_are_sent_by_next_process_after_a_crash(self):
+        journal = tempfile.mktemp()
+        self.queue.journal = journal
+        self.queue.push({'index': {'_id': '1'}}, {'age': 1})
+        # Killed before flushing: the next process sends them.
+        queue = indexer.BulkIndexingQueue(self.client, flush_interval=60,
+                                          journal=journal)
+        queue.close()
+        self.client.bulk.assert_called_once_with(body=[
+            {'index': {'_id': '1'}}, {'age': 1}
+        ])
+        self.assertFalse(os.path.exists(journal))
+
+    @mock.patch('daybed.indexer.logger.error')
+    def test_failed_actions_are_lost_without_journal(self, error_mock):
+        self.client.bulk.side_effect = indexer.ElasticsearchException
+        self.queue.push({'delete': {'_id': '1'}})
+        self.queue.flush()
+        error_mock.assert_called_with("1 indexing actions lost.")
+
+    def test_indexer_queues_records_instead_of_indexing_them(self):
+        index = indexer.ElasticSearchIndexer(['localhost:9200'], 'test',
+                                             {'flush_interval': 60})
+        index.client = mock.MagicMock()
+        index.queue = mock.MagicMock()
+        event = mock.MagicMock(model_id='test', record_id='1')
+        event.request.db.get_model_definition.return_value = \
+            MODEL_DEFINITION['definition']
+        event.request.db.get_record.return_value = MODEL_RECORD
+        index.on_record_created(event)
+        self.assertFalse(index.client.index.called)
+        self.assertTrue(index.queue.push.called)
+
+
+class ReindexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.indexer = indexer.ElasticSearchIndexer(['localhost:9200'], 'test',
+                                                    reindex_batch_size=2,
+                                                    reindex_delay=0)
+        self.client = self.indexer.client = mock.MagicMock()
+        self.aliases = mock_aliases(self.client)
+        self.client.bulk.return_value = {'errors': False, 'items': []}
+
+        self.db = MemoryBackend(KoremutakeGenerator())
+        self.db.put_model(MODEL_DEFINITION['definition'], {}, 'model')
+        for i in range(3):
+            self.db.put_record('model', {'age': i}, ['Alexis'], str(i))
+
+    def copied_ids(self):
+        return [[action['create']['_id'] for action in call[1]['body'][::2]]
+                for call in self.client.bulk.call_args_list]
+
+    def test_records_are_copied_by_batches_to_a_new_index(self):
+        self.assertEqual(self.indexer.reindex(self.db, 'model'), 3)
+        self.client.indices.create.assert_called_with(
+            index='test_model_v2',
+            body={'mappings': {'model': self.indexer._definition_as_mapping(
+                MODEL_DEFINITION['definition'])},
+                  'aliases': {'test_model_reindexing': {}}})
+        self.assertEqual(self.copied_ids(), [['0', '1'], ['2']])
+        action = self.client.bulk.call_args[1]['body'][0]['create']
+        self.assertEqual(action['_index'], 'test_model_v2')
+
+    def test_alias_is_swapped_and_previous_index_deleted(self):
+        self.indexer.reindex(self.db, 'model')
+        self.client.indices.update_aliases.assert_called_with(body={
+            'actions': [
+                {'remove': {'index': 'test_model_v1', 'alias': 'test_model'}},
+                {'remove': {'index': 'test_model_v2',
+                            'alias': 'test_model_reindexing'}},
+                {'add': {'index': 'test_model_v2', 'alias': 'test_model'}}
+            ]})
+        self.client.indices.delete.assert_called_with(index='test_model_v1',
+                                                      ignore=404)
+
+    def test_index_created_without_alias_is_replaced(self):
+        mock_aliases(self.client, current=None)
+        self.client.indices.exists.return_value = True
+        self.indexer.reindex(self.db, 'model')
+        self.client.indices.delete.assert_called_with(index='test_model')
+        self.client.indices.update_aliases.assert_called_with(body={
+            'actions': [
+                {'remove': {'index': 'test_model_v1',
+                            'alias': 'test_model_reindexing'}},
+                {'add': {'index': 'test_model_v1', 'alias': 'test_model'}}
+            ]})
+
+    def test_previous_index_is_kept_if_copy_fails(self):
+        self.client.bulk.side_effect = indexer.ElasticsearchException
+        self.assertRaises(indexer.ElasticsearchException,
+                          self.indexer.reindex, self.db, 'model')
+        self.assertFalse(self.client.indices.update_aliases.called)
+        self.client.indices.delete.assert_called_with(index='test_model_v2',
+                                                      ignore=404)
+
+    def test_unfinished_reindex_index_is_discarded(self):
+        self.aliases['test_model_reindexing'] = 'test_model_v3'
+        self.indexer.reindex(self.db, 'model')
+        self.client.indices.delete.assert_any_call(index='test_model_v3',
+                                                   ignore=404)
+        self.assertEqual(self.client.indices.create.call_args[1]['index'],
+                         'test_model_v4')
+
+    def test_index_replaced_meanwhile_is_not_switched(self):
+        def progress(count):
+            self.aliases['test_model_reindexing'] = 'test_model_v3'
+
+        self.assertRaises(indexer.ReindexError, self.indexer.reindex,
+                          self.db, 'model', progress=progress)
+        self.assertFalse(self.client.indices.update_aliases.called)
+        self.client.indices.delete.assert_called_with(index='test_model_v2',
+                                                      ignore=404)
+
+    def test_records_written_meanwhile_by_any_process_are_indexed_in_both(
+            self):
+        # Another process, which learns about the reindex from Elasticsearch.
+        other = indexer.ElasticSearchIndexer(['localhost:9200'], 'test',
+                                             reindex_delay=0)
+        other.client = self.client
+        event = mock.MagicMock(model_id='model', record_id='1')
+        event.request.db = self.db
+
+        def progress(count):
+            if count == 2:
+                other.on_record_updated(event)
+
+        self.indexer.reindex(self.db, 'model', progress=progress)
+        indices = [call[1]['index']
+                   for call in self.client.index.call_args_list]
+        self.assertEqual(indices, ['test_model', 'test_model_v2'])
+
+    def test_records_deleted_meanwhile_are_marked_in_the_new_index(self):
+        event = mock.MagicMock(model_id='model', record_id='2')
+
+        def progress(count):
+            if count == 2:
+                self.indexer.on_record_deleted(event)
+
+        self.indexer.reindex(self.db, 'model', progress=progress)
+        self.client.index.assert_called_with(index='test_model_v2',
+                                             doc_type=indexer.DELETED_TYPE,
+                                             id='2', body={})
+        indices = [call[1]['index']
+                   for call in self.client.delete.call_args_list]
+        self.assertEqual(indices, ['test_model', 'test_model_v2'])
+
+    def test_mapping_changed_is_told_by_its_fingerprint(self):
+        definition = MODEL_DEFINITION['definition']
+        mapping = self.indexer._definition_as_mapping(definition)
+        self.client.indices.get_mapping.return_value = {
+            'test_model_v1': {'mappings': {'model': mapping}}}
+        self.assertFalse(self.indexer.mapping_changed('model', definition))
+        changed = copy.deepcopy(definition)
+        changed['fields'].append({'name': 'nickname', 'type': 'string'})
+        self.assertTrue(self.indexer.mapping_changed('model', changed))
+
+    def test_mapping_changed_without_fingerprint_or_index(self):
+        definition = MODEL_DEFINITION['definition']
+        self.client.indices.get_mapping.return_value = {
+            'test_model_v1': {'mappings': {'model': {'properties': {}}}}}
+        self.assertTrue(self.indexer.mapping_changed('model', definition))
+        self.client.indices.get_mapping.side_effect = indexer.NotFoundError
+        self.assertTrue(self.indexer.mapping_changed('model', definition))
+
+    def test_updates_received_while_reindexing_are_coalesced(self):
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def reindex(db, model_id):
+            calls.append(model_id)
+            started.set()
+            release.wait(5)
+
+        self.indexer.reindex = reindex
+        self.indexer.mapping_changed = mock.MagicMock(return_value=True)
+        event = mock.MagicMock(model_id='model')
+        event.request.registry.backend = self.db
+        self.indexer.on_model_updated(event)
+        self.assertTrue(started.wait(5))
+        for i in range(3):
+            self.indexer.on_model_updated(event)
+        release.set()
+        self.indexer.wait_reindexes()
+        self.assertEqual(calls, ['model', 'model'])
+
+    def test_indices_being_filled_are_not_looked_up_on_writes(self):
+        watching = indexer.ElasticSearchIndexer(['localhost:9200'], 'test',
+                                                reindex_delay=60)
+        watching.client = self.client
+        self.client.indices.get_alias.side_effect = None
+        self.client.indices.get_alias.return_value = {
+            'test_model_v2': {'aliases': {'test_model_reindexing': {}}}}
+        for i in range(3):
+            self.assertEqual(watching._indices('model'),
+                             ['test_model', 'test_model_v2'])
+        self.assertEqual(watching._indices('other'), ['test_other'])
+        self.client.indices.get_alias.assert_called_once_with(
+            name='test_*_reindexing')
+
+    def test_copied_records_marked_as_deleted_are_removed(self):
+        self.client.mget.return_value = {'docs': [
+            {'_id': '0', 'found': True}, {'_id': '1', 'found': False}]}
+        records = [{'id': '0', 'age': 0}, {'id': '1', 'age': 1}]
+        self.indexer.bulk_create(indexer.create_actions(
+            'model', 'test_model_v2', MODEL_DEFINITION['definition'],
+            records))
+        self.client.mget.assert_called_with(index='test_model_v2',
+                                            doc_type=indexer.DELETED_TYPE,
+                                            body={'ids': ['0', '1']})
+        self.client.bulk.assert_called_with(body=[
+            {'delete': {'_index': 'test_model_v2', '_type': 'model',
+                        '_id': '0'}}])
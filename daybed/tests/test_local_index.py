@@ -0,0 +1,276 @@
+import json
+import threading
+
+import mock
+import webtest
+from pyramid.paster import get_appsettings
+
+from daybed import main
+from daybed.backends.memory import MemoryBackend
+from daybed.local_index import LocalIndexer, ModelIndex, parse_sort
+from daybed.indexer import SearchError
+
+from .support import BaseWebTest, unittest
+
+
+DEFINITION = {
+    'title': 'people',
+    'description': 'People',
+    'fields': [{'name': 'name', 'type': 'string'},
+               {'name': 'age', 'type': 'int', 'required': False},
+               {'name': 'city', 'type': 'string', 'required': False}]
+}
+
+PEOPLE = [
+    {'id': 'a', 'name': 'Alexis Metaireau', 'age': 28, 'city': 'Paris'},
+    {'id': 'b', 'name': 'Remy Hubscher', 'age': 31, 'city': 'Rennes'},
+    {'id': 'c', 'name': 'Mathieu Leplatre', 'age': 34, 'city': 'Paris'},
+    {'id': 'd', 'name': 'Remy Remy', 'city': 'Lyon'},
+]
+
+
+class ModelIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = ModelIndex()
+        for person in PEOPLE:
+            self.index.add(person['id'], person)
+
+    def search(self, query):
+        return sorted(self.index.query(query))
+
+    def test_match_all_returns_every_document(self):
+        self.assertEqual(self.search({'match_all': {}}), ['a', 'b', 'c', 'd'])
+
+    def test_term_is_looked_up_in_analyzed_strings(self):
+        self.assertEqual(self.search({'term': {'city': 'paris'}}),
+                         ['a', 'c'])
+        self.assertEqual(self.search({'term': {'city': 'Paris'}}), [])
+
+    def test_term_matches_numbers(self):
+        self.assertEqual(self.search({'term': {'age': {'value': 31}}}),
+                         ['b'])
+
+    def test_terms_matches_any_value(self):
+        self.assertEqual(self.search({'terms': {'age': [28, 34]}}),
+                         ['a', 'c'])
+
+    def test_match_analyzes_the_query(self):
+        self.assertEqual(self.search({'match': {'name': 'REMY alexis'}}),
+                         ['a', 'b', 'd'])
+        query = {'match': {'name': {'query': 'remy hubscher',
+                                    'operator': 'and'}}}
+        self.assertEqual(self.search(query), ['b'])
+
+    def test_match_scores_frequent_terms_lower(self):
+        scores = self.index.query({'match': {'name': 'remy mathieu'}})
+        self.assertGreater(scores['c'], scores['b'])
+
+    def test_range_uses_bounds(self):
+        self.assertEqual(self.search({'range': {'age': {'gte': 28,
+                                                        'lt': 34}}}),
+                         ['a', 'b'])
+        self.assertEqual(self.search({'range': {'age': {'gt': 28}}}),
+                         ['b', 'c'])
+        self.assertEqual(self.search({'range': {'name': {'lte': 'N'}}}),
+                         ['a', 'c'])
+
+    def test_bool_combines_clauses(self):
+        query = {'bool': {'must': {'term': {'city': 'paris'}},
+                          'must_not': [{'range': {'age': {'lt': 30}}}]}}
+        self.assertEqual(self.search(query), ['c'])
+        query = {'bool': {'should': [{'term': {'city': 'lyon'}},
+                                     {'term': {'age': 28}}]}}
+        self.assertEqual(self.search(query), ['a', 'd'])
+        query = {'bool': {'filter': {'term': {'name': 'remy'}},
+                          'should': {'term': {'city': 'lyon'}},
+                          'minimum_should_match': 1}}
+        self.assertEqual(self.search(query), ['d'])
+
+    def test_filtered_restricts_the_query(self):
+        query = {'filtered': {'query': {'match': {'name': 'remy'}},
+                              'filter': {'range': {'age': {'gte': 30}}}}}
+        self.assertEqual(self.search(query), ['b'])
+
+    def test_removed_documents_are_not_found(self):
+        self.index.remove('a')
+        self.assertEqual(self.search({'term': {'city': 'paris'}}), ['c'])
+        self.assertEqual(self.search({'range': {'age': {'lt': 30}}}), [])
+
+    def test_updated_documents_are_reindexed(self):
+        self.index.add('a', {'name': 'Alexis', 'age': 40, 'city': 'Lyon'})
+        self.assertEqual(self.search({'term': {'city': 'lyon'}}),
+                         ['a', 'd'])
+        self.assertEqual(self.search({'range': {'age': {'lt': 30}}}), [])
+
+    def test_documents_added_at_once_are_sorted_once(self):
+        index = ModelIndex()
+        index.add('e', {'age': 29})
+        index.extend([(p['id'], p) for p in reversed(PEOPLE)] +
+                     [('a', {'age': 40})])
+        self.index.add('e', {'age': 29})
+        self.index.add('a', {'age': 40})
+        self.assertEqual(index.values['age'][1], ['e', 'b', 'c', 'a'])
+        self.assertEqual(index.values, self.index.values)
+        self.assertEqual(index.terms, self.index.terms)
+        self.assertEqual(index.documents, self.index.documents)
+
+    def test_nested_objects_and_lists_are_flattened(self):
+        self.index.add('e', {'place': {'tags': ['Sea', 'sun']}})
+        self.assertEqual(self.search({'term': {'place.tags': 'sea'}}), ['e'])
+
+    def test_unsupported_queries_are_refused(self):
+        self.assertRaises(ValueError, self.index.query, {'fuzzy': {}})
+        self.assertRaises(ValueError, self.index.query,
+                          {'range': {'age': {'near': 3}}})
+
+    def test_sort_by_a_single_field_walks_its_values(self):
+        scores = self.index.query({'match_all': {}})
+        self.assertEqual(self.index.sort(scores, [('age', False)], 10),
+                         ['a', 'b', 'c', 'd'])
+        self.assertEqual(self.index.sort(scores, [('age', True)], 2),
+                         ['c', 'b'])
+
+    def test_sort_by_several_fields(self):
+        scores = self.index.query({'match_all': {}})
+        sort = [('city', True), ('age', True)]
+        self.assertEqual(self.index.sort(scores, sort, 10),
+                         ['b', 'c', 'a', 'd'])
+
+    def test_sort_is_parsed_from_body_and_querystring(self):
+        self.assertEqual(parse_sort('age:desc,name'),
+                         [('age', True), ('name', False)])
+        self.assertEqual(parse_sort(['name', {'age': 'desc'},
+                                     {'city': {'order': 'asc'}}]),
+                         [('name', False), ('age', True), ('city', False)])
+
+
+class LocalIndexerTest(unittest.TestCase):
+    def setUp(self):
+        self.db = MemoryBackend(mock.MagicMock(return_value='people'))
+        self.db.put_model(DEFINITION, {}, 'people')
+        for person in PEOPLE:
+            person = person.copy()
+            self.db.put_record('people', person, ['alexis'],
+                               person.pop('id'))
+        self.indexer = LocalIndexer(db=self.db)
+
+    def search(self, query, **params):
+        return self.indexer.search('people', json.dumps(query), params)
+
+    def test_index_is_built_from_backend(self):
+        results = self.search({'query': {'term': {'city': 'paris'}}})
+        self.assertEqual(results['hits']['total'], 2)
+        self.assertEqual(sorted(h['_id'] for h in results['hits']['hits']),
+                         ['a', 'c'])
+
+    def test_response_has_elasticsearch_shape(self):
+        results = self.search({'query': {'match': {'name': 'mathieu'}}})
+        self.assertFalse(results['timed_out'])
+        hit, = results['hits']['hits']
+        self.assertEqual(hit['_source']['name'], 'Mathieu Leplatre')
+        self.assertEqual(hit['_type'], 'people')
+        self.assertEqual(hit['_score'], results['hits']['max_score'])
+
+    def test_empty_query_matches_everything(self):
+        results = self.indexer.search('people', '', {})
+        self.assertEqual(results['hits']['total'], 4)
+
+    def test_from_and_size_paginate_sorted_hits(self):
+        results = self.search({'sort': [{'age': 'desc'}], 'from': 1,
+                               'size': 2})
+        self.assertEqual(results['hits']['total'], 4)
+        hits = results['hits']['hits']
+        self.assertEqual([h['_id'] for h in hits], ['b', 'a'])
+        self.assertEqual([h['sort'] for h in hits], [[31], [28]])
+
+    def test_querystring_parameters_override_body(self):
+        results = self.search({'size': 1}, size='3', sort='age')
+        self.assertEqual([h['_id'] for h in results['hits']['hits']],
+                         ['a', 'b', 'c'])
+
+    def test_invalid_queries_raise_search_errors(self):
+        self.assertRaises(SearchError, self.indexer.search, 'people',
+                          '{"query"', {})
+        self.assertRaises(SearchError, self.search, {'query': {'prefix': {}}})
+
+    def test_unknown_models_are_empty(self):
+        results = self.indexer.search('unknown', '', {})
+        self.assertEqual(results['hits']['total'], 0)
+
+    def test_records_are_indexed_from_the_request_data(self):
+        self.search({})
+        event = mock.MagicMock(model_id='people', record_id='e')
+        event.request.data_clean = {'name': 'Ada', 'city': 'Paris'}
+        self.indexer.on_record_created(event)
+        self.assertFalse(event.request.db.get_record.called)
+        self.assertFalse(event.request.db.get_model_definition.called)
+        results = self.search({'query': {'term': {'city': 'paris'}}})
+        self.assertEqual(results['hits']['total'], 3)
+
+    def test_models_are_searched_while_another_is_filled(self):
+        self.search({})
+        filling = threading.Event()
+        release = threading.Event()
+        db = self.indexer.db = mock.MagicMock()
+
+        def get_paginated_records(*args):
+            filling.set()
+            release.wait(5)
+            return [], None
+
+        db.get_paginated_records.side_effect = get_paginated_records
+        thread = threading.Thread(target=self.indexer.search,
+                                  args=('other', '', {}))
+        thread.start()
+        try:
+            self.assertTrue(filling.wait(5))
+            results = self.search({})
+            self.assertFalse(release.is_set())
+        finally:
+            release.set()
+            thread.join()
+        self.assertEqual(results['hits']['total'], 4)
+
+
+class LocalSearchViewTest(BaseWebTest):
+
+    def get_app(self):
+        settings = get_appsettings('conf/tests.ini')
+        settings['daybed.indexer'] = 'daybed.local_index.LocalIndexer'
+        return webtest.TestApp(main({}, **settings))
+
+    def setUp(self):
+        super(LocalSearchViewTest, self).setUp()
+        self.app.put_json('/models/people', {'definition': DEFINITION},
+                          headers=self.headers)
+        for person in PEOPLE:
+            person = person.copy()
+            self.app.put_json('/models/people/records/%s' % person.pop('id'),
+                              person, headers=self.headers)
+
+    def test_indexer_is_chosen_in_settings(self):
+        self.assertIsInstance(self.indexer, LocalIndexer)
+
+    def test_search_finds_created_records(self):
+        query = {'query': {'bool': {'must': {'term': {'city': 'paris'}},
+                                    'filter': {'range': {'age': {'gt': 30}}}}}}
+        response = self.app.post_json('/models/people/search/', query,
+                                      headers=self.headers)
+        hits = response.json['hits']['hits']
+        self.assertEqual([h['_id'] for h in hits], ['c'])
+
+    def test_search_follows_updates_and_deletions(self):
+        self.app.patch_json('/models/people/records/a', {'city': 'Lyon'},
+                            headers=self.headers)
+        self.app.delete('/models/people/records/d', headers=self.headers)
+        response = self.app.post_json('/models/people/search/?sort=age',
+                                      {'query': {'term': {'city': 'lyon'}}},
+                                      headers=self.headers)
+        hits = response.json['hits']['hits']
+        self.assertEqual([h['_id'] for h in hits], ['a'])
+
+    def test_unsupported_queries_return_400(self):
+        response = self.app.post_json('/models/people/search/',
+                                      {'query': {'fuzzy': {'name': 'rmy'}}},
+                                      headers=self.headers, status=400)
+        self.assertIn('fuzzy', response.json['msg'])
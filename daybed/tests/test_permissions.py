@@ -7,10 +7,15 @@ import mock
 from pyramid.security import Authenticated
 
 from daybed.backends import exceptions
+from daybed.backends.cache import RequestBackend
+from daybed.backends.id_generators import KoremutakeGenerator
+from daybed.backends.memory import MemoryBackend
 from daybed.permissions import (
     All, Any, DaybedAuthorizationPolicy,
     invert_permissions_matrix, dict_set2list, dict_list2set,
-    default_model_permissions, PERMISSIONS_SET, merge_permissions
+    default_model_permissions, PERMISSIONS_SET, merge_permissions,
+    permission_bit, permissions_mask, mask_permissions, permissions_matrix,
+    PERMISSIONS_BITS
 )
 
 
@@ -55,6 +60,24 @@ class TestAnyAll(TestCase):
         self.assertFalse(All([Any(['un', 'deux']), Any(['trois', 'quatre'])])
             .matches(['un', 'deux']))
 
+    def test_compiled(self):
+        matches = All(['read_definition',
+                       Any(['read_all_records',
+                            All(['read_own_records',
+                                 'update_own_records'])])]).compile()
+        self.assertTrue(matches(permissions_mask(['read_definition',
+                                                  'read_all_records'])))
+        self.assertTrue(matches(permissions_mask(['read_definition',
+                                                  'read_own_records',
+                                                  'update_own_records'])))
+        self.assertFalse(matches(permissions_mask(['read_definition',
+                                                   'read_own_records'])))
+        self.assertFalse(matches(permissions_mask(['read_all_records',
+                                                   'delete_model'])))
+
+        self.assertTrue(All().compile()(0))
+        self.assertFalse(Any().compile()(permissions_mask(['create_model'])))
+
 
 class TestPermissionTools(TestCase):
 
@@ -100,6 +123,31 @@ class TestPermissionTools(TestCase):
         self.assertDictEqual(invert_permissions_matrix(model_permissions),
                              credentials_ids_permissions)
 
+    def test_permissions_bits_are_assigned_once(self):
+        for name in PERMISSIONS_SET:
+            self.assertIn(name, PERMISSIONS_BITS)
+        bits = list(PERMISSIONS_BITS.values())
+        self.assertEqual(len(set(bits)), len(bits))
+        self.assertRaises(KeyError, permission_bit, 'unknown')
+
+    def test_permissions_matrix_ignores_unknown_permissions(self):
+        matrix = permissions_matrix({'read_definition': ['admin'],
+                                     'unknown': ['admin', 'alexis']})
+        self.assertEqual(mask_permissions(matrix['admin']),
+                         set(['read_definition']))
+        self.assertEqual(matrix['alexis'], 0)
+
+    def test_permissions_matrix(self):
+        matrix = permissions_matrix({
+            'read_permissions': ['admin', 'alexis'],
+            'update_definition': ['admin'],
+        })
+        self.assertEqual(sorted(matrix.keys()), ['admin', 'alexis'])
+        self.assertEqual(mask_permissions(matrix['admin']),
+                         set(['read_permissions', 'update_definition']))
+        self.assertEqual(mask_permissions(matrix['alexis']),
+                         set(['read_permissions']))
+
 
 class MergePermissionsTest(TestCase):
     def test_from_empty_set(self):
@@ -164,6 +212,8 @@ class BasePolicyPermissionTest(TestCase):
     def setUp(self):
         self.policy = DaybedAuthorizationPolicy()
         self.context = mock.MagicMock()
+        self.context.db = mock.MagicMock(spec=['get_model_permissions',
+                                               'get_record_authors'])
         self.context.db.get_model_permissions.return_value = {}
 
     def permits(self, *args):
@@ -195,6 +245,32 @@ class PolicyPermissionTest(BasePolicyPermissionTest):
         self.context.db.get_record_authors.return_value = ['xyz']
         self.assertFalse(self.permits(['abc'], 'get_record'))
 
+    def test_permissions_are_exposed_to_views(self):
+        self.context.db.get_model_permissions.return_value = {
+            'read_definition': ['abc'],
+            'read_all_records': [Authenticated, 'xyz'],
+        }
+        self.permits(['abc', Authenticated], 'get_definition')
+        self.assertIn('read_all_records', self.context.request.permissions)
+        self.assertIn('read_definition', self.context.request.permissions)
+
+    def test_compiled_permissions_matrix_is_used(self):
+        self.context.db.get_model_permissions_matrix = mock.MagicMock(
+            return_value=permissions_matrix({
+                'read_definition': [Authenticated],
+                'read_own_records': ['abc'],
+            }))
+        self.assertTrue(self.permits(['abc', Authenticated], 'get_definition'))
+        self.assertFalse(self.permits(['xyz'], 'get_definition'))
+        self.assertFalse(self.context.db.get_model_permissions.called)
+
+    def test_authors_are_not_read_without_authors_permissions(self):
+        self.context.db.get_model_permissions.return_value = {
+            'read_all_records': ['abc']
+        }
+        self.assertTrue(self.permits(['abc'], 'get_record'))
+        self.assertFalse(self.context.db.get_record_authors.called)
+
 
 class UnknownModelPolicyPermissionTest(BasePolicyPermissionTest):
 
@@ -212,3 +288,44 @@ class UnknownModelPolicyPermissionTest(BasePolicyPermissionTest):
     def test_allowed_to_create_model_if_among_model_creators(self):
         self.policy.model_creators = ['abc']
         self.assertTrue(self.permits(['abc'], 'post_model'))
+
+
+class BackendPolicyPermissionTest(TestCase):
+
+    def setUp(self):
+        self.policy = DaybedAuthorizationPolicy()
+        self.backend = MemoryBackend(KoremutakeGenerator())
+        self.backend.put_model({}, {'read_definition': [Authenticated],
+                                    'read_own_records': ['abc']}, 'model')
+        self.context = mock.MagicMock(model_id='model', record_id=None)
+
+    def assertPermits(self, db):
+        self.context.db = db
+        self.assertTrue(self.policy.permits(self.context,
+                                            ['abc', Authenticated],
+                                            'get_definition'))
+        self.assertEqual(self.context.request.permissions,
+                         set(['read_definition', 'read_own_records']))
+        self.assertFalse(self.policy.permits(self.context, ['xyz'],
+                                             'get_definition'))
+
+    def test_memory_backend(self):
+        self.assertPermits(self.backend)
+
+    def test_request_backend(self):
+        self.assertPermits(RequestBackend(self.backend))
+
+    def test_request_backend_compiles_permissions_once(self):
+        db = RequestBackend(self.backend)
+        with mock.patch('daybed.backends.cache.permissions_matrix',
+                        wraps=permissions_matrix) as compile_matrix:
+            self.assertPermits(db)
+        self.assertEqual(compile_matrix.call_count, 1)
+
+    def test_request_backend_uses_the_compiled_permissions(self):
+        self.backend.get_model_permissions_matrix = mock.MagicMock(
+            return_value=permissions_matrix({'read_definition': ['abc']}))
+        self.context.db = RequestBackend(self.backend)
+        self.assertTrue(self.policy.permits(self.context, ['abc'],
+                                            'get_definition'))
+        self.assertTrue(self.backend.get_model_permissions_matrix.called)
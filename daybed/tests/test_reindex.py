@@ -0,0 +1,125 @@
+import json
+import os
+import shutil
+import tempfile
+
+import mock
+
+from daybed import indexer
+from daybed.backends.id_generators import KoremutakeGenerator
+from daybed.backends.memory import MemoryBackend
+from daybed.scripts import reindex
+
+from .support import unittest
+from .test_indexer import mock_aliases
+from .test_views import MODEL_DEFINITION
+
+
+class ReindexerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.indexer = indexer.ElasticSearchIndexer(['localhost:9200'], 'test',
+                                                    reindex_delay=0)
+        self.client = self.indexer.client = mock.MagicMock()
+        self.aliases = mock_aliases(self.client)
+        self.client.bulk.return_value = {'errors': False, 'items': []}
+
+        self.db = MemoryBackend(KoremutakeGenerator())
+        self.db.put_model(MODEL_DEFINITION['definition'], {}, 'model')
+        for i in range(5):
+            self.db.put_record('model', {'age': i}, ['Alexis'], str(i))
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.checkpoint = os.path.join(self.tmpdir, 'checkpoint')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def reindexer(self, **kwargs):
+        kwargs.setdefault('batch_size', 2)
+        kwargs.setdefault('checkpoints',
+                          reindex.Checkpoints(self.checkpoint))
+        return reindex.Reindexer(self.db, self.indexer, **kwargs)
+
+    def loaded_ids(self):
+        return [[action['create']['_id'] for action in call[1]['body'][::2]]
+                for call in self.client.bulk.call_args_list]
+
+    def test_records_are_loaded_by_batches_in_a_new_index(self):
+        self.reindexer().run(['model'])
+        self.assertEqual(self.loaded_ids(), [['0', '1'], ['2', '3'], ['4']])
+        self.client.indices.update_aliases.assert_called_with(body={
+            'actions': [
+                {'remove': {'index': 'test_model_v1', 'alias': 'test_model'}},
+                {'remove': {'index': 'test_model_v2',
+                            'alias': 'test_model_reindexing'}},
+                {'add': {'index': 'test_model_v2', 'alias': 'test_model'}}
+            ]})
+
+    def test_records_can_be_transformed_by_worker_processes(self):
+        self.reindexer(workers=2).run(['model'])
+        self.assertEqual(self.loaded_ids(), [['0', '1'], ['2', '3'], ['4']])
+
+    def test_progress_is_reported(self):
+        progress = mock.MagicMock()
+        self.reindexer(progress=progress).run(['model'])
+        self.assertEqual([call[0][:2] for call in progress.call_args_list],
+                         [('model', 2), ('model', 4), ('model', 5)])
+
+    def test_interrupted_run_is_resumed_from_checkpoint(self):
+        self.client.bulk.side_effect = [
+            {'errors': False, 'items': []}, indexer.ElasticsearchException]
+        self.assertRaises(indexer.ElasticsearchException,
+                          self.reindexer().run, ['model'])
+        self.assertFalse(self.client.indices.update_aliases.called)
+        with open(self.checkpoint) as f:
+            self.assertEqual(json.load(f)['model']['count'], 2)
+
+        self.client.bulk.side_effect = None
+        self.client.bulk.reset_mock()
+        self.client.indices.create.reset_mock()
+        self.reindexer().run(['model'])
+        self.assertEqual(self.loaded_ids(), [['2', '3'], ['4']])
+        self.assertFalse(self.client.indices.create.called)
+        self.assertTrue(self.client.indices.update_aliases.called)
+
+    def test_replaced_index_is_reindexed_from_scratch_on_resume(self):
+        self.client.bulk.side_effect = [
+            {'errors': False, 'items': []}, indexer.ElasticsearchException]
+        self.assertRaises(indexer.ElasticsearchException,
+                          self.reindexer().run, ['model'])
+        # Reindexed by the application meanwhile.
+        del self.aliases['test_model_reindexing']
+
+        self.client.bulk.side_effect = None
+        self.client.bulk.reset_mock()
+        self.reindexer().run(['model'])
+        self.assertEqual(self.loaded_ids(), [['0', '1'], ['2', '3'], ['4']])
+        self.assertEqual(self.client.indices.create.call_count, 2)
+
+    def test_reindexed_models_are_skipped_on_resume(self):
+        self.reindexer().run(['model'])
+        self.client.reset_mock()
+        self.reindexer().run(['model'])
+        self.assertFalse(self.client.bulk.called)
+        self.assertFalse(self.client.indices.create.called)
+
+    @mock.patch('daybed.scripts.reindex.time')
+    def test_loading_is_throttled(self, time_mock):
+        time_mock.time.return_value = 100
+        throttle = reindex.Throttle(max_rate=10)
+        throttle.wait(5)
+        time_mock.sleep.assert_called_with(0.5)
+
+    @mock.patch('daybed.scripts.reindex.bootstrap')
+    @mock.patch('daybed.scripts.reindex.setup_logging')
+    def test_command_reindexes_given_models(self, setup_logging, bootstrap):
+        closer = mock.MagicMock()
+        registry = mock.MagicMock(backend=self.db, index=self.indexer)
+        bootstrap.return_value = {'registry': registry, 'closer': closer}
+        with mock.patch('sys.stdout'):
+            reindex.main(['daybed-reindex', 'conf.ini', 'model',
+                          '--workers', '0', '--batch-size', '10'])
+        bootstrap.assert_called_with('conf.ini')
+        self.assertEqual(self.loaded_ids(), [['0', '1', '2', '3', '4']])
+        self.assertTrue(closer.called)
@@ -46,6 +46,44 @@ class ValidatorTests(unittest.TestCase):
         self.assertIsNone(self.request.data_clean['records'][0].get('name'))
 
 
+class RecordSchemaCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = validators.RecordSchemaCache(size=2)
+        self.definition = {'fields': [{'name': 'age', 'type': 'int'}]}
+
+    def test_schema_is_compiled_once_per_definition(self):
+        schema = self.cache.get('model', self.definition)
+        self.assertIs(self.cache.get('model', dict(self.definition)), schema)
+
+    def test_schema_is_compiled_again_if_definition_changes(self):
+        schema = self.cache.get('model', self.definition)
+        definition = {'fields': [{'name': 'name', 'type': 'string'}]}
+        self.assertIsNot(self.cache.get('model', definition), schema)
+
+    def test_least_recently_used_schemas_are_dropped(self):
+        schema = self.cache.get('a', self.definition)
+        self.cache.get('b', self.definition)
+        self.cache.get('a', self.definition)
+        self.cache.get('c', self.definition)
+        self.assertIs(self.cache.get('a', self.definition), schema)
+        self.assertEqual(len(self.cache._schemas), 2)
+
+    def test_invalidation_drops_model_schemas(self):
+        schema = self.cache.get('model', self.definition)
+        self.cache.invalidate('model')
+        self.assertIsNot(self.cache.get('model', self.definition), schema)
+
+    @mock.patch('daybed.schemas.base.datetime')
+    def test_autonow_values_are_resolved_for_each_record(self, datetime_mock):
+        datetime_mock.datetime.now.side_effect = ['first', 'second']
+        definition = {'fields': [{'name': 'created', 'type': 'datetime',
+                                  'autonow': True}]}
+        schema = self.cache.get('model', definition)
+        self.assertEqual(schema.deserialize({})['created'], 'first')
+        schema = self.cache.get('model', definition)
+        self.assertEqual(schema.deserialize({})['created'], 'second')
+
+
 class DefinitionSchemaTest(unittest.TestCase):
     def setUp(self):
         self.schema = schemas.TypeField.definition()
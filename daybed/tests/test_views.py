@@ -1,5 +1,6 @@
 import copy
 import base64
+import json
 
 import mock
 from webtest.app import TestRequest
@@ -551,6 +552,145 @@ class RecordsViewsTest(BaseWebTest):
         resp = self.app.get('/models/test/records')
         self.assertEqual(len(resp.json["records"]), 1)
 
+    def test_get_model_records_paginated(self):
+        self.app.put_json('/models/test', MODEL_DEFINITION,
+                          headers=self.headers)
+        for age in range(5):
+            self.app.post_json('/models/test/records', {'age': age},
+                               headers=self.headers)
+
+        resp = self.app.get('/models/test/records?limit=2',
+                            headers=self.headers)
+        self.assertEqual(len(resp.json['records']), 2)
+        self.assertIn('rel="next"', resp.headers['Link'])
+        ages = [r['age'] for r in resp.json['records']]
+
+        while 'next' in resp.json:
+            next_page = resp.json['next']
+            self.assertTrue(next_page.startswith(
+                'http://localhost/v1/models/test/records'))
+            resp = self.app.get(next_page.replace('http://localhost/v1', ''),
+                                headers=self.headers)
+            ages.extend([r['age'] for r in resp.json['records']])
+        self.assertNotIn('Link', resp.headers)
+        self.assertEqual(sorted(ages), list(range(5)))
+
+    def test_get_model_records_as_ndjson_stream(self):
+        self.app.put_json('/models/test', MODEL_DEFINITION,
+                          headers=self.headers)
+        for age in range(3):
+            self.app.post_json('/models/test/records', {'age': age},
+                               headers=self.headers)
+        headers = self.headers.copy()
+        headers['Accept'] = 'application/x-ndjson'
+        resp = self.app.get('/models/test/records', headers=headers)
+        self.assertEqual(resp.content_type, 'application/x-ndjson')
+        lines = resp.body.decode('utf-8').splitlines()
+        ages = [json.loads(line)['age'] for line in lines]
+        self.assertEqual(sorted(ages), [0, 1, 2])
+
+    def test_get_model_records_as_json_stream(self):
+        self.app.put_json('/models/test', MODEL_DEFINITION,
+                          headers=self.headers)
+        for age in range(3):
+            self.app.post_json('/models/test/records', {'age': age},
+                               headers=self.headers)
+        resp = self.app.get('/models/test/records?stream=1',
+                            headers=self.headers)
+        ages = [r['age'] for r in resp.json['records']]
+        self.assertEqual(sorted(ages), [0, 1, 2])
+
+    def test_get_model_records_rejects_invalid_limit(self):
+        self.app.put_json('/models/test', MODEL_DEFINITION,
+                          headers=self.headers)
+        for limit in ('0', '-1', 'abc'):
+            resp = self.app.get('/models/test/records?limit=%s' % limit,
+                                headers=self.headers, status=400)
+            self.assertEqual(resp.json['errors'][0]['name'], 'limit')
+
+    def test_get_model_records_rejects_invalid_cursor(self):
+        self.app.put_json('/models/test', MODEL_DEFINITION,
+                          headers=self.headers)
+        resp = self.app.get('/models/test/records?limit=2&cursor=bad',
+                            headers=self.headers, status=400)
+        self.assertEqual(resp.json['errors'][0]['name'], 'cursor')
+
+    def test_get_model_records_filtered_by_fields(self):
+        self.app.put_json('/models/test', MODEL_DEFINITION,
+                          headers=self.headers)
+        for age in [1, 2, 1, 3, 1]:
+            self.app.post_json('/models/test/records', {'age': age},
+                               headers=self.headers)
+
+        resp = self.app.get('/models/test/records?age=1',
+                            headers=self.headers)
+        self.assertEqual([r['age'] for r in resp.json['records']], [1] * 3)
+        resp = self.app.get('/models/test/records?age=2&stream=1',
+                            headers=self.headers)
+        self.assertEqual([r['age'] for r in resp.json['records']], [2])
+
+        resp = self.app.get('/models/test/records?age=1&limit=2',
+                            headers=self.headers)
+        ages = [r['age'] for r in resp.json['records']]
+        while 'next' in resp.json:
+            self.assertIn('age=1', resp.json['next'])
+            resp = self.app.get(
+                resp.json['next'].replace('http://localhost/v1', ''),
+                headers=self.headers)
+            ages.extend([r['age'] for r in resp.json['records']])
+        self.assertEqual(ages, [1] * 3)
+
+    def test_get_model_records_filters_are_pushed_down(self):
+        self.app.put_json('/models/test', MODEL_DEFINITION,
+                          headers=self.headers)
+        filter_records = mock.MagicMock(return_value=([], None))
+        with mock.patch.object(self.db, 'filter_records', filter_records,
+                               create=True):
+            self.app.get('/models/test/records?age=1&limit=2',
+                         headers=self.headers)
+        filter_records.assert_called_with('test', {'age': 1}, 2, None)
+
+    def test_get_model_records_rejects_invalid_filters(self):
+        self.app.put_json('/models/test', MODEL_DEFINITION,
+                          headers=self.headers)
+        resp = self.app.get('/models/test/records?age=abc',
+                            headers=self.headers, status=400)
+        self.assertEqual(resp.json['errors'][0]['name'], 'age')
+
+    def test_post_bulk_records(self):
+        self.app.put_json('/models/test', MODEL_DEFINITION,
+                          headers=self.headers)
+        resp = self.app.post_json('/models/test/bulk',
+                                  [MODEL_RECORD, {'age': 'abc'},
+                                   MODEL_RECORD2],
+                                  headers=self.headers)
+        results = resp.json['records']
+        self.assertIn('id', results[0])
+        self.assertIn('age', results[1]['errors'])
+        self.assertIn('id', results[2])
+        record = self.db.get_record('test', results[2]['id'])
+        self.assertEqual(record['age'], MODEL_RECORD2['age'])
+
+    def test_post_bulk_records_as_ndjson(self):
+        self.app.put_json('/models/test', MODEL_DEFINITION,
+                          headers=self.headers)
+        headers = self.headers.copy()
+        headers['Content-Type'] = 'application/x-ndjson'
+        body = '\n'.join(json.dumps({'age': age}) for age in range(3))
+        resp = self.app.post('/models/test/bulk', body, headers=headers)
+        self.assertEqual(len(resp.json['records']), 3)
+        self.assertEqual(len(self.db.get_records('test')), 3)
+
+    def test_post_bulk_records_rejects_non_list(self):
+        self.app.put_json('/models/test', MODEL_DEFINITION,
+                          headers=self.headers)
+        self.app.post_json('/models/test/bulk', MODEL_RECORD,
+                           headers=self.headers, status=400)
+
+    def test_post_bulk_records_on_unknown_model(self):
+        self.app.post_json('/models/unknown/bulk', [MODEL_RECORD],
+                           headers=self.headers, status=404)
+
     def test_unknown_record_returns_404(self):
         self.app.put_json('/models/test', MODEL_DEFINITION,
                           headers=self.headers)
@@ -587,6 +727,147 @@ class RecordsViewsTest(BaseWebTest):
                 "description": "record not found"}],
             "status": "error"}))
 
+    def test_record_has_etag(self):
+        self.app.put_json('/models/test', MODEL_DEFINITION,
+                          headers=self.headers)
+        self.app.put_json('/models/test/records/1234', MODEL_RECORD,
+                          headers=self.headers)
+        resp = self.app.get('/models/test/records/1234',
+                            headers=self.headers)
+        self.assertEqual(resp.headers['ETag'],
+                         '"%s"' % self.db.get_record_version('test', '1234'))
+
+    def test_unmodified_record_is_not_sent_again(self):
+        self.app.put_json('/models/test', MODEL_DEFINITION,
+                          headers=self.headers)
+        resp = self.app.put_json('/models/test/records/1234', MODEL_RECORD,
+                                 headers=self.headers)
+        headers = dict(self.headers, **{'If-None-Match': resp.headers['ETag']})
+        resp = self.app.get('/models/test/records/1234', headers=headers,
+                            status=304)
+        self.assertEqual(resp.body, b'')
+
+        self.app.patch_json('/models/test/records/1234', {'age': 43},
+                            headers=self.headers)
+        resp = self.app.get('/models/test/records/1234', headers=headers)
+        self.assertEqual(resp.json['age'], 43)
+
+    def test_put_record_with_outdated_if_match(self):
+        self.app.put_json('/models/test', MODEL_DEFINITION,
+                          headers=self.headers)
+        resp = self.app.put_json('/models/test/records/1234', MODEL_RECORD,
+                                 headers=self.headers)
+        headers = dict(self.headers, **{'If-Match': resp.headers['ETag']})
+        self.app.put_json('/models/test/records/1234', MODEL_RECORD,
+                          headers=headers)
+        resp = self.app.put_json('/models/test/records/1234', MODEL_RECORD,
+                                 headers=headers, status=412)
+        self.assertEqual(resp.json['errors'][0]['name'], 'If-Match')
+
+    def test_put_record_if_none_match_refuses_overwrite(self):
+        self.app.put_json('/models/test', MODEL_DEFINITION,
+                          headers=self.headers)
+        headers = dict(self.headers, **{'If-None-Match': '*'})
+        self.app.put_json('/models/test/records/1234', MODEL_RECORD,
+                          headers=headers)
+        self.app.put_json('/models/test/records/1234', MODEL_RECORD,
+                          headers=headers, status=412)
+
+    def test_put_record_if_match_any_requires_record(self):
+        self.app.put_json('/models/test', MODEL_DEFINITION,
+                          headers=self.headers)
+        headers = dict(self.headers, **{'If-Match': '*'})
+        resp = self.app.put_json('/models/test/records/1234', MODEL_RECORD,
+                                 headers=headers, status=412)
+        self.assertEqual(resp.json['errors'][0]['name'], 'If-Match')
+        self.assertRaises(RecordNotFound, self.db.get_record, 'test', '1234')
+
+    def test_etag_is_the_version_written(self):
+        self.app.put_json('/models/test', MODEL_DEFINITION,
+                          headers=self.headers)
+        put_record = self.db.put_record
+        written = []
+
+        def concurrent_put_record(*args, **kwargs):
+            # Another client writes the record right after this request.
+            written.append(put_record(*args, **kwargs))
+            put_record('test', dict(MODEL_RECORD, age=50), ['Alexis'],
+                       '1234')
+            return written[0]
+
+        with mock.patch.object(self.db, 'put_record',
+                               side_effect=concurrent_put_record):
+            resp = self.app.put_json('/models/test/records/1234',
+                                     MODEL_RECORD, headers=self.headers)
+        self.assertEqual(resp.headers['ETag'], '"%s"' % written[0][1])
+
+    def test_patch_record_with_outdated_if_match(self):
+        self.app.put_json('/models/test', MODEL_DEFINITION,
+                          headers=self.headers)
+        self.app.put_json('/models/test/records/1234', MODEL_RECORD,
+                          headers=self.headers)
+        headers = dict(self.headers, **{'If-Match': '"outdated"'})
+        self.app.patch_json('/models/test/records/1234', {'age': 43},
+                            headers=headers, status=412)
+        self.assertEqual(self.db.get_record('test', '1234')['age'], 42)
+
+    def test_patch_record_merges_concurrent_updates(self):
+        self.app.put_json('/models/test', MODEL_DEFINITION,
+                          headers=self.headers)
+        self.app.put_json('/models/test/records/1234', MODEL_RECORD,
+                          headers=self.headers)
+        put_record = self.db.put_record
+        conflicts = []
+
+        def concurrent_put_record(*args, **kwargs):
+            # Another client writes the record between the read and the
+            # write of the first attempt.
+            if not conflicts:
+                conflicts.append(True)
+                put_record('test', dict(MODEL_RECORD, age=50), ['Alexis'],
+                           '1234')
+            return put_record(*args, **kwargs)
+
+        with mock.patch.object(self.db, 'put_record',
+                               side_effect=concurrent_put_record) as mocked:
+            self.app.patch_json('/models/test/records/1234', {'age': 43},
+                                headers=self.headers)
+        # The first write was refused, the record was read and merged again.
+        self.assertEqual(mocked.call_count, 2)
+        self.assertEqual(self.db.get_record('test', '1234')['age'], 43)
+
+    def test_record_deletion_with_outdated_if_match(self):
+        self.app.put_json('/models/test', MODEL_DEFINITION,
+                          headers=self.headers)
+        self.app.put_json('/models/test/records/1234', MODEL_RECORD,
+                          headers=self.headers)
+        headers = dict(self.headers, **{'If-Match': '"outdated"'})
+        self.app.delete('/models/test/records/1234', headers=headers,
+                        status=412)
+        self.db.get_record('test', '1234')
+
+    def test_record_modified_after_if_match_check_is_not_deleted(self):
+        self.app.put_json('/models/test', MODEL_DEFINITION,
+                          headers=self.headers)
+        resp = self.app.put_json('/models/test/records/1234', MODEL_RECORD,
+                                 headers=self.headers)
+        headers = dict(self.headers, **{'If-Match': resp.headers['ETag']})
+        delete_record = self.db.delete_record
+
+        def concurrent_delete_record(*args, **kwargs):
+            # Another client writes the record between the check and the
+            # deletion.
+            self.db.put_record('test', dict(MODEL_RECORD, age=50),
+                               ['Alexis'], '1234')
+            return delete_record(*args, **kwargs)
+
+        with mock.patch.object(self.db, 'delete_record',
+                               side_effect=concurrent_delete_record):
+            resp = self.app.delete('/models/test/records/1234',
+                                   headers=headers, status=412)
+        self.assertEqual(resp.json['errors'][0]['name'], 'If-Match')
+        self.assertEqual(self.db.get_record('test', '1234')['age'], 50)
+
     def assertStartsWith(self, a, b):
         if not a.startswith(b):
             self.fail("'%s' doesn't startswith '%s'" % (a, b))
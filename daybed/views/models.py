@@ -130,9 +130,7 @@ def post_models(request):
 
     request.notify('ModelCreated', model_id)
 
-    for record in request.data_clean['records']:
-        record_id = request.db.put_record(model_id, record, [credentials_id])
-        request.notify('RecordCreated', model_id, record_id)
+    create_records(request, model_id, credentials_id)
 
     request.response.status = "201 Created"
     location = '%s/models/%s' % (request.application_url, model_id)
@@ -169,9 +167,8 @@ def get_model(request):
         return
 
     if "read_all_records" not in request.permissions:
-        records = request.db.get_records_with_authors(model_id)
-        records = [r["record"] for r in records
-                   if set(request.principals).intersection(r["authors"])]
+        records = request.db.get_records_by_authors(model_id,
+                                                    request.principals)
     else:
         records = request.db.get_records(model_id)
 
@@ -219,8 +216,17 @@ def handle_put_model(request, create=False):
     event = 'ModelCreated' if create else 'ModelUpdated'
     request.notify(event, model_id)
 
-    for record in request.data_clean['records']:
-        record_id = request.db.put_record(model_id, record, [credentials_id])
-        request.notify('RecordCreated', model_id, record_id)
+    create_records(request, model_id, credentials_id)
 
     return {"id": model_id}
+
+
+def create_records(request, model_id, credentials_id):
+    """Stores the records given with the model definition at once."""
+    records = request.data_clean['records']
+    if not records:
+        return
+    records_ids = request.db.put_records(model_id, records, [credentials_id])
+    created = [dict(record, id=record_id) for record, record_id
+               in zip(records, records_ids)]
+    request.notify('RecordsCreated', model_id, created)
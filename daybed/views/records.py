@@ -1,11 +1,17 @@
+import base64
 import json
 
+import six
+from colander import Invalid
 from cornice import Service
+from pyramid.httpexceptions import HTTPNotModified
 from pyramid.security import Everyone
+from webob.etag import AnyETag
 
-from daybed.backends.exceptions import RecordNotFound, ModelNotFound
-from daybed.schemas.validators import (RecordSchema, record_validator,
-                                       validate_against_schema)
+from daybed.backends.exceptions import (RecordNotFound, ModelNotFound,
+                                        VersionMismatch)
+from daybed.schemas.validators import (get_record_schema, record_validator,
+                                       validate_against_schema, post_serialize)
 
 
 records = Service(name='records',
@@ -18,25 +24,237 @@ record = Service(name='record',
                  description='Single record')
 
 
+bulk_records = Service(name='bulk-records',
+                       path='/models/{model_id}/bulk',
+                       description='Bulk import of records')
+
+
+def encode_cursor(cursor):
+    """Turns a backend pagination cursor into an opaque URL-safe token."""
+    cursor = json.dumps(cursor).encode('utf-8')
+    return base64.urlsafe_b64encode(cursor).decode('ascii')
+
+
+def decode_cursor(token):
+    """Returns the backend pagination cursor of a token built with
+    :func:`encode_cursor`.
+    """
+    cursor = base64.urlsafe_b64decode(token.encode('ascii'))
+    return json.loads(cursor.decode('utf-8'))
+
+
+def get_record_version(request, model_id, record_id):
+    """Returns the current version of the record, ``None`` if missing."""
+    try:
+        return request.db.get_record_version(model_id, record_id)
+    except RecordNotFound:
+        return None
+
+
+def check_preconditions(request, version):
+    """Checks the ``If-Match`` and ``If-None-Match`` headers of a write
+    against the record ``version`` (``None`` if it does not exist).
+
+    Returns False, with a ``412 Precondition Failed`` error, if they do not
+    match. ``If-Match: *`` requires the record to exist.
+    """
+    if 'If-Match' in request.headers:
+        if version is None or version not in request.if_match:
+            request.errors.add('header', 'If-Match',
+                               "record was modified")
+            request.errors.status = "412 Precondition Failed"
+            return False
+    if version is not None and version in request.if_none_match:
+        request.errors.add('header', 'If-None-Match', "record exists")
+        request.errors.status = "412 Precondition Failed"
+        return False
+    return True
+
+
+def version_mismatch(request):
+    request.errors.add('header', 'If-Match', "record was modified")
+    request.errors.status = "412 Precondition Failed"
+
+
+#: Querystring parameters of records listings, that are not filters.
+LISTING_PARAMETERS = ('limit', 'cursor', 'stream')
+
+
+def get_filters(request, model_id, definition):
+    """Returns the values records are filtered with, given in querystring
+    by field name (``?age=42``) and typed after the model definition.
+    """
+    schema = get_record_schema(model_id, definition)
+    filters = {}
+    for name, value in request.GET.items():
+        node = schema.get(name)
+        if node is None or name in LISTING_PARAMETERS:
+            continue
+        try:
+            filters[name] = post_serialize(node.deserialize(value))
+        except Invalid as e:
+            for field, error in e.asdict().items():
+                request.errors.add('querystring', field, error)
+    return filters
+
+
+def contains(value, expected):
+    """Tells if ``value`` contains ``expected``, like the JSONB ``@>``
+    operator: objects contain their sub-objects, lists contain the lists of
+    some of their items, and other values must be equal.
+    """
+    if isinstance(expected, dict):
+        return isinstance(value, dict) and all(
+            key in value and contains(value[key], item)
+            for key, item in expected.items())
+    if isinstance(expected, list):
+        return isinstance(value, list) and all(
+            any(contains(item, e) for item in value) for e in expected)
+    if isinstance(value, bool) or isinstance(expected, bool):
+        return value is expected
+    return value == expected
+
+
+def filter_records(db, model_id, filters, limit, cursor=None):
+    """Returns a page of records matching the ``filters``, and the cursor of
+    the next one.
+
+    Filters are pushed down to the backend if it supports it, otherwise the
+    records of the page are filtered here (the page may be shorter than
+    ``limit``).
+    """
+    if filters and hasattr(db, 'filter_records'):
+        return db.filter_records(model_id, filters, limit, cursor)
+    results, cursor = db.get_paginated_records(model_id, limit, cursor)
+    if filters:
+        results = [r for r in results if contains(r['record'], filters)]
+    return results, cursor
+
+
+def get_paginated_records(request, model_id, limit, filters):
+    """Returns a page of records, and sets the link to the next one."""
+    cursor = request.GET.get('cursor')
+    try:
+        if cursor is not None:
+            cursor = decode_cursor(cursor)
+        results, next_cursor = filter_records(request.db, model_id, filters,
+                                              limit, cursor)
+    except (TypeError, ValueError):
+        request.errors.add('querystring', 'cursor', "invalid cursor")
+        request.errors.status = "400 Bad Request"
+        return
+
+    if "read_all_records" not in request.permissions:
+        results = [r for r in results
+                   if set(request.principals).intersection(r['authors'])]
+    page = {'records': [r['record'] for r in results]}
+
+    if next_cursor is not None:
+        params = dict((name, value) for name, value in request.GET.items()
+                      if name not in LISTING_PARAMETERS)
+        params.update(limit=limit, cursor=encode_cursor(next_cursor))
+        page['next'] = request.route_url('records', model_id=model_id,
+                                         _query=params)
+        request.response.headers['Link'] = str('<%s>; rel="next"' %
+                                               page['next'])
+    return page
+
+
+def iter_records(request, model_id, batch_size, filters=None):
+    """Yields the readable records of the model matching the ``filters``,
+    fetched from the backend by batches of ``batch_size``.
+    """
+    principals = set(request.principals)
+    read_all = "read_all_records" in request.permissions
+    cursor = None
+    while True:
+        results, cursor = filter_records(request.db, model_id, filters,
+                                         batch_size, cursor)
+        for result in results:
+            if read_all or principals.intersection(result['authors']):
+                yield result['record']
+        if cursor is None:
+            break
+
+
+def stream_records(request, model_id, filters, ndjson=False):
+    """Returns a response whose body is encoded while records are read."""
+    settings = request.registry.settings
+    batch_size = int(settings.get('daybed.stream_batch_size', 1000))
+    records = iter_records(request, model_id, batch_size, filters)
+
+    def ndjson_body():
+        for record in records:
+            yield (json.dumps(record) + '\n').encode('utf-8')
+
+    def json_body():
+        separator = ''
+        yield b'{"records": ['
+        for record in records:
+            yield (separator + json.dumps(record)).encode('utf-8')
+            separator = ', '
+        yield b']}'
+
+    response = request.response
+    if ndjson:
+        response.content_type = 'application/x-ndjson'
+        response.app_iter = ndjson_body()
+    else:
+        response.content_type = 'application/json'
+        response.app_iter = json_body()
+    return response
+
+
 @records.get(permission='get_records')
 @records.get(accept='application/vnd.geo+json', renderer='geojson',
              permission='get_records')
+@records.get(accept='application/x-ndjson', permission='get_records')
 def get_records(request):
-    """Retrieves all model records."""
+    """Retrieves all model records.
+
+    If a ``limit`` is given in querystring, records are paginated, and the
+    link to the next page is provided in ``next``.
+
+    With ``Accept: application/x-ndjson`` or ``?stream=1``, records are
+    streamed to the client as they are read from the backend.
+
+    Records can be filtered by field values given in querystring
+    (``?age=42``).
+    """
     model_id = request.matchdict['model_id']
     try:
-        request.db.get_model_definition(model_id)
+        definition = request.db.get_model_definition(model_id)
     except ModelNotFound:
         request.errors.add('path', model_id, "model not found")
         request.errors.status = "404 Not Found"
         return
+
+    filters = get_filters(request, model_id, definition)
+    if request.errors:
+        request.errors.status = "400 Bad Request"
+        return
+
+    ndjson = 'application/x-ndjson' in request.headers.get('Accept', '')
+    if ndjson or request.GET.get('stream') in ('1', 'true'):
+        return stream_records(request, model_id, filters, ndjson=ndjson)
+
+    limit = request.GET.get('limit')
+    if limit is not None:
+        if not limit.isdigit() or int(limit) == 0:
+            request.errors.add('querystring', 'limit',
+                               "limit should be a positive integer")
+            request.errors.status = "400 Bad Request"
+            return
+        return get_paginated_records(request, model_id, int(limit), filters)
+
     # Return array of records
     if "read_all_records" not in request.permissions:
-        results = request.db.get_records_with_authors(model_id)
-        results = [r['record'] for r in results
-                   if set(request.principals).intersection(r['authors'])]
+        results = request.db.get_records_by_authors(model_id,
+                                                    request.principals)
     else:
         results = request.db.get_records(model_id)
+    if filters:
+        results = [r for r in results if contains(r, filters)]
     return {'records': results}
 
 
@@ -57,10 +275,11 @@ def post_record(request):
         credentials_id = request.credentials_id
     else:
         credentials_id = Everyone
-    record_id = request.db.put_record(model_id, request.data_clean,
-                                      [credentials_id])
+    record_id, version = request.db.put_record(model_id, request.data_clean,
+                                               [credentials_id])
 
     request.notify('RecordCreated', model_id, record_id)
+    request.response.etag = version
 
     created = u'%s/models/%s/records/%s' % (request.application_url, model_id,
                                             record_id)
@@ -69,6 +288,66 @@ def post_record(request):
     return {'id': record_id}
 
 
+def records_from_body(request):
+    """Returns the list of records given as a JSON array, or as NDJSON."""
+    body = request.body.decode('utf-8')
+    if request.content_type == 'application/x-ndjson':
+        return [json.loads(line) for line in body.splitlines()
+                if line.strip()]
+    records = json.loads(body)
+    if not isinstance(records, list):
+        raise ValueError("A list of records is expected.")
+    return records
+
+
+@bulk_records.post(permission='post_record')
+def post_bulk_records(request):
+    """Saves many records at once.
+
+    Every record is validated against the model definition, and the valid
+    ones are stored together. The result of each record, its ``id`` or its
+    ``errors``, is returned in the same order.
+    """
+    model_id = request.matchdict['model_id']
+    try:
+        definition = request.db.get_model_definition(model_id)
+    except ModelNotFound:
+        request.errors.add('path', model_id, "model not found")
+        request.errors.status = "404 Not Found"
+        return
+
+    try:
+        records = records_from_body(request)
+    except ValueError as e:
+        request.errors.add('body', 'body', six.text_type(e))
+        return
+
+    schema = get_record_schema(model_id, definition)
+    results = []
+    valid_records = []
+    for record in records:
+        try:
+            valid_records.append(post_serialize(schema.deserialize(record)))
+            results.append(None)
+        except Invalid as e:
+            results.append({'errors': e.asdict()})
+
+    if request.credentials_id:
+        credentials_id = request.credentials_id
+    else:
+        credentials_id = Everyone
+
+    records_ids = request.db.put_records(model_id, valid_records,
+                                         [credentials_id])
+    created = [dict(record, id=record_id) for record, record_id
+               in zip(valid_records, records_ids)]
+    request.notify('RecordsCreated', model_id, created)
+
+    records_ids = iter(records_ids)
+    return {'records': [result or {'id': next(records_ids)}
+                        for result in results]}
+
+
 @records.delete(permission='delete_records')
 def delete_records(request):
     """Deletes all records of model."""
@@ -86,14 +365,26 @@ def delete_records(request):
 
 @record.get(permission='get_record')
 def get(request):
-    """Retrieves a singe record."""
+    """Retrieves a singe record.
+
+    Its version is given in the ``ETag`` header. If it matches the
+    ``If-None-Match`` header, a ``304 Not Modified`` is returned instead.
+    """
     model_id = request.matchdict['model_id']
     record_id = request.matchdict['record_id']
     try:
-        return request.db.get_record(model_id, record_id)
+        record, version = request.db.get_record_with_version(model_id,
+                                                             record_id)
     except RecordNotFound:
         request.errors.add('path', record_id, "record not found")
         request.errors.status = "404 Not Found"
+        return
+    if version in request.if_none_match:
+        response = HTTPNotModified()
+        response.etag = version
+        return response
+    request.response.etag = version
+    return record
 
 
 @record.put(validators=record_validator, permission='put_record')
@@ -106,27 +397,45 @@ def put(request):
     model_id = request.matchdict['model_id']
     record_id = request.matchdict['record_id']
 
-    try:
-        request.db.get_record(model_id, record_id)
-        create = True
-    except RecordNotFound:
-        create = False
+    version = get_record_version(request, model_id, record_id)
+    if not check_preconditions(request, version):
+        return
+    create = version is None
 
     if request.credentials_id:
         credentials_id = request.credentials_id
     else:
         credentials_id = Everyone
 
-    record_id = request.db.put_record(model_id, request.data_clean,
-                                      [credentials_id], record_id=record_id)
+    # With If-Match, the record is only replaced if it was not modified
+    # in the meantime.
+    expected = version if request.if_match is not AnyETag else None
+    try:
+        record_id, version = request.db.put_record(model_id,
+                                                   request.data_clean,
+                                                   [credentials_id],
+                                                   record_id=record_id,
+                                                   version=expected)
+    except VersionMismatch:
+        version_mismatch(request)
+        return
     event = 'RecordCreated' if create else 'RecordUpdated'
     request.notify(event, model_id, record_id)
+    request.response.etag = version
     return {'id': record_id}
 
 
+PATCH_ATTEMPTS = 3
+
+
 @record.patch(permission='patch_record')
 def patch(request):
-    """Updates an existing record."""
+    """Updates an existing record.
+
+    The record is only written back if it was not modified since it was
+    read: concurrent updates are merged again, unless an ``If-Match``
+    version was given.
+    """
     model_id = request.matchdict['model_id']
     record_id = request.matchdict['record_id']
 
@@ -135,19 +444,44 @@ def patch(request):
     else:
         credentials_id = Everyone
 
-    try:
-        record = request.db.get_record(model_id, record_id)
-    except RecordNotFound:
-        request.errors.add('path', record_id, "record not found")
-        request.errors.status = "404 Not Found"
+    changes = json.loads(request.body.decode('utf-8'))
+    definition = request.db.get_model_definition(model_id)
+    schema = get_record_schema(model_id, definition)
+
+    for attempt in range(PATCH_ATTEMPTS):
+        try:
+            record, version = request.db.get_record_with_version(model_id,
+                                                                 record_id)
+        except RecordNotFound:
+            request.errors.add('path', record_id, "record not found")
+            request.errors.status = "404 Not Found"
+            return
+
+        if not check_preconditions(request, version):
+            return
+
+        record.update(changes)
+        validate_against_schema(request, schema, record)
+        if request.errors:
+            return {'id': record_id}
+
+        try:
+            _, version = request.db.put_record(model_id, record,
+                                               [credentials_id], record_id,
+                                               version=version)
+            break
+        except VersionMismatch:
+            if request.if_match is not AnyETag:
+                version_mismatch(request)
+                return
+    else:
+        request.errors.add('path', record_id,
+                           "record is modified concurrently")
+        request.errors.status = "409 Conflict"
         return
 
-    record.update(json.loads(request.body.decode('utf-8')))
-    definition = request.db.get_model_definition(model_id)
-    validate_against_schema(request, RecordSchema(definition), record)
-    if not request.errors:
-        request.db.put_record(model_id, record, [credentials_id], record_id)
-        request.notify('RecordUpdated', model_id, record_id)
+    request.notify('RecordUpdated', model_id, record_id)
+    request.response.etag = version
     return {'id': record_id}
 
 
@@ -157,11 +491,22 @@ def delete(request):
     model_id = request.matchdict['model_id']
     record_id = request.matchdict['record_id']
 
+    version = get_record_version(request, model_id, record_id)
+    if not check_preconditions(request, version):
+        return
+
+    # With If-Match, the record is only deleted if it was not modified
+    # in the meantime.
+    expected = version if request.if_match is not AnyETag else None
     try:
-        deleted = request.db.delete_record(model_id, record_id)
+        deleted = request.db.delete_record(model_id, record_id,
+                                           version=expected)
         request.notify('RecordDeleted', model_id, record_id)
     except RecordNotFound:
         request.errors.add('path', record_id, "record not found")
         request.errors.status = "404 Not Found"
         return
+    except VersionMismatch:
+        version_mismatch(request)
+        return
     return deleted
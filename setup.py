@@ -49,6 +49,9 @@ REQUIREMENTS = [
     'setuptools',
     'six',
 ]
+EXTRAS_REQUIRE = {
+    'postgresql': ['psycopg2'],
+}
 DEPENDENCY_LINKS = [
     'https://github.com/Natim/couchdb-python/tarball/'
     'authorization_header_py26#egg=CouchDB-0.10.1dev',
@@ -58,6 +61,9 @@ DEPENDENCY_LINKS = [
 ENTRY_POINTS = {
     'paste.app_factory': [
         'main = daybed:main',
+    ],
+    'console_scripts': [
+        'daybed-reindex = daybed.scripts.reindex:main',
     ]}
 
 
@@ -79,5 +85,6 @@ if __name__ == '__main__':  # Don't run setup() when we import this module.
           include_package_data=True,
           zip_safe=False,
           install_requires=REQUIREMENTS,
+          extras_require=EXTRAS_REQUIRE,
           dependency_links=DEPENDENCY_LINKS,
           entry_points=ENTRY_POINTS)